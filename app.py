@@ -9,6 +9,7 @@ import subprocess
 import pandas as pd
 import io 
 from datetime import date
+from etl_nested import read_flat # Descargas del Paso 4 en forma plana aunque esté anidado
 
 # --- Configuración Inicial ---
 sys.path.append(os.getcwd()) 
@@ -79,14 +80,16 @@ def check_status(paths):
     outputs = {
         1: os.path.join(paths.get('intermediate_loaded',''), 'CasosActuacionesInquisitivo.parquet'),
         2: os.path.join(paths.get('intermediate_processed',''), 'data_casos_processed.parquet'),
-        3: os.path.join(paths.get('intermediate_analytical',''), 'data_final_comparativo.parquet'),
+        3: [os.path.join(paths.get('intermediate_analytical',''), 'data_final_comparativo.parquet'),
+            os.path.join(paths.get('intermediate_analytical',''), 'data_atlas.json')], # Ancho o par estrella
         4: os.path.join(paths.get('intermediate_processed',''), 'df_casos_personas_final.parquet'),
         5: os.path.join(paths.get('intermediate_processed',''), 'df_procesal_unificado.parquet'),
         6: os.path.join(paths.get('output_reports',''), 'baseUnisaMixtoAcusatorio.csv')
     }
     status = {}
     for i in range(1, 7):
-        status[f'step_{i}_done'] = os.path.exists(outputs.get(i, ''))
+        output = outputs.get(i, '')
+        status[f'step_{i}_done'] = any(os.path.exists(p) for p in output) if isinstance(output, list) else os.path.exists(output)
         status[f'step_{i}_running'] = os.path.exists(STEP_CTRLS[i]['running'])
     return status
 
@@ -170,14 +173,14 @@ def render_inspector(step_num, metrics_file):
                 elif fmt == "CSV":
                     if st.button("Generar CSV", key=f"c_{step_num}"):
                         with st.spinner("Convirtiendo..."):
-                            df = pd.read_parquet(output_file)
+                            df = read_flat(output_file, log=lambda msg: None)
                             st.download_button("⬇️ Bajar CSV", df.to_csv(index=False).encode('utf-8'), "data.csv", "text/csv")
                 elif fmt == "Excel":
                     if m.get('rows', 0) > 1000000: st.error("Muy grande para Excel.")
                     elif st.button("Generar Excel", key=f"x_{step_num}"):
                         with st.spinner("Generando..."):
                             buf = io.BytesIO()
-                            pd.read_parquet(output_file).to_excel(buf, index=False)
+                            read_flat(output_file, log=lambda msg: None).to_excel(buf, index=False)
                             st.download_button("⬇️ Bajar Excel", buf.getvalue(), "data.xlsx")
         else: st.warning(f"Archivo no encontrado: {output_file}")
     except Exception as e: st.error(f"Error inspector: {e}")
@@ -0,0 +1,286 @@
+# etl_atlas.py
+"""
+etl_atlas.py
+
+Atlas en esquema estrella. data_final_comparativo.parquet repite en cada fila de actuación
+todos los atributos del caso (oficina, fiscalía y territorio de ingreso y actual, delito,
+imputados, víctimas, CasoComplejo, EstadoUNISA...). El Paso 3 puede escribir, además del
+archivo ancho o en su lugar, un par normalizado en la carpeta analítica:
+
+- data_atlas_casos.parquet: dimensión de casos, una fila por IdCaso con las columnas de caso.
+- data_atlas_actuaciones.parquet: tabla de hechos, una fila por actuación (IdActuacion) con
+  IdCaso como clave del caso, en el mismo orden de filas que el Atlas ancho.
+- data_atlas.json: orden de columnas de la vista ancha y columnas de cada tabla. Se escribe
+  al final: si falta, el par no está completo y no se usa.
+
+load_atlas() reconstruye la vista ancha solo con las columnas pedidas: lee de la tabla de
+hechos las columnas de actuación (más IdCaso), de la dimensión las de caso, y las agrega por
+índice (etl_join). Los filtros sobre columnas de caso se resuelven en la dimensión y llegan a
+la tabla de hechos como IdCaso in (...). Sin el par lee el Atlas ancho como siempre (dataset
+particionado o archivo único).
+
+Configuración (sección "atlas" de config.json): "star" escribe el par, "wide" el archivo
+ancho. Con ambos apagados se escribe el ancho.
+"""
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from etl_loader import load_parquet, scan_parquet
+from etl_join import KeyIndex, join_left
+from etl_buckets import bucket_path, split_parquet, split_tables, concat_buckets
+
+ATLAS_NAME = 'data_final_comparativo'
+CASES_FILE = 'data_atlas_casos.parquet'
+FACTS_FILE = 'data_atlas_actuaciones.parquet'
+LAYOUT_FILE = 'data_atlas.json'
+CASE_KEY = 'IdCaso'
+
+# Atributos del caso (Paso 2 y enriquecimiento del Paso 3). Las columnas de la actuación
+# (fechas, oficina/fiscalía/territorio de la actuación, estado, audiencia) quedan en los hechos.
+ATLAS_CASE_COLS = [
+    'numero', 'FechaIngreso', 'estadocaso', 'origen', 'tipodecaso', 'Organismo',
+    'IdOficinaAlta', 'oficina_ingreso', 'fiscalia_ingreso', 'jurisdiccion_ingreso',
+    'IdOficinaActual', 'oficina_actual', 'fiscalia_actual', 'jurisdiccion_actual',
+    'IdSistemaProcesal', 'AutoresIgnorados', 'IdCasoOriginal', 'FechaIngresoCasoIncidente',
+    'FechaIngresoOriginal', 'fechaprimeractuacion', 'caso_incidente', 'fecha_hecho', 'fechahechosk',
+    'unidadfiscal_ingreso', 'unidadfiscal_actual', 'territorio_acusatorio_ingreso', 'territorio_acusatorio_actual',
+    'delito_principal', 'IdActuacion_ulitmoestado', 'descripcionactuacion_ulitmoestado',
+    'imputados', 'imputados_complejo', 'Victimas', 'victimas_complejo', 'CasoComplejo',
+    'IdActuacionUltimoEstadoUNISA', 'ordenultimoestado', 'EstadoUNISA', 'EstadoUnisaFecha',
+    'jurisdiccion_para_implementacion', 'descripcion_sistemaprocesal'
+]
+
+def star_paths(analytical_dir):
+    return {"cases": os.path.join(analytical_dir, CASES_FILE),
+            "facts": os.path.join(analytical_dir, FACTS_FILE),
+            "layout": os.path.join(analytical_dir, LAYOUT_FILE)}
+
+def read_layout(analytical_dir):
+    """Descripción del par estrella, o None si no hay un par completo."""
+    paths = star_paths(analytical_dir)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    try:
+        with open(paths['layout'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def remove_star(analytical_dir):
+    """Borra el par de una corrida anterior (primero el layout, para que nadie lo lea a medias)."""
+    paths = star_paths(analytical_dir)
+    for key in ('layout', 'cases', 'facts'):
+        if os.path.exists(paths[key]):
+            os.remove(paths[key])
+
+def _first_rows(keys):
+    """Códigos de caso por fila y primera fila de cada caso (en orden de aparición)."""
+    codes, _ = pd.factorize(keys, use_na_sentinel=False)
+    _, first = np.unique(codes, return_index=True)
+    return codes, first
+
+def case_columns(df, candidates=None, log=print):
+    """
+    Columnas de caso presentes en df que efectivamente son constantes dentro de cada IdCaso.
+    Las que varían se informan y quedan en la tabla de hechos, así la vista reconstruida es
+    siempre igual al Atlas ancho.
+    """
+    present = [c for c in (candidates or ATLAS_CASE_COLS) if c in df.columns and c != CASE_KEY]
+    if df.empty:
+        return present
+    codes, first = _first_rows(df[CASE_KEY])
+    representative = first[codes]
+    constant = []
+    for col in present:
+        values, _ = pd.factorize(df[col], use_na_sentinel=False)
+        if (values[representative] == values).all():
+            constant.append(col)
+        else:
+            log(f"    [ATLAS] {col} varía dentro de un mismo caso: queda en la tabla de actuaciones")
+    return constant
+
+def split_star(df, case_cols):
+    """Separa el Atlas ancho en (dimensión de casos, tabla de hechos)."""
+    _, first = _first_rows(df[CASE_KEY])
+    dim = df[[CASE_KEY] + case_cols].take(first).reset_index(drop=True)
+    dropped = set(case_cols)
+    fact = df[[c for c in df.columns if c not in dropped]]
+    return dim, fact
+
+def _write_parquet(df, path):
+    tmp_path = path + '.tmp'
+    df.to_parquet(tmp_path, index=False, engine='pyarrow')
+    os.replace(tmp_path, path)
+
+def _write_layout(analytical_dir, columns, case_cols, rows, cases, rules=None):
+    paths = star_paths(analytical_dir)
+    layout = {"key": CASE_KEY, "columns": list(columns), "case_columns": list(case_cols),
+              "fact_columns": [c for c in columns if c not in set(case_cols)],
+              "rows": int(rows), "cases": int(cases), "rules": rules or {}, "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    tmp_path = paths['layout'] + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(layout, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, paths['layout'])
+    return layout
+
+def write_star(df, analytical_dir, log=print, rules=None):
+    """
+    Escribe el par estrella a partir del Atlas ancho en memoria. Devuelve el layout.
+    'rules' ({nombre: huella}) queda en el layout, como en los metadatos del archivo ancho.
+    """
+    remove_star(analytical_dir)
+    paths = star_paths(analytical_dir)
+    case_cols = case_columns(df, log=log)
+    dim, fact = split_star(df, case_cols)
+    _write_parquet(dim, paths['cases'])
+    _write_parquet(fact, paths['facts'])
+    layout = _write_layout(analytical_dir, df.columns, case_cols, len(fact), len(dim), rules)
+    _log_written(layout, paths, log)
+    return layout
+
+def write_star_buckets(salidas, analytical_dir, case_cols, work_dir, log=print, rules=None):
+    """
+    Igual que write_star para las salidas por balde del modo fuera de memoria. Los baldes
+    son por IdCaso (ningún caso queda repartido), así que cada balde se separa por su cuenta
+    con las mismas columnas de caso y las piezas se concatenan.
+    """
+    remove_star(analytical_dir)
+    paths = star_paths(analytical_dir)
+    columns, dims, facts = None, [], []
+    for b, path in enumerate(salidas):
+        if not os.path.exists(path):
+            continue
+        df = pq.read_table(path).to_pandas()
+        columns = columns if columns is not None else list(df.columns)
+        dim, fact = split_star(df, case_cols)
+        dims.append(bucket_path(work_dir, 'star_casos', b))
+        facts.append(bucket_path(work_dir, 'star_actuaciones', b))
+        dim.to_parquet(dims[-1], index=False, engine='pyarrow')
+        fact.to_parquet(facts[-1], index=False, engine='pyarrow')
+        del df, dim, fact
+    if columns is None:
+        return None
+    cases = concat_buckets(dims, paths['cases'])
+    rows = concat_buckets(facts, paths['facts'])
+    layout = _write_layout(analytical_dir, columns, case_cols, rows, cases, rules)
+    _log_written(layout, paths, log)
+    return layout
+
+def _log_written(layout, paths, log):
+    mb = sum(os.path.getsize(paths[k]) for k in ('cases', 'facts')) / 1024**2
+    log(f"  -> Atlas estrella: {layout['cases']:,} casos x {len(layout['case_columns'])} columnas + "
+        f"{layout['rows']:,} actuaciones x {len(layout['fact_columns'])} columnas ({mb:.1f} MB en disco)")
+
+# --- Lectura ---
+
+def atlas_source(analytical_dir, use_dataset=False):
+    """
+    De dónde lee load_atlas: ('star', layout), ('wide', archivo único), ('dataset', carpeta
+    particionada) o (None, None) si el Paso 3 no dejó nada. El dataset particionado sale en
+    orden de partición: solo se prefiere al archivo único con use_dataset=True (el Paso 4,
+    que filtra por partición); si no, solo se usa cuando no hay otra fuente.
+    """
+    layout = read_layout(analytical_dir)
+    if layout is not None:
+        return 'star', layout
+    dataset_path = os.path.join(analytical_dir, ATLAS_NAME)
+    wide_path = dataset_path + '.parquet'
+    has_dataset = os.path.isdir(dataset_path)
+    if use_dataset and has_dataset:
+        return 'dataset', dataset_path
+    if os.path.exists(wide_path):
+        return 'wide', wide_path
+    if has_dataset:
+        return 'dataset', dataset_path
+    return None, None
+
+def _split_filters(filters, layout):
+    """Reparte filtros [(col, op, valor), ...] entre la dimensión y la tabla de hechos."""
+    if filters is None:
+        return [], []
+    if not isinstance(filters, list) or not all(isinstance(f, tuple) for f in filters):
+        raise ValueError("El Atlas estrella solo acepta filtros [(columna, op, valor), ...]")
+    case_cols = set(layout['case_columns'])
+    return [f for f in filters if f[0] in case_cols], [f for f in filters if f[0] not in case_cols]
+
+def load_atlas(analytical_dir, columns=None, filters=None, log=print, partition_columns=False, use_dataset=False):
+    """
+    Atlas ancho con las columnas pedidas (todas con columns=None, en el orden original) y
+    los filtros de fila aplicados en la lectura. Con el par estrella solo se leen y cruzan las
+    columnas pedidas; si no, se lee el Atlas ancho con load_parquet. use_dataset: ver
+    atlas_source. Un dataset particionado devuelve siempre sus columnas de partición.
+    """
+    source, where = atlas_source(analytical_dir, use_dataset)
+    if source is None:
+        raise FileNotFoundError(f"No se encontró el Atlas en {analytical_dir}")
+    if source != 'star':
+        return load_parquet(where, columns=columns, filters=filters, log=log,
+                            partition_columns=partition_columns or source == 'dataset')
+
+    layout, paths = where, star_paths(analytical_dir)
+    key, case_cols = layout['key'], set(layout['case_columns'])
+    if columns is None:
+        wanted = list(layout['columns'])
+    else:
+        wanted = [c for c in columns if c in layout['columns']]
+        missing = [c for c in columns if c not in layout['columns']]
+        if missing:
+            log(f"    [ATLAS] columnas no presentes (se omiten): {missing}")
+    case_filters, fact_filters = _split_filters(filters, layout)
+    dim_cols = [c for c in wanted if c in case_cols]
+
+    dim = None
+    if dim_cols or case_filters:
+        dim = load_parquet(paths['cases'], columns=[key] + dim_cols, filters=case_filters or None, log=log)
+    if case_filters:
+        fact_filters.append((key, 'in', dim[key].tolist()))
+    fact_cols = [c for c in wanted if c not in case_cols]
+    fact = load_parquet(paths['facts'], columns=fact_cols + ([key] if key not in fact_cols else []),
+                        filters=fact_filters or None, log=log)
+    if dim_cols:
+        fact, _ = join_left(fact, KeyIndex(fact[key]), dim, key)
+    log(f"    [ATLAS] Vista ancha desde el par estrella: {len(fact_cols)} columnas de actuación + "
+        f"{len(dim_cols)} de caso, {len(fact):,} filas")
+    return fact[wanted]
+
+def split_atlas(analytical_dir, key, n_buckets, work_dir, name, filters=None, log=print):
+    """
+    Reparte el Atlas ancho en baldes por hash de 'key' (modo fuera de memoria del Paso 4).
+    Con el par estrella la vista ancha se arma por lotes de la tabla de hechos: la dimensión
+    (ya filtrada) queda en memoria y sus columnas se agregan a cada lote con un take.
+    Devuelve las filas repartidas, o None si no hay Atlas.
+    """
+    source, where = atlas_source(analytical_dir)
+    if source is None:
+        return None
+    if source != 'star':
+        wide_path = os.path.join(analytical_dir, ATLAS_NAME + '.parquet')
+        if not os.path.exists(wide_path):
+            wide_path = where
+        return split_parquet(wide_path, key, n_buckets, work_dir, name, filters=filters)
+
+    layout, paths = where, star_paths(analytical_dir)
+    case_key = layout['key']
+    case_filters, fact_filters = _split_filters(filters, layout)
+    dim = scan_parquet(paths['cases'], filters=case_filters or None).to_table()
+    if case_filters:
+        fact_filters.append((case_key, 'in', dim.column(case_key).to_pylist()))
+    scanner = scan_parquet(paths['facts'], filters=fact_filters or None)
+    fact_schema = scanner.projected_schema
+    schema = pa.schema([fact_schema.field(c) if c in fact_schema.names else dim.schema.field(c) for c in layout['columns']])
+    dim_index = pd.Index(dim.column(case_key).to_pandas())
+
+    def wide_batches():
+        for batch in scanner.to_batches():
+            table = pa.Table.from_batches([batch], schema=fact_schema)
+            positions = dim_index.get_indexer(table.column(case_key).to_pandas())
+            yield pa.Table.from_arrays([table.column(c) if c in fact_schema.names else dim.column(c).take(positions)
+                                        for c in layout['columns']], schema=schema)
+
+    rows = split_tables(wide_batches(), schema, key, n_buckets, work_dir, name)
+    log(f"    [ATLAS] Baldes armados desde el par estrella ({len(layout['case_columns'])} columnas de caso)")
+    return rows
@@ -0,0 +1,136 @@
+# etl_audiencias.py
+"""
+etl_audiencias.py
+
+Detector de audiencias del Paso 3. Una actuación es audiencia si su descripción contiene
+'audiencia' y ninguna de las frases de exclusión (rules/exclusiones_audiencia.json).
+
+- Las frases de exclusión se buscan todas juntas con un autómata Aho-Corasick (una sola
+  pasada por texto, independiente de la cantidad de frases). pyahocorasick es opcional
+  (requirements-optional.txt): sin él se usa la alternancia regex de siempre, con el
+  mismo resultado.
+- Cada descripción distinta se evalúa una vez y el veredicto queda en un caché Parquet
+  en disco (descripción -> bool). El nombre del archivo lleva un hash de las reglas
+  (palabra clave + frases), así que al cambiar la lista el caché anterior se descarta
+  solo y la corrida siguiente reclasifica todo.
+"""
+import os
+import re
+import glob
+import json
+import hashlib
+import pandas as pd
+
+try:
+    import ahocorasick
+except ImportError: # Opcional: sin pyahocorasick se usa la alternancia regex
+    ahocorasick = None
+
+AUDIENCIA_KEYWORD = 'audiencia'
+CACHE_PREFIX = 'audiencias_'
+
+class PhraseMatcher:
+    """¿El texto (ya en minúsculas) contiene alguna de las frases? Aho-Corasick o regex."""
+
+    def __init__(self, phrases):
+        self.phrases = sorted({p.lower() for p in phrases if p})
+        self.backend = 'aho-corasick' if ahocorasick is not None else 'regex'
+        if not self.phrases:
+            self._search = lambda text: False
+        elif ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for i, phrase in enumerate(self.phrases):
+                automaton.add_word(phrase, i)
+            automaton.make_automaton()
+            self._search = lambda text: next(automaton.iter(text), None) is not None
+        else:
+            pattern = re.compile('|'.join(re.escape(p) for p in self.phrases))
+            self._search = lambda text: pattern.search(text) is not None
+
+    def search(self, text):
+        return self._search(text)
+
+def rules_hash(exclusions, keyword=AUDIENCIA_KEYWORD):
+    """Hash corto de las reglas: cambia si cambia la palabra clave o cualquier frase."""
+    rules = {"keyword": keyword, "exclusiones": sorted({p.lower() for p in exclusions if p})}
+    return hashlib.sha256(json.dumps(rules, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+class AudienciaDetector:
+    """
+    Clasificador con caché persistente. classify() recibe valores distintos (pensado para
+    apply_on_categories) y devuelve una Serie bool; save() agrega al caché lo nuevo.
+    Sin cache_dir funciona igual pero no persiste nada.
+    """
+
+    def __init__(self, exclusions, cache_dir=None, keyword=AUDIENCIA_KEYWORD, log=print):
+        self.keyword = keyword
+        self.matcher = PhraseMatcher(exclusions)
+        self.key = rules_hash(exclusions, keyword)
+        self.log = log
+        self.cache_path = os.path.join(cache_dir, f"{CACHE_PREFIX}{self.key}.parquet") if cache_dir else None
+        self.verdicts = self._load()
+        self.new = {}
+        self.hits = 0
+
+    def _load(self):
+        if self.cache_path is None:
+            return {}
+        # Cachés de otras versiones de la lista: ya no sirven
+        for stale in glob.glob(os.path.join(os.path.dirname(self.cache_path), f"{CACHE_PREFIX}*.parquet")):
+            if stale != self.cache_path:
+                try: os.remove(stale)
+                except FileNotFoundError: continue # Otro balde ya lo borró
+                self.log(f"    [AUDIENCIAS] Lista de exclusión modificada: se descarta {os.path.basename(stale)}")
+        return self._read_cache()
+
+    def _evaluate(self, text):
+        lowered = text.lower()
+        return self.keyword in lowered and not self.matcher.search(lowered)
+
+    def classify(self, values):
+        """Veredicto por valor; los nulos no son audiencia y no se guardan en el caché."""
+        result = []
+        for value in values:
+            if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+                result.append(False)
+                continue
+            text = str(value)
+            verdict = self.verdicts.get(text)
+            if verdict is None:
+                verdict = self._evaluate(text)
+                self.verdicts[text] = verdict
+                self.new[text] = verdict
+            else:
+                self.hits += 1
+            result.append(bool(verdict))
+        return pd.Series(result, index=values.index, dtype=bool)
+
+    def _read_cache(self):
+        """Veredictos guardados en disco ({} si no hay caché o no se puede leer)."""
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            cached = pd.read_parquet(self.cache_path)
+        except Exception as e:
+            self.log(f"    [AUDIENCIAS] Caché ilegible, se reclasifica: {e}")
+            return {}
+        return dict(zip(cached['descripcion'], cached['es_audiencia']))
+
+    def save(self):
+        """
+        Agrega los veredictos nuevos al caché (escritura atómica: tmp + replace). En el modo
+        por baldes varios procesos guardan el mismo archivo: se relee justo antes de escribir
+        y se suma lo que agregaron los demás, en lugar de pisarlo con lo cargado al inicio.
+        """
+        total = self.hits + len(self.new)
+        self.log(f"    [AUDIENCIAS] {total:,} descripciones distintas: {self.hits:,} desde caché, "
+                 f"{len(self.new):,} clasificadas ({self.matcher.backend})")
+        if self.cache_path is None or not self.new:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        verdicts = {**self._read_cache(), **self.new}
+        cached = pd.DataFrame({'descripcion': list(verdicts), 'es_audiencia': list(verdicts.values())})
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        cached.to_parquet(tmp_path, index=False, engine='pyarrow')
+        os.replace(tmp_path, self.cache_path)
+        self.new = {}
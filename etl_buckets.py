@@ -0,0 +1,190 @@
+# etl_buckets.py
+"""
+etl_buckets.py
+
+Ejecución particionada "fuera de memoria" para los pasos 2 a 5. Las filas se reparten
+por hash de una clave (IdCaso, IdActuacion o IdCasoOriginal según el paso) en N archivos
+de disco; la lógica del paso corre balde por balde, en serie o en procesos paralelos,
+y las salidas se concatenan en un único Parquet. Como todas las operaciones de grupo
+de esos pasos son por caso (o por persona, resuelto con un agregado global chico),
+el pico de memoria queda acotado por el tamaño de un balde y no por el del dataset.
+
+Configuración (sección "out_of_core" de config.json):
+    {"enabled": false, "buckets": 16, "workers": 1, "dir": null}
+'dir' es la carpeta de trabajo de los baldes (por defecto '_buckets' dentro de la
+carpeta de salida del paso); se borra al terminar.
+"""
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from etl_loader import scan_parquet
+
+DEFAULT_BUCKETS = 16
+BUCKETS_DIRNAME = '_buckets'
+
+def bucket_settings(config, default_dir):
+    """Normaliza la sección 'out_of_core' del config. Devuelve None si el modo está apagado."""
+    settings = (config or {}).get('out_of_core', {})
+    if not settings.get('enabled', False):
+        return None
+    return {
+        "buckets": max(int(settings.get('buckets', DEFAULT_BUCKETS)), 1),
+        "workers": max(int(settings.get('workers', 1)), 1),
+        "dir": settings.get('dir') or os.path.join(default_dir, BUCKETS_DIRNAME),
+    }
+
+def hash_bucket(keys, n_buckets):
+    """
+    Balde de cada clave. Las claves numéricas se hashean como float64 para que un IdCaso
+    int32 en un archivo e int64/float en otro caigan en el mismo balde.
+    """
+    s = pd.Series(keys)
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        s = s.astype(s.cat.categories.dtype)
+    if pd.api.types.is_numeric_dtype(s):
+        values = s.astype('float64').to_numpy()
+    else:
+        values = s.astype(object).to_numpy()
+    return (pd.util.hash_array(values) % n_buckets).astype(np.int64)
+
+def key_column(path, candidates):
+    """Primera columna de 'candidates' presente en el Parquet (los extractos crudos usan minúsculas)."""
+    names = scan_parquet(path).projected_schema.names
+    return next((c for c in candidates if c in names), None)
+
+def bucket_path(work_dir, name, bucket):
+    return os.path.join(work_dir, f"{name}.b{bucket:03d}.parquet")
+
+def split_parquet(path, key, n_buckets, work_dir, name, columns=None, filters=None):
+    """
+    Reparte un Parquet en n_buckets archivos según hash_bucket(key), leyendo por lotes.
+    Todos los baldes quedan creados (vacíos si no les toca ninguna fila). Devuelve las filas escritas.
+    """
+    scanner = scan_parquet(path, columns=columns, filters=filters)
+    schema = scanner.projected_schema
+    tables = (pa.Table.from_batches([batch], schema=schema) for batch in scanner.to_batches())
+    return split_tables(tables, schema, key, n_buckets, work_dir, name)
+
+def split_tables(tables, schema, key, n_buckets, work_dir, name):
+    """Igual que split_parquet para una secuencia de tablas Arrow con el mismo esquema."""
+    os.makedirs(work_dir, exist_ok=True)
+    writers = [pq.ParquetWriter(bucket_path(work_dir, name, b), schema) for b in range(n_buckets)]
+    rows = 0
+    try:
+        for table in tables:
+            if table.num_rows == 0:
+                continue
+            buckets = hash_bucket(table.column(key).to_pandas(), n_buckets)
+            order = np.argsort(buckets, kind='stable')
+            bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+            for b in range(n_buckets):
+                if bounds[b] < bounds[b + 1]:
+                    writers[b].write_table(table.take(order[bounds[b]:bounds[b + 1]]))
+            rows += table.num_rows
+    finally:
+        for w in writers:
+            w.close()
+    return rows
+
+def split_frame(df, key, n_buckets, work_dir, name):
+    """Igual que split_parquet para un DataFrame ya en memoria (tablas de referencia chicas)."""
+    os.makedirs(work_dir, exist_ok=True)
+    buckets = hash_bucket(df[key], n_buckets)
+    for b in range(n_buckets):
+        df[buckets == b].to_parquet(bucket_path(work_dir, name, b), index=False, engine='pyarrow')
+
+def read_bucket(work_dir, name, bucket):
+    """Lee un balde; None si el insumo no se repartió (p.ej. una tabla opcional ausente)."""
+    path = bucket_path(work_dir, name, bucket)
+    if not os.path.exists(path):
+        return None
+    return pq.read_table(path).to_pandas()
+
+def run_buckets(func, args_list, workers):
+    """Ejecuta func(*args) por balde, en serie o en un pool de procesos. Devuelve los resultados en orden."""
+    if workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, *args) for args in args_list]
+        return [f.result() for f in futures]
+
+def _unified_schema(schemas):
+    """
+    Esquema común para concatenar baldes: un balde puede traer una columna como nula
+    (todo vacío) o como texto plano donde otro la trae categórica.
+    """
+    names = []
+    for schema in schemas:
+        names.extend(n for n in schema.names if n not in names)
+    fields = []
+    for name in names:
+        types = [s.field(name).type for s in schemas if name in s.names and not pa.types.is_null(s.field(name).type)]
+        if not types:
+            fields.append(pa.field(name, pa.null()))
+            continue
+        if all(t == types[0] for t in types):
+            fields.append(pa.field(name, types[0]))
+            continue
+        plain = [t.value_type if pa.types.is_dictionary(t) else t for t in types]
+        if all(t == plain[0] for t in plain):
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), plain[0])))
+        else:
+            fields.append(pa.unify_schemas([pa.schema([pa.field(name, t)]) for t in plain],
+                                           promote_options='permissive').field(name))
+    return pa.schema(fields)
+
+def iter_unified_tables(paths):
+    """Recorre las salidas de los baldes de a una, ya convertidas al esquema común."""
+    paths = [p for p in paths if p and os.path.exists(p)]
+    schema = _unified_schema([pq.read_schema(p) for p in paths])
+    for p in paths:
+        table = pq.read_table(p)
+        columns = [table.column(f.name).cast(f.type) if f.name in table.column_names
+                   else pa.nulls(table.num_rows, f.type) for f in schema]
+        yield pa.Table.from_arrays(columns, schema=schema)
+
+def concat_buckets(paths, output_path, metadata=None):
+    """
+    Concatena las salidas de los baldes en un único Parquet, de a un balde por vez.
+    'metadata' se agrega a los metadatos del esquema. Devuelve la cantidad de filas escritas.
+    """
+    tmp_path = output_path + '.tmp'
+    rows = 0
+    writer = None
+    try:
+        for table in iter_unified_tables(paths):
+            if metadata:
+                table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, output_path)
+    return rows
+
+def preview_frame(path, rows=10):
+    """Primeras filas de un Parquet, para las métricas sin cargar el archivo completo."""
+    pf = pq.ParquetFile(path)
+    # Por row groups enteros: iter_batches no arma lotes de columnas anidadas (listas de
+    # structs) que crucen row groups, y cada balde concatenado es un row group
+    tables, n = [], 0
+    for i in range(pf.num_row_groups):
+        if n >= rows:
+            break
+        table = pf.read_row_group(i)
+        tables.append(table.slice(0, rows - n))
+        n += table.num_rows
+    if not tables:
+        return pf.schema_arrow.empty_table().to_pandas()
+    return pa.concat_tables(tables).to_pandas()
+
+def clear_work_dir(work_dir):
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
@@ -0,0 +1,285 @@
+# etl_join.py
+"""
+etl_join.py
+
+Cruces "por índice" para enriquecer una tabla ancha con varias tablas de referencia
+por la misma clave (IdCaso en el Atlas). En lugar de encadenar pd.merge, que copia
+todas las columnas de la tabla creciente en cada cruce:
+
+- La clave de la tabla base se factoriza una sola vez (KeyIndex): códigos por fila y
+  valores distintos.
+- Para cada tabla de referencia se ubica la fila que corresponde a cada valor distinto
+  (get_indexer) y sus columnas se agregan con un take vectorizado. Las columnas de la
+  tabla base no se tocan.
+- Si la referencia tiene varias filas por clave (uno a muchos) la tabla base se expande
+  una vez, explícitamente, y el índice se actualiza sin volver a factorizar.
+
+El resultado es el mismo que pd.merge(how='left', on=clave): orden de la tabla base,
+coincidencias múltiples en el orden de la referencia, faltantes como nulos (los enteros
+pasan a float) y sufijos _x/_y si una columna está en ambas tablas.
+
+join_tagged arma en una sola pasada la unión "con coincidencia + sin coincidencia" que el
+Paso 4 construía con un merge interno, un anti-cruce por isin y un concat.
+"""
+import threading
+import time
+import numpy as np
+import pandas as pd
+import psutil
+
+class KeyIndex:
+    """Índice clave -> filas de la tabla base: códigos por fila sobre los valores distintos."""
+
+    def __init__(self, keys):
+        # use_na_sentinel=False: como en pd.merge, una clave nula cruza con las nulas de la referencia
+        self.codes, uniques = pd.factorize(keys, use_na_sentinel=False)
+        self.uniques = pd.Index(uniques)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def positions(self, right_keys):
+        """
+        Agrupa las filas de la referencia por valor distinto de la base. Devuelve
+        (cantidad de coincidencias por valor distinto, inicio de cada grupo, filas de la
+        referencia ordenadas por grupo respetando su orden original).
+        """
+        right_codes = self.uniques.get_indexer(pd.Index(right_keys))
+        matched = np.flatnonzero(right_codes >= 0)
+        right_codes = right_codes[matched]
+        order = matched[np.argsort(right_codes, kind='stable')]
+        counts = np.bincount(right_codes, minlength=len(self.uniques))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]]) if len(counts) else counts
+        return counts, starts, order
+
+def _take(values, indexer):
+    """take con -1 como faltante (promueve el dtype solo si hace falta, igual que merge)."""
+    return pd.api.extensions.take(values.array, indexer, allow_fill=True)
+
+def join_left(df, index, right, key, right_key=None, log=None, label=None):
+    """
+    Equivale a pd.merge(df, right, left_on=key, right_on=right_key, how='left') usando
+    el KeyIndex de df. Si no hay coincidencias múltiples las columnas de 'right' se
+    agregan a df en el lugar; si las hay, df se expande y se devuelve un índice nuevo.
+    Devuelve (df, index).
+    """
+    right_key = right_key or key
+    counts, starts, order = index.positions(right[right_key])
+    # Primera coincidencia de cada valor distinto (-1 si no hay)
+    first = np.where(counts > 0, order[np.minimum(starts, len(order) - 1)], -1) if len(order) else np.full(len(counts), -1)
+    row_counts = counts[index.codes]
+
+    if (row_counts > 1).any():
+        # Uno a muchos: cada fila de la base se repite una vez por coincidencia (mínimo una)
+        reps = np.maximum(row_counts, 1)
+        left_rows = np.repeat(np.arange(len(df)), reps)
+        offsets = np.arange(len(left_rows)) - np.repeat(np.cumsum(reps) - reps, reps)
+        codes = index.codes[left_rows]
+        right_rows = np.where(counts[codes] > 0, order[np.minimum(starts[codes] + offsets, len(order) - 1)], -1)
+        if log is not None:
+            log(f"    [JOIN] {label or right_key}: uno a muchos, {len(df):,} -> {len(left_rows):,} filas")
+        df = df.take(left_rows).reset_index(drop=True)
+        index.codes = codes
+    else:
+        right_rows = first[index.codes]
+
+    right_cols = [c for c in right.columns if c != right_key or right_key != key]
+    overlap = [c for c in right_cols if c in df.columns and c != key]
+    if overlap:
+        df = df.rename(columns={c: f"{c}_x" for c in overlap})
+    for col in right_cols:
+        if col == key:
+            continue
+        df[f"{col}_y" if col in overlap else col] = _take(right[col], right_rows)
+    return df, index
+
+def join_tagged(df, right, key, indicator, labels):
+    """
+    Cruce izquierdo en una pasada, con las filas etiquetadas en la columna 'indicator'.
+    Equivale a
+
+        con = pd.merge(df, right, on=key, how='inner', suffixes=('', '_r'))  # sin las columnas _r
+        sin = df[~df[key].isin(right[key])]
+        pd.concat([con.assign(**{indicator: labels[0]}), sin.assign(**{indicator: labels[1]})], ignore_index=True)
+
+    sin armar las dos ramas: primero las filas con coincidencia, después las demás en el
+    orden de df. El orden de las coincidencias sale de pd.merge sobre las claves solas (no
+    siempre es el de df: depende del camino de cruce que elija pandas), así el resultado es
+    idéntico fila por fila. Las columnas de right que ya están en df se descartan antes del
+    cruce (la base conserva su valor); las nuevas quedan nulas en las filas sin coincidencia.
+    Devuelve (df, filas con coincidencia).
+    """
+    pairs = pd.merge(pd.DataFrame({key: df[key].array, '_izq': np.arange(len(df))}),
+                     pd.DataFrame({key: right[key].array, '_der': np.arange(len(right))}), on=key, how='inner')
+    left_matched, right_matched = pairs['_izq'].to_numpy(), pairs['_der'].to_numpy()
+    unmatched = np.ones(len(df), dtype=bool)
+    unmatched[left_matched] = False
+    unmatched = np.flatnonzero(unmatched)
+
+    left_rows = np.concatenate([left_matched, unmatched])
+    # Con un -1 extra el dtype sale igual que en el concat (que promueve aunque no haya filas
+    # sin coincidencia): enteros a float, bool a object
+    right_rows = np.concatenate([right_matched, np.full(len(unmatched) + 1, -1, dtype=np.intp)])
+    out = df.take(left_rows).reset_index(drop=True)
+    for col in right.columns:
+        if col != key and col not in df.columns:
+            out[col] = _take(right[col], right_rows)[:-1]
+    out[indicator] = labels[1]
+    out.iloc[:len(left_matched), out.columns.get_loc(indicator)] = labels[0]
+    return out, len(left_matched)
+
+def attach(df, index, series, name):
+    """
+    Agrega una columna a partir de una Serie indexada por la clave (p.ej. un groupby por
+    IdCaso), equivalente a mergear series.reset_index() por la clave.
+    """
+    positions = pd.Index(series.index).get_indexer(index.uniques)
+    df[name] = _take(series, positions[index.codes])
+    return df
+
+class phase_monitor:
+    """
+    Mide tiempo y pico de memoria (RSS del proceso, muestreado en un hilo) de una fase.
+    Uso: with phase_monitor("Fases 3-5", log): ...
+    """
+
+    def __init__(self, label, log, interval=0.05):
+        self.label, self.log, self.interval = label, log, interval
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._process.memory_info().rss)
+
+    def __enter__(self):
+        self.start_rss = self.peak = self._process.memory_info().rss
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        end_rss = self._process.memory_info().rss
+        self.peak = max(self.peak, end_rss)
+        self.elapsed = time.time() - self.start_time
+        mb = 1024**2
+        self.log(f"    [MEDICIÓN] {self.label}: {self.elapsed:.2f}s | RSS inicio {self.start_rss / mb:.0f} MB, "
+                 f"pico {self.peak / mb:.0f} MB (+{(self.peak - self.start_rss) / mb:.0f} MB), fin {end_rss / mb:.0f} MB")
+        return False
+
+# --- Control de cardinalidad ---
+
+JOIN_POLICIES = ('warn', 'abort', 'dedupe')
+DEFAULT_JOIN_POLICY = {"policy": "warn", "max_expansion": 1.0, "max_memory_mb": None}
+
+class JoinCardinalityError(ValueError):
+    """Un cruce con política 'abort' superó su límite de filas o memoria."""
+
+def predict_join(left, right, left_on, right_on=None, how='left'):
+    """
+    Filas y memoria que produciría pd.merge(left, right, how=how) a partir de las
+    multiplicidades de la clave en cada lado, sin ejecutar el cruce. 'expansion' compara
+    contra el mismo cruce con claves únicas a la derecha (1.0 = búsqueda pura).
+    """
+    right_on = right_on or left_on
+    left_counts = left[left_on].value_counts(dropna=False)
+    right_counts = right[right_on].value_counts(dropna=False)
+    per_key = right_counts.reindex(left_counts.index)
+    matched = per_key.notna()
+    matched_rows = int((left_counts[matched] * per_key[matched]).sum())
+    unmatched_rows = int(left_counts[~matched].sum())
+    predicted = matched_rows + (unmatched_rows if how == 'left' else 0)
+    baseline = int(left_counts[matched].sum()) + (unmatched_rows if how == 'left' else 0)
+
+    right_payload = [c for c in right.columns if c != right_on or right_on != left_on]
+    left_row_bytes = left.memory_usage(index=False).sum() / max(len(left), 1)
+    right_row_bytes = right[right_payload].memory_usage(index=False).sum() / max(len(right), 1)
+    return {
+        "how": how,
+        "left_rows": len(left), "right_rows": len(right),
+        "duplicate_keys": int((right_counts > 1).sum()),
+        "max_multiplicity": int(right_counts.max()) if len(right_counts) else 0,
+        "predicted_rows": predicted,
+        "predicted_mb": round(float(predicted * (left_row_bytes + right_row_bytes)) / 1024**2, 2),
+        "expansion": round(predicted / baseline, 4) if baseline else 1.0,
+    }
+
+class JoinGuard:
+    """
+    Revisa cada cruce antes de ejecutarlo (predict_join) y aplica la política configurada
+    en la sección "joins" de config.json, por nombre de cruce ("step3.delitos", ...) o
+    "default":
+        {"policy": "warn" | "abort" | "dedupe", "max_expansion": 1.0, "max_memory_mb": null}
+    'dedupe' conserva la primera fila por clave de la tabla derecha. Los límites en null no
+    se controlan. Las predicciones y las filas reales quedan en 'records' para las métricas.
+    """
+
+    def __init__(self, config=None, log=print):
+        config = config or {}
+        self.default = {**DEFAULT_JOIN_POLICY, **config.get('default', {})}
+        self.policies = {k: v for k, v in config.items() if k != 'default'}
+        self.log = log
+        self.records = []
+
+    def policy(self, name):
+        policy = {**self.default, **self.policies.get(name, {})}
+        if policy['policy'] not in JOIN_POLICIES:
+            raise ValueError(f"Política de cruce desconocida para {name}: {policy['policy']} (válidas: {JOIN_POLICIES})")
+        return policy
+
+    def check(self, name, left, right, left_on, right_on=None, how='left'):
+        """Predice el cruce y aplica la política. Devuelve la tabla derecha a usar (deduplicada si corresponde)."""
+        right_on = right_on or left_on
+        policy = self.policy(name)
+        prediction = predict_join(left, right, left_on, right_on, how)
+        limits = []
+        if policy['max_expansion'] is not None and prediction['expansion'] > policy['max_expansion']:
+            limits.append(f"expansión x{prediction['expansion']:.2f} > x{policy['max_expansion']}")
+        if policy['max_memory_mb'] is not None and prediction['predicted_mb'] > policy['max_memory_mb']:
+            limits.append(f"{prediction['predicted_mb']:,.0f} MB > {policy['max_memory_mb']:,} MB")
+
+        action = 'ok'
+        if limits:
+            action = policy['policy']
+            detail = (f"{name}: {prediction['left_rows']:,} x {prediction['right_rows']:,} -> {prediction['predicted_rows']:,} filas "
+                      f"(~{prediction['predicted_mb']:,.0f} MB; {prediction['duplicate_keys']:,} claves repetidas, "
+                      f"máx. {prediction['max_multiplicity']} por clave): {', '.join(limits)}")
+            if action == 'abort':
+                self.records.append({"join": name, **prediction, "action": action, "actual_rows": None})
+                raise JoinCardinalityError(f"Cruce abortado {detail}")
+            if action == 'dedupe':
+                right = right.drop_duplicates(subset=[right_on], keep='first')
+                self.log(f"    [JOIN] ⚠️ {detail}. Se conserva la primera fila por clave.")
+                prediction = {**predict_join(left, right, left_on, right_on, how), "predicted_before_dedupe": prediction['predicted_rows']}
+            else:
+                self.log(f"    [JOIN] ⚠️ {detail}")
+        self.records.append({"join": name, **prediction, "action": action, "actual_rows": None})
+        return right
+
+    def record(self, name, actual_rows):
+        """Registra las filas reales del último cruce 'name'."""
+        for rec in reversed(self.records):
+            if rec['join'] == name:
+                rec['actual_rows'] = int(actual_rows)
+                if rec['actual_rows'] != rec['predicted_rows']:
+                    self.log(f"    [JOIN] {name}: predicción {rec['predicted_rows']:,} filas, reales {actual_rows:,}")
+                return
+
+def combine_join_records(record_lists):
+    """Suma los registros de varios baldes por nombre de cruce (modo fuera de memoria)."""
+    combined = {}
+    for records in record_lists:
+        for rec in records or []:
+            acc = combined.setdefault(rec['join'], {**rec, "predicted_rows": 0, "predicted_mb": 0.0, "actual_rows": 0,
+                                                    "left_rows": 0, "right_rows": 0, "duplicate_keys": 0})
+            for k in ('predicted_rows', 'predicted_mb', 'left_rows', 'right_rows', 'duplicate_keys'):
+                acc[k] += rec[k]
+            acc['actual_rows'] += rec['actual_rows'] or 0
+            acc['max_multiplicity'] = max(acc['max_multiplicity'], rec['max_multiplicity'])
+            acc['expansion'] = max(acc['expansion'], rec['expansion'])
+            if rec['action'] != 'ok':
+                acc['action'] = rec['action']
+    return list(combined.values())
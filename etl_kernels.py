@@ -0,0 +1,267 @@
+# etl_kernels.py
+"""
+etl_kernels.py
+
+Kernels de texto "sobre categorías": en lugar de recorrer millones de filas, la
+operación se aplica una sola vez a los valores distintos de la columna y el resultado
+se reparte por posición con los códigos (take). El costo pasa a depender de la
+cardinalidad (cientos de oficinas, fiscalías o descripciones) y no de la cantidad de filas.
+
+- Si la columna es categórica se usan sus categorías y códigos tal cual, y el resultado
+  sigue siendo categórico.
+- Si no, se factoriza una vez (pd.factorize) y el resultado conserva el dtype que
+  hubiera dado la operación fila a fila.
+
+Los nulos se resuelven con la misma operación: se agrega un valor nulo al final de los
+valores distintos y el código -1 de factorize lo toma por posición.
+
+Al final, reductores por grupo (top1_per_group, group_max, group_nunique) que reemplazan
+cadenas de groupby().transform + filtros + drop_duplicates por un único ordenamiento, y
+group_ids, que numera grupos de varias columnas sin armar un MultiIndex. concat_keys y
+sha256_prefix arman y hashean claves compuestas una vez por combinación distinta.
+"""
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+KEEP = object() # Centinela: en map_values, conservar el valor original si no está en el mapeo
+
+# Formatos que se prueban, en orden, sobre una muestra antes de parsear fechas. Solo formatos
+# sin ambigüedad día/mes: con barras se deja la inferencia de pandas, igual que antes.
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "ISO8601"]
+DATE_SAMPLE_SIZE = 1000
+HASH_MIN_BATCH = 100000 # Claves por lote en sha256_prefix: por debajo no compensa abrir procesos
+
+def _decompose(s):
+    """Devuelve (códigos, valores distintos como Series, es_categórica)."""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.codes.to_numpy(), pd.Series(s.cat.categories), True
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    return codes, pd.Series(uniques, dtype=s.dtype), False
+
+def apply_on_categories(s, func):
+    """
+    Aplica func (una transformación elemento a elemento Series -> Series) sobre los
+    valores distintos de s y reconstruye la columna completa con los códigos.
+    """
+    codes, values, is_categorical = _decompose(s)
+    if (codes == -1).any():
+        # Posición extra para los nulos: el código -1 indexa el último elemento
+        if values.dtype.kind in 'iub': # Enteros/booleanos sin nulos: categorías de una categórica con faltantes
+            values = values.astype(object)
+        values = pd.concat([values, pd.Series([None], dtype=values.dtype)], ignore_index=True)
+    result = func(values)
+    if is_categorical:
+        new_codes, new_categories = pd.factorize(result, use_na_sentinel=True)
+        return pd.Series(pd.Categorical.from_codes(new_codes[codes], categories=new_categories),
+                         index=s.index, name=s.name)
+    return pd.Series(result.array.take(codes), index=s.index, name=s.name)
+
+# --- Kernels ---
+
+def strip_text(s):
+    """Equivale a s.astype(str).str.strip()."""
+    return apply_on_categories(s, lambda v: v.astype(str).str.strip())
+
+def lower_text(s, fill=None):
+    """Equivale a s.fillna(fill).str.lower() (sin fill, los nulos siguen nulos)."""
+    return apply_on_categories(s, lambda v: (v if fill is None else v.fillna(fill)).str.lower())
+
+def fill_text(s, value):
+    """
+    Mismos valores que s.astype(str).fillna(value), pero conserva el tipo de la entrada:
+    con s categórica el resultado sigue siendo categórico (el de pandas sería texto).
+    """
+    return apply_on_categories(s, lambda v: v.astype(str).fillna(value))
+
+def extract_text(s, pattern):
+    """Equivale a s.str.extract(pattern, expand=False) con un único grupo de captura."""
+    return apply_on_categories(s, lambda v: v.str.extract(pattern, expand=False))
+
+def map_values(s, mapping, default=KEEP):
+    """
+    Búsqueda en un diccionario. Los valores ausentes del mapeo conservan el original
+    (default=KEEP) o toman 'default' (None los deja nulos).
+    """
+    def _lookup(v):
+        mapped = v.map(mapping)
+        if default is KEEP:
+            return mapped.where(v.isin(list(mapping)), v)
+        return mapped if default is None else mapped.fillna(default)
+    return apply_on_categories(s, _lookup)
+
+def remap_where(target, key, mapping):
+    """
+    Reasignación condicional entre dos columnas: donde 'key' tiene un valor del mapeo
+    se usa mapping[key]; en el resto se conserva 'target'. La búsqueda corre sobre
+    los valores distintos de 'key'; solo el reemplazo final recorre las filas.
+    """
+    hit = map_values(key, mapping, default=None)
+    if isinstance(target.dtype, pd.CategoricalDtype):
+        # Los valores del mapeo que no son categorías de 'target' se agregan antes del cast,
+        # que de otro modo los convertiría en nulos
+        missing = pd.Index(hit.dropna().unique()).difference(target.cat.categories, sort=False)
+        if len(missing):
+            target = target.cat.add_categories(missing)
+        hit = hit.astype(target.dtype)
+    elif isinstance(hit.dtype, pd.CategoricalDtype):
+        hit = hit.astype(target.dtype)
+    return target.mask(hit.notna(), hit)
+
+# --- Fechas ---
+
+def detect_date_format(values, sample_size=DATE_SAMPLE_SIZE):
+    """Primer formato de DATE_FORMATS que parsea toda la muestra (valores no vacíos), o None."""
+    sample = values.dropna()
+    sample = sample[sample.astype(str).str.strip() != ''].head(sample_size)
+    if sample.empty:
+        return None
+    for fmt in DATE_FORMATS:
+        if pd.to_datetime(sample, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+def parse_dates(s, format=None):
+    """
+    pd.to_datetime(errors='coerce') evaluado una vez por valor distinto: muchas actuaciones
+    comparten fecha, así que se parsean los únicos y el resultado se reparte por código.
+    Sin 'format', se detecta sobre una muestra (detect_date_format). Si la columna ya es
+    fecha nativa no se toca. Devuelve (serie, cantidad de filas no vacías que no parsearon).
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s, 0
+    def _parse(values):
+        fmt = format if format is not None else detect_date_format(values)
+        return pd.to_datetime(values, format=fmt, errors='coerce')
+    parsed = apply_on_categories(s, _parse)
+    failed = int((parsed.isna() & s.notna()).sum())
+    return parsed, failed
+
+# --- Reductores por grupo ---
+
+def _sort_key(values, ascending):
+    """Clave float64 para lexsort (nulos como NaN, que quedan al final en cualquier sentido)."""
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        key = values.to_numpy(dtype='datetime64[ns]').astype('int64').astype('float64')
+        key[values.isna().to_numpy()] = np.nan
+    elif pd.api.types.is_numeric_dtype(values.dtype) and not isinstance(values.dtype, pd.CategoricalDtype):
+        key = values.to_numpy(dtype='float64', na_value=np.nan)
+    else:
+        # Texto o categorías: posición del valor entre los distintos ordenados
+        codes, _ = pd.factorize(values, sort=True, use_na_sentinel=True)
+        key = codes.astype('float64')
+        key[codes == -1] = np.nan
+    return key if ascending else -key
+
+def top1_per_group(keys, by, ascending=True, dropna=True):
+    """
+    Fila "ganadora" de cada grupo según uno o más criterios (p.ej. mayor orden y, entre
+    empatados, menor IdActuacion), con un único lexsort sobre la clave y los criterios:
+    sin transformaciones por grupo ni copias de la tabla ancha. Los empates completos se
+    resuelven por la primera fila, como drop_duplicates.
+
+    Devuelve (códigos de grupo por fila, fila ganadora por grupo). Las filas con clave nula
+    tienen código -1 (como en groupby). Con dropna=True un grupo cuyo ganador tiene algún
+    criterio nulo queda sin ganador (-1): igual que max/min de pandas, que ignoran nulos.
+    """
+    if not isinstance(by, (list, tuple)):
+        by = [by]
+    if not isinstance(ascending, (list, tuple)):
+        ascending = [ascending] * len(by)
+    codes, uniques = pd.factorize(keys, use_na_sentinel=True)
+    sort_keys = [_sort_key(pd.Series(v).reset_index(drop=True), asc) for v, asc in zip(by, ascending)]
+    # lexsort ordena por la última clave primero y es estable (empates en orden de fila)
+    order = np.lexsort(sort_keys[::-1] + [codes])
+    order = order[codes[order] >= 0]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = codes[order[1:]] != codes[order[:-1]]
+    winners = np.full(len(uniques), -1, dtype=np.int64)
+    winners[codes[order[first]]] = order[first]
+    if dropna and len(winners):
+        valid = winners >= 0
+        for key in sort_keys:
+            valid[valid] &= ~np.isnan(key[winners[valid]])
+        winners[~valid] = -1
+    return codes, winners
+
+def group_max(keys, values):
+    """Equivale a values.groupby(keys).transform('max') (grupos con clave nula -> nulo)."""
+    codes, winners = top1_per_group(keys, values, ascending=False)
+    rows = np.where(codes >= 0, winners[codes] if len(winners) else -1, -1)
+    return pd.Series(pd.api.extensions.take(values.array, rows, allow_fill=True), index=values.index, name=values.name)
+
+def _combine_codes(code_arrays, sizes):
+    """Códigos de varias columnas -> número de grupo (-1 si alguna parte es nula) y cantidad."""
+    combined = np.zeros(len(code_arrays[0]), dtype=np.int64)
+    missing = np.zeros(len(combined), dtype=bool)
+    for key_codes, size in zip(code_arrays, sizes):
+        missing |= key_codes == -1
+        # Se recomprime en cada paso: el producto de cardinalidades no llega a desbordar
+        combined, _ = pd.factorize(combined * max(size, 1) + np.maximum(key_codes, 0))
+    codes = np.full(len(combined), -1, dtype=np.int64)
+    codes[~missing], groups = pd.factorize(combined[~missing])
+    return codes, len(groups)
+
+def group_ids(*keys):
+    """
+    Número de grupo por fila para una clave de una o más columnas (como groupby, sin
+    MultiIndex). Devuelve (códigos, cantidad de grupos); las filas con alguna clave nula
+    tienen código -1 y no forman grupo.
+    """
+    factorized = [pd.factorize(key, use_na_sentinel=True) for key in keys]
+    return _combine_codes([c for c, _ in factorized], [len(u) for _, u in factorized])
+
+def group_nunique(codes, n_groups, values, mask=None):
+    """
+    Equivale a values[mask].groupby(grupo).nunique() por grupo (0 si el grupo no tiene filas
+    en la máscara), con los códigos de group_ids. Los nulos no cuentan.
+    """
+    value_codes, _ = pd.factorize(values, use_na_sentinel=True)
+    rows = (codes >= 0) & (value_codes >= 0)
+    if mask is not None:
+        rows &= np.asarray(mask, dtype=bool)
+    pairs = np.unique(np.stack([codes[rows], value_codes[rows]]), axis=1)
+    return np.bincount(pairs[0], minlength=n_groups)
+
+def concat_keys(columns, sep='_'):
+    """
+    Equivale a columns[0].astype(str) + sep + columns[1].astype(str) + ... (nulo si alguna
+    parte es nula), armado una sola vez por combinación distinta. Devuelve (códigos por fila,
+    claves distintas como Serie de texto); las filas con alguna parte nula tienen código -1.
+    """
+    decomposed = [_decompose(col) for col in columns]
+    codes, n_groups = _combine_codes([c for c, _, _ in decomposed], [len(v) for _, v, _ in decomposed])
+    # Fila representativa de cada combinación (la primera), en orden de código
+    valid = np.flatnonzero(codes >= 0)
+    _, first = np.unique(codes[valid], return_index=True)
+    first = valid[first]
+    keys = None
+    for part_codes, values, _ in decomposed:
+        text = values.astype(str).reset_index(drop=True).take(part_codes[first]).reset_index(drop=True)
+        keys = text if keys is None else keys + sep + text
+    if keys is None or n_groups == 0:
+        keys = pd.Series([], dtype=str)
+    return codes, keys
+
+def _sha256_prefix(values, length):
+    return [hashlib.sha256(v.encode()).hexdigest()[:length] for v in values]
+
+def sha256_prefix(keys, length=16, workers=1, min_batch=HASH_MIN_BATCH):
+    """
+    Primeros 'length' caracteres hex del SHA-256 de cada clave (texto sin nulos). Con
+    workers > 1 y suficientes claves, se reparte en lotes entre procesos.
+    """
+    values = keys.tolist()
+    if workers > 1 and len(values) >= 2 * min_batch:
+        size = max(min_batch, -(-len(values) // workers))
+        batches = [values[i:i + size] for i in range(0, len(values), size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            hashed = [h for batch in pool.map(_sha256_prefix, batches, [length] * len(batches)) for h in batch]
+    else:
+        hashed = _sha256_prefix(values, length)
+    return pd.Series(hashed, index=keys.index, dtype=str)
+
+def take_values(values, codes, index=None):
+    """values (Serie de distintos) repartidos por fila según codes; -1 -> nulo."""
+    return pd.Series(pd.api.extensions.take(values.array, codes, allow_fill=True), index=index)
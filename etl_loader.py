@@ -0,0 +1,180 @@
+# etl_loader.py
+"""
+etl_loader.py
+
+Cargador Parquet compartido por los pasos del pipeline. Recibe la lista de columnas
+y los filtros de filas que el paso necesita y los empuja al escáner de datasets de
+Arrow: solo se decodifican esas columnas, las particiones Hive que no cumplen el
+filtro no se abren y los row groups se descartan por estadísticas (min/max).
+
+Los filtros aceptan la forma de pd.read_parquet ([(col, op, valor), ...]) o una
+expresión de pyarrow.compute (necesaria, p.ej., para conservar nulos con is_null()).
+
+ConcurrentLoads lanza las cargas independientes de un paso en paralelo (hilos).
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DEFAULT_LOAD_WORKERS = 8
+
+def _to_expression(filters):
+    if filters is None:
+        return None
+    if isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+def _dataset(path):
+    if os.path.isdir(path):
+        return ds.dataset(path, format='parquet', partitioning='hive')
+    return ds.dataset(path, format='parquet')
+
+def _bytes_on_disk(dataset):
+    return sum(os.path.getsize(f) for f in dataset.files)
+
+def _bytes_to_read(dataset, columns, expression):
+    """
+    Estimación de los bytes comprimidos que realmente se leen: suma de los column chunks
+    proyectados en los row groups que sobreviven a la poda por partición y estadísticas.
+    """
+    wanted = set(columns) if columns is not None else None
+    total = 0
+    for fragment in dataset.get_fragments(filter=expression):
+        metadata = fragment.metadata
+        pieces = fragment.split_by_row_group(expression, schema=dataset.schema) if expression is not None else [fragment]
+        for piece in pieces:
+            for rg_info in piece.row_groups:
+                rg = metadata.row_group(rg_info.id)
+                for i in range(rg.num_columns):
+                    col = rg.column(i)
+                    if wanted is None or col.path_in_schema.split('.')[0] in wanted:
+                        total += col.total_compressed_size
+    return total
+
+def _pandas_layout(dataset):
+    """Orden original de columnas y columnas categóricas según los metadatos pandas del archivo."""
+    meta = dataset.schema.pandas_metadata or {}
+    cols = meta.get('columns', [])
+    order = [c['name'] for c in cols if c.get('name') is not None]
+    categorical = {c['name'] for c in cols if c.get('pandas_type') == 'categorical'}
+    return order, categorical
+
+def load_parquet(path, columns=None, filters=None, log=print, partition_columns=False):
+    """
+    Lee un Parquet (archivo o dataset particionado) aplicando proyección y filtros en origen.
+    Las columnas pedidas que no existen se ignoran (se informa en el log). Las columnas de
+    partición Hive solo se devuelven si se piden explícitamente o con partition_columns=True;
+    en ese caso recuperan el orden y el tipo categórico que tenían al escribirse.
+    """
+    dataset = _dataset(path)
+    expression = _to_expression(filters)
+    available = dataset.schema.names
+    partition_cols = set(dataset.partitioning.schema.names) if dataset.partitioning is not None else set()
+
+    if columns is None:
+        read_columns = [c for c in available if partition_columns or c not in partition_cols]
+        order, _ = _pandas_layout(dataset)
+        if partition_cols & set(read_columns) and order:
+            rank = {c: i for i, c in enumerate(order)}
+            read_columns.sort(key=lambda c: rank.get(c, len(rank)))
+    else:
+        read_columns = [c for c in columns if c in available]
+        missing = [c for c in columns if c not in available]
+        if missing:
+            log(f"    [LOAD] {os.path.basename(path)}: columnas no presentes (se omiten): {missing}")
+
+    disk_bytes = _bytes_on_disk(dataset)
+    read_bytes = _bytes_to_read(dataset, read_columns, expression)
+    table = dataset.to_table(columns=read_columns, filter=expression)
+    pct = (read_bytes / disk_bytes * 100) if disk_bytes else 0
+    log(f"    [LOAD] {os.path.basename(path)}: {len(read_columns)}/{len(available)} columnas, "
+        f"{table.num_rows:,} filas | leído {read_bytes / 1024**2:.1f} MB de {disk_bytes / 1024**2:.1f} MB en disco ({pct:.0f}%)")
+    df = table.to_pandas()
+    _, categorical = _pandas_layout(dataset)
+    for col in partition_cols & categorical & set(df.columns):
+        df[col] = df[col].astype('category')
+    return df
+
+def scan_parquet(path, columns=None, filters=None, batch_size=131072):
+    """
+    Devuelve un pyarrow Scanner con la misma proyección y filtros que load_parquet, para
+    recorrer el archivo por lotes (to_batches) sin materializar la tabla completa.
+    Sin 'columns' no incluye las columnas de partición Hive.
+    """
+    dataset = _dataset(path)
+    partition_cols = set(dataset.partitioning.schema.names) if dataset.partitioning is not None else set()
+    available = dataset.schema.names
+    if columns is None:
+        read_columns = [c for c in available if c not in partition_cols]
+    else:
+        read_columns = [c for c in columns if c in available]
+    return dataset.scanner(columns=read_columns, filter=_to_expression(filters), batch_size=batch_size)
+
+# --- Cargas concurrentes ---
+
+class PendingLoad:
+    """Resultado diferido de ConcurrentLoads: se espera recién en ready()."""
+
+    def __init__(self, loads, name):
+        self.loads, self.name = loads, name
+
+    def result(self):
+        return self.loads.get(self.name)
+
+def ready(value):
+    """Devuelve el valor de una carga, esperándola si todavía está pendiente."""
+    return value.result() if isinstance(value, PendingLoad) else value
+
+class ConcurrentLoads:
+    """
+    Lanza cargas independientes a la vez en un pool de hilos (Arrow y la lectura de disco
+    liberan el GIL) y espera cada una recién cuando se la pide con get(). Registra por
+    insumo la duración de la carga, el tiempo que el paso quedó esperándola y las filas.
+
+        with ConcurrentLoads(log=log_message) as loads:
+            loads.submit('df_delitos.parquet', safe_load, path)
+            ...
+            df_delitos = loads.get('df_delitos.parquet')
+    """
+
+    def __init__(self, max_workers=None, log=print):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers or DEFAULT_LOAD_WORKERS, thread_name_prefix='carga')
+        self.log = log
+        self.futures = {}
+        self.stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+    def submit(self, name, func, *args, **kwargs):
+        def timed():
+            start = time.time()
+            result = func(*args, **kwargs)
+            self.stats.setdefault(name, {})['seconds'] = round(time.time() - start, 3)
+            return result
+        self.futures[name] = self.pool.submit(timed)
+        return PendingLoad(self, name)
+
+    def get(self, name):
+        """Resultado de la carga 'name' (las excepciones de la carga se propagan acá)."""
+        start = time.time()
+        result = self.futures[name].result()
+        stats = self.stats.setdefault(name, {})
+        stats['waited'] = round(stats.get('waited', 0) + time.time() - start, 3)
+        if hasattr(result, 'shape'): # DataFrame (las cargas que devuelven None o dicts no llevan filas)
+            stats['rows'] = int(result.shape[0])
+        return result
+
+    def timings(self):
+        """Desglose por insumo para las métricas del paso: {nombre: {seconds, waited, rows}}."""
+        return {name: dict(self.stats.get(name, {})) for name in self.futures}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,124 @@
+# etl_nested.py
+"""
+etl_nested.py
+
+Salida anidada del Paso 4. En la forma plana, cada fila de actuación 'con_persona' se
+repite una vez por persona × delito con todas las columnas del Atlas. En la forma anidada
+queda una fila por actuación y los datos de personas van en una columna lista de structs
+(IdActuacionPersonaDelito, IdPersona, IdDelito, rol, género). Las filas 'sin_persona'
+llevan la lista nula.
+
+nest_frame() arma la tabla anidada a partir del DataFrame plano: agrupa filas consecutivas
+iguales en las columnas de actuación, así que explode_table() devuelve exactamente las
+mismas filas, en el mismo orden y con los mismos tipos. Los metadatos del esquema guardan
+la columna lista y el orden de columnas de la forma plana.
+
+read_flat() lee cualquiera de las dos formas y devuelve siempre la plana. Con 'columns' solo
+se expanden las columnas pedidas; la repetición de filas se hace con un take de Arrow.
+
+Configuración (sección "actuaciones" de config.json):
+    {"nested": false}
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from etl_loader import load_parquet, scan_parquet
+
+NESTED_METADATA_KEY = b'etl_nested'
+DEFAULT_LIST_COLUMN = 'personas'
+
+def nested_enabled(config):
+    return bool((config or {}).get('actuaciones', {}).get('nested', False))
+
+def _boundaries(df, row_columns, item_columns):
+    """Inicio de cada grupo: cambia alguna columna de actuación o la fila no tiene ítem."""
+    n = len(df)
+    starts = np.zeros(n, dtype=bool)
+    if n == 0:
+        return starts, np.zeros(0, dtype=bool)
+    starts[0] = True
+    for col in row_columns:
+        codes, _ = pd.factorize(df[col], use_na_sentinel=True) # Nulo == nulo: mismo código -1
+        starts[1:] |= codes[1:] != codes[:-1]
+    empty = df[item_columns].isna().all(axis=1).to_numpy()
+    # Una fila sin ítem es un grupo de una fila (lista nula) y corta el grupo siguiente
+    starts |= empty
+    starts[1:] |= empty[:-1]
+    return starts, empty
+
+def nest_frame(df, item_columns, list_column=DEFAULT_LIST_COLUMN):
+    """
+    Tabla Arrow anidada a partir del DataFrame plano. Las columnas de actuación mantienen su
+    tipo (categóricas incluidas) y quedan en su orden; la columna lista va al final.
+    """
+    item_columns = [c for c in df.columns if c in set(item_columns)]
+    row_columns = [c for c in df.columns if c not in set(item_columns)]
+    starts, empty = _boundaries(df, row_columns, item_columns)
+    first = np.flatnonzero(starts)
+    group = np.cumsum(starts) - 1
+    # Los ítems de las filas sin persona no se guardan: esos grupos quedan con largo 0 y lista nula
+    lengths = np.bincount(group[~empty], minlength=len(first))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    items = pa.Table.from_pandas(df.loc[~empty, item_columns], preserve_index=False)
+    values = pa.StructArray.from_arrays([items.column(c).combine_chunks() for c in item_columns], names=item_columns)
+    lists = pa.ListArray.from_arrays(pa.array(offsets), values, mask=pa.array(empty[first]))
+    rows = pa.Table.from_pandas(df[row_columns].iloc[first], preserve_index=False)
+    table = rows.append_column(list_column, lists)
+    layout = {"list_column": list_column, "items": item_columns, "columns": list(df.columns)}
+    metadata = {**(table.schema.metadata or {}), NESTED_METADATA_KEY: json.dumps(layout, ensure_ascii=False).encode('utf-8')}
+    return table.replace_schema_metadata(metadata)
+
+def nested_layout(schema):
+    """Layout anidado guardado en el esquema (None si el archivo es plano)."""
+    raw = (schema.metadata or {}).get(NESTED_METADATA_KEY)
+    return json.loads(raw.decode('utf-8')) if raw else None
+
+def nested_metadata(schema):
+    """Metadatos a conservar al concatenar baldes anidados."""
+    return {NESTED_METADATA_KEY: schema.metadata[NESTED_METADATA_KEY]}
+
+def explode_table(table, layout, columns=None):
+    """
+    Forma plana de una tabla anidada como DataFrame: cada actuación se repite una vez por
+    ítem (una vez si la lista es nula). Sin 'columns' devuelve todas las columnas planas.
+    """
+    list_column = layout['list_column']
+    wanted = [c for c in layout['columns'] if columns is None or c in columns]
+    lists = table.column(list_column).combine_chunks()
+    offsets = lists.offsets.to_numpy(zero_copy_only=False).astype(np.int64)
+    lengths = np.diff(offsets)
+    repeats = np.maximum(lengths, 1)
+    row_idx = np.repeat(np.arange(len(lengths)), repeats)
+    within = np.arange(len(row_idx)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    item_idx = np.repeat(offsets[:-1], repeats) + within
+    no_item = np.repeat(lengths == 0, repeats)
+    item_take = pa.array(item_idx, mask=no_item)
+    values = lists.values
+    out = {}
+    for col in wanted:
+        if col in layout['items']:
+            out[col] = values.field(col).take(item_take)
+        else:
+            out[col] = table.column(col).take(row_idx)
+    return pa.table(out).to_pandas() if out else pd.DataFrame(index=range(len(row_idx)))
+
+def read_flat(path, columns=None, filters=None, log=print):
+    """
+    load_parquet que devuelve siempre la forma plana: los archivos anidados se expanden
+    (solo las columnas pedidas). Los filtros valen para las columnas de actuación.
+    """
+    layout = nested_layout(pq.read_schema(path)) if os.path.isfile(path) else None
+    if layout is None:
+        return load_parquet(path, columns=columns, filters=filters, log=log)
+    read_columns = None
+    if columns is not None:
+        read_columns = [c for c in columns if c not in layout['items']] + [layout['list_column']]
+    # La lista se expande en Arrow: pasarla por pandas la convertiría en objetos fila por fila
+    table = scan_parquet(path, columns=read_columns, filters=filters).to_table()
+    flat = explode_table(table, layout, columns)
+    log(f"    [ANIDADO] {os.path.basename(path)}: {table.num_rows:,} actuaciones -> {len(flat):,} filas planas "
+        f"({len(flat.columns)} columnas)")
+    return flat
@@ -0,0 +1,134 @@
+# etl_personas.py
+"""
+etl_personas.py
+
+Tablas derivadas de df_persona_actuacion_delito.parquet, calculadas una sola vez después
+del Paso 1 para que los pasos siguientes no vuelvan a leer el archivo completo:
+
+- imputados_por_caso.parquet: IdCaso -> imputados (IdPersona distintos). Es lo único que
+  el Paso 3 necesita de personas.
+- actuaciones_con_persona.parquet: IdActuacion distintos que tienen alguna persona.
+- personas_por_actuacion.parquet: la tabla de personas completa ordenada por IdActuacion
+  (orden estable), en row groups chicos. El Paso 4 lee solo las filas de sus actuaciones:
+  con el orden, el filtro descarta casi todos los row groups por estadísticas.
+
+Van en la carpeta '_personas' dentro de 'intermediate_loaded', con _fuente.json (tamaño,
+mtime y SHA-256 del archivo de personas). Se vuelven a derivar solo si el archivo cambió,
+con el mismo criterio que el manifiesto del Paso 1.
+"""
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from etl_loader import load_parquet
+from etl_refcache import file_sha256
+
+PERSONAS_FILE = 'df_persona_actuacion_delito.parquet'
+DERIVED_DIRNAME = '_personas'
+DERIVED_TABLES = {
+    "imputados": 'imputados_por_caso.parquet',
+    "actuaciones": 'actuaciones_con_persona.parquet',
+    "indice": 'personas_por_actuacion.parquet',
+}
+META_FILE = '_fuente.json'
+INDEX_ROW_GROUP_SIZE = 50000
+
+def derived_paths(loaded_dir):
+    folder = os.path.join(loaded_dir, DERIVED_DIRNAME)
+    return {name: os.path.join(folder, filename) for name, filename in DERIVED_TABLES.items()}
+
+def imputados_por_caso(df_personas):
+    """IdPersona distintos por IdCaso, como DataFrame (IdCaso, imputados)."""
+    return df_personas.groupby('IdCaso')['IdPersona'].nunique().rename('imputados').reset_index()
+
+def _read_meta(meta_path):
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def _write_meta(meta_path, meta):
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+def _is_fresh(meta, source_path, meta_path, paths):
+    """True si las tablas corresponden al archivo de personas actual (actualiza el mtime si solo cambió la fecha)."""
+    st = os.stat(source_path)
+    if meta is None or meta.get('size') != st.st_size:
+        return False
+    if not all(os.path.exists(p) for p in paths.values()):
+        return False
+    if meta.get('mtime') == st.st_mtime:
+        return True
+    # Mismo tamaño pero otra fecha (Paso 1 reconvirtió el mismo contenido): decide el hash
+    if file_sha256(source_path) != meta.get('sha256'):
+        return False
+    meta['mtime'] = st.st_mtime
+    _write_meta(meta_path, meta)
+    return True
+
+def _write_table(table, path, **kwargs):
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, **kwargs)
+    os.replace(tmp_path, path)
+
+def derive_personas_tables(loaded_dir, force=False, log=print):
+    """
+    Devuelve {tabla: ruta} con las tablas derivadas vigentes, derivándolas si faltan o si el
+    archivo de personas cambió. None si no hay archivo de personas.
+    """
+    source = os.path.join(loaded_dir, PERSONAS_FILE)
+    if not os.path.exists(source):
+        return None
+    paths = derived_paths(loaded_dir)
+    meta_path = os.path.join(loaded_dir, DERIVED_DIRNAME, META_FILE)
+    if not force and _is_fresh(_read_meta(meta_path), source, meta_path, paths):
+        return paths
+
+    t0 = time.time()
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path) # Sin _fuente.json las tablas no se usan hasta terminar de escribirlas
+    table = pq.read_table(source)
+    _write_table(table.sort_by([('IdActuacion', 'ascending')]), paths['indice'], row_group_size=INDEX_ROW_GROUP_SIZE)
+    actuaciones = pc.unique(table.column('IdActuacion'))
+    _write_table(pa.table({'IdActuacion': actuaciones.take(pc.sort_indices(actuaciones))}), paths['actuaciones'])
+    df_imputados = imputados_por_caso(table.select(['IdCaso', 'IdPersona']).to_pandas())
+    df_imputados.to_parquet(paths['imputados'] + '.tmp', index=False, engine='pyarrow')
+    os.replace(paths['imputados'] + '.tmp', paths['imputados'])
+
+    st = os.stat(source)
+    _write_meta(meta_path, {"source": source, "size": st.st_size, "mtime": st.st_mtime, "sha256": file_sha256(source),
+                            "rows": table.num_rows, "actuaciones": len(actuaciones), "casos": len(df_imputados),
+                            "created": time.strftime("%Y-%m-%d %H:%M:%S")})
+    log(f"    [PERSONAS] Tablas derivadas de {PERSONAS_FILE}: {table.num_rows:,} filas, {len(actuaciones):,} actuaciones "
+        f"con persona, {len(df_imputados):,} casos ({time.time() - t0:.2f}s)")
+    return paths
+
+def load_personas_for(paths, actuaciones, log=print):
+    """
+    Filas de personas de las actuaciones dadas (Serie de IdActuacion), leídas del índice
+    ordenado. Devuelve lo mismo que filtrar la tabla completa: sirve para el cruce interno y
+    para el anti-cruce (sin_persona) sobre esas actuaciones.
+    """
+    con_persona = pd.Index(pq.read_table(paths['actuaciones']).column('IdActuacion').to_pandas())
+    wanted = pd.Index(actuaciones.dropna().unique())
+    wanted = wanted[wanted.isin(con_persona)]
+    key_type = pq.read_schema(paths['indice']).field('IdActuacion').type
+    field = pc.field('IdActuacion')
+    expression = field.isin(pa.array(np.asarray(wanted)).cast(key_type))
+    if len(wanted):
+        # El rango permite descartar row groups por min/max; isin deja solo las actuaciones pedidas
+        expression = expression & (field >= pa.scalar(wanted.min()).cast(key_type)) & (field <= pa.scalar(wanted.max()).cast(key_type))
+    if actuaciones.hasnans:
+        expression = expression | field.is_null() # pd.merge cruza nulos con nulos
+    return load_parquet(paths['indice'], filters=expression, log=log)
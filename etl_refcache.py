@@ -0,0 +1,125 @@
+# etl_refcache.py
+"""
+etl_refcache.py
+
+Caché Parquet de tablas de referencia en Excel (libro UNISA).
+Leer un .xlsx con openpyxl tarda segundos por hoja; el contenido casi nunca cambia.
+
+La primera vez se leen todas las hojas del libro (una sola apertura) y cada una se guarda
+como <libro>__<hoja>.parquet en la carpeta de caché, junto a <libro>.refcache.json con
+tamaño, mtime y SHA-256 del libro. Las corridas siguientes leen los Parquet. El caché se
+reconstruye si cambia el tamaño o, con otro mtime, el contenido (hash), igual que el
+manifiesto del Paso 1. Las hojas que no se pueden guardar en Parquet quedan anotadas
+('uncached') y se leen del Excel, solas, en cada corrida.
+"""
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+
+HASH_CHUNK = 8 * 1024 * 1024
+INVALID_FILENAME_CHARS = '<>:"/\\|?*'
+META_SUFFIX = '.refcache.json'
+
+def file_sha256(path):
+    """Hash SHA-256 del contenido, leído por bloques para no cargar el archivo en memoria."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _stem(workbook_path):
+    return os.path.splitext(os.path.basename(workbook_path))[0]
+
+def _sheet_path(cache_dir, workbook_path, sheet_name):
+    safe = ''.join('_' if c in INVALID_FILENAME_CHARS else c for c in str(sheet_name)).strip()
+    return os.path.join(cache_dir, f"{_stem(workbook_path)}__{safe}.parquet")
+
+def _meta_path(cache_dir, workbook_path):
+    return os.path.join(cache_dir, _stem(workbook_path) + META_SUFFIX)
+
+def _read_meta(meta_path):
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def _write_meta(meta_path, meta):
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+def _is_fresh(meta, workbook_path, meta_path):
+    """True si el caché corresponde al libro actual (actualiza el mtime si solo cambió la fecha)."""
+    st = os.stat(workbook_path)
+    if meta is None or meta.get('size') != st.st_size:
+        return False
+    if not all(os.path.exists(p) for p in meta.get('sheets', {}).values()):
+        return False
+    if meta.get('mtime') == st.st_mtime:
+        return True
+    # Mismo tamaño pero otra fecha (copia/touch): decide el contenido
+    if file_sha256(workbook_path) != meta.get('sha256'):
+        return False
+    meta['mtime'] = st.st_mtime
+    _write_meta(meta_path, meta)
+    return True
+
+def read_workbook(workbook_path, sheets=None):
+    """Lee las hojas pedidas (todas con sheets=None) abriendo el libro una sola vez."""
+    with pd.ExcelFile(workbook_path) as xls:
+        names = xls.sheet_names if sheets is None else sheets
+        return {name: pd.read_excel(xls, sheet_name=name) for name in names}
+
+def load_reference_sheets(workbook_path, sheets=None, cache_dir=None, log=print):
+    """
+    Devuelve {hoja: DataFrame} para las hojas pedidas (todas con sheets=None), desde el
+    caché si está vigente. Sin cache_dir lee el Excel directamente. Si una hoja no se
+    puede guardar en Parquet (p.ej. columnas con tipos mezclados) se usa el Excel y se avisa.
+    """
+    name = os.path.basename(workbook_path)
+    if cache_dir is None:
+        return read_workbook(workbook_path, sheets)
+
+    meta_path = _meta_path(cache_dir, workbook_path)
+    meta = _read_meta(meta_path)
+    if _is_fresh(meta, workbook_path, meta_path):
+        uncached = meta.get('uncached', [])
+        wanted = [s for s in meta.get('sheet_names', list(meta['sheets']) + uncached) if sheets is None or s in sheets]
+        if sheets is None or all(s in wanted for s in sheets):
+            t0 = time.time()
+            from_excel = [s for s in wanted if s in uncached]
+            excel_frames = read_workbook(workbook_path, from_excel) if from_excel else {}
+            frames = {s: excel_frames[s] if s in excel_frames else pd.read_parquet(meta['sheets'][s])
+                      for s in (wanted if sheets is None else sheets)}
+            detail = f", {len(from_excel)} del Excel" if from_excel else ""
+            log(f"    [CACHE] {name}: {len(frames) - len(from_excel)} hojas desde caché{detail} ({time.time() - t0:.2f}s)")
+            return frames
+
+    t0 = time.time()
+    frames = read_workbook(workbook_path) # Todas las hojas: las que no se pidieron hoy quedan cacheadas
+    elapsed = time.time() - t0
+    os.makedirs(cache_dir, exist_ok=True)
+    st = os.stat(workbook_path)
+    new_meta = {"workbook": workbook_path, "size": st.st_size, "mtime": st.st_mtime,
+                "sha256": file_sha256(workbook_path), "sheet_names": list(frames), "sheets": {}, "uncached": [],
+                "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    for sheet_name, df in frames.items():
+        sheet_path = _sheet_path(cache_dir, workbook_path, sheet_name)
+        try:
+            df.to_parquet(sheet_path, index=False, engine='pyarrow')
+            new_meta['sheets'][sheet_name] = sheet_path
+        except Exception as e:
+            new_meta['uncached'].append(sheet_name)
+            log(f"    [CACHE] {name} / {sheet_name}: no se puede cachear ({e}); se leerá del Excel")
+    _write_meta(meta_path, new_meta)
+    log(f"    [CACHE] {name}: leído del Excel ({elapsed:.2f}s), {len(new_meta['sheets'])}/{len(frames)} hojas cacheadas")
+    if sheets is None:
+        return frames
+    return {s: frames[s] for s in sheets}
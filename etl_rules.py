@@ -0,0 +1,151 @@
+# etl_rules.py
+"""
+etl_rules.py
+
+Reglas de clasificación versionadas (carpeta 'rules/'), fuera del código de los pasos:
+
+- estados_informe: descripcionactuacion -> EstadoInforme (Paso 4).
+- orden_resoluciones: EstadoInforme -> orden_jerarquia (Paso 5).
+- exclusiones_audiencia: palabra clave y frases que descartan una audiencia (Paso 3).
+
+Formato de un archivo:
+    {
+      "name": "estados_informe", "version": 1,
+      "kind": "groups",              # groups: salida -> [valores]; mapping: valor -> salida;
+                                     # phrases: keyword + lista de frases
+      "columns": ["EstadoInforme"],  # columnas de salida que dependen de estas reglas
+      "default": "Otros Estados",    # salida para valores sin regla (y nulos)
+      "rules": {...}
+    }
+
+compile_rules() arma una sola vez el índice de valores y el arreglo de salidas; classify()
+resuelve cada valor distinto con un get_indexer y reparte el resultado por los códigos de la
+columna (apply_on_categories), sin recorrer filas en Python.
+
+Cada Parquet de salida lleva en sus metadatos la huella de las reglas usadas
+("nombre@vN:hash"); changed_rules() compara contra el archivo anterior y dice qué reglas
+cambiaron y qué columnas quedan desactualizadas.
+"""
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from etl_kernels import apply_on_categories
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+RULES_METADATA_KEY = b'etl_rules'
+RULE_KINDS = ('groups', 'mapping', 'phrases')
+
+def load_rules(name):
+    """Reglas declaradas en rules/<name>.json (FileNotFoundError si no existen)."""
+    path = os.path.join(RULES_DIR, f"{name}.json")
+    with open(path, 'r', encoding='utf-8') as f:
+        rules = json.load(f)
+    if rules.get('kind') not in RULE_KINDS:
+        raise ValueError(f"{path}: tipo de reglas desconocido {rules.get('kind')!r} (válidos: {RULE_KINDS})")
+    return rules
+
+def rules_fingerprint(rules):
+    """Huella de un juego de reglas: versión declarada más hash del contenido."""
+    payload = json.dumps(rules, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return f"{rules.get('name')}@v{rules.get('version', 1)}:{hashlib.sha256(payload).hexdigest()[:12]}"
+
+class CompiledRules:
+    """Reglas 'groups' o 'mapping' compiladas: índice de valores -> posición en el arreglo de salidas."""
+
+    def __init__(self, rules):
+        if rules['kind'] not in ('groups', 'mapping'):
+            raise ValueError(f"{rules.get('name')}: las reglas '{rules['kind']}' no se compilan como búsqueda")
+        self.name = rules['name']
+        self.version = rules.get('version', 1)
+        self.fingerprint = rules_fingerprint(rules)
+        self.columns = list(rules.get('columns', []))
+        self.default = rules.get('default')
+        mapping = {}
+        if rules['kind'] == 'groups':
+            for output, values in rules['rules'].items():
+                for value in values:
+                    mapping[value] = output # Un valor repetido en dos grupos: gana el último, como con el dict anterior
+        else:
+            mapping = dict(rules['rules'])
+        self.index = pd.Index(list(mapping), dtype=object)
+        outputs = list(mapping.values())
+        if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in outputs + [self.default]):
+            self.outputs = np.array(outputs + [self.default], dtype='int64')
+        else:
+            self.outputs = np.array(outputs + [self.default], dtype=object)
+        self.numeric = self.outputs.dtype.kind == 'i'
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, values):
+        """Salida para cada valor distinto (Series); sin regla o nulo -> default."""
+        positions = self.index.get_indexer(pd.Index(values, dtype=object))
+        return pd.Series(self.outputs[positions], index=values.index) # -1 indexa el default, al final
+
+    def classify(self, s):
+        """
+        Clasifica una columna: búsqueda sobre los valores distintos y reparto por códigos.
+        Con salida de texto y columna categórica el resultado es categórico; con salida
+        numérica es int64.
+        """
+        result = apply_on_categories(s, self.lookup)
+        if self.numeric and result.dtype != 'int64':
+            result = result.astype('int64')
+        return result
+
+@functools.lru_cache(maxsize=None)
+def compile_rules(name):
+    """Carga y compila rules/<name>.json una vez por proceso."""
+    return CompiledRules(load_rules(name))
+
+# --- Versiones en los archivos de salida ---
+
+def _identity(ruleset):
+    """(nombre, huella, columnas) de un juego de reglas, compilado (CompiledRules) o no (dict)."""
+    if isinstance(ruleset, CompiledRules):
+        return ruleset.name, ruleset.fingerprint, ruleset.columns
+    return ruleset['name'], rules_fingerprint(ruleset), list(ruleset.get('columns', []))
+
+def rule_versions(*rulesets):
+    """{nombre: huella} de los juegos de reglas dados."""
+    return {name: fingerprint for name, fingerprint, _ in map(_identity, rulesets)}
+
+def rules_metadata(*rulesets):
+    """Metadatos Parquet con la huella de cada juego de reglas."""
+    return {RULES_METADATA_KEY: json.dumps(rule_versions(*rulesets), ensure_ascii=False).encode('utf-8')}
+
+def write_parquet(df, path, *rulesets):
+    """df.to_parquet(path, index=False) registrando las reglas usadas en los metadatos."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **rules_metadata(*rulesets)})
+    pq.write_table(table, path)
+
+def read_rule_versions(path):
+    """{nombre: huella} registrado en un Parquet de salida ({} si no tiene o no existe)."""
+    if not os.path.isfile(path):
+        return {}
+    raw = (pq.read_schema(path).metadata or {}).get(RULES_METADATA_KEY)
+    return json.loads(raw.decode('utf-8')) if raw else {}
+
+def changed_rules(path, *rulesets):
+    """
+    Reglas que cambiaron respecto de las registradas en 'path':
+    [(nombre, huella anterior o None, huella actual, columnas afectadas)]. Vacío si el archivo
+    no existe (primera corrida: no hay nada que comparar).
+    """
+    if not os.path.isfile(path):
+        return []
+    previous = read_rule_versions(path)
+    return [(name, previous.get(name), fingerprint, columns)
+            for name, fingerprint, columns in map(_identity, rulesets) if previous.get(name) != fingerprint]
+
+def log_rule_changes(path, *rulesets, log=print):
+    """Avisa qué reglas cambiaron desde la última salida y qué columnas se recalculan."""
+    for name, before, after, columns in changed_rules(path, *rulesets):
+        log(f"    [REGLAS] {name}: {before or 'sin registro'} -> {after} (recalcula {', '.join(columns) or '-'})")
@@ -0,0 +1,205 @@
+# etl_schema.py
+"""
+etl_schema.py
+
+Registro de esquemas declarados para los insumos conocidos (carpeta 'schemas/').
+Cada archivo JSON fija nombres canónicos de columnas, anchos enteros, fechas con
+formato explícito y codificación categórica. El Paso 1 los aplica una sola vez al
+convertir, así los pasos siguientes leen tipos nativos sin volver a parsear.
+
+Formato de un esquema:
+    {
+      "name": "CasosActuacionesAcusatorio", "version": 1,
+      "rename": {"idcaso": "IdCaso", ...},            # nombre crudo -> canónico
+      "columns": {                                    # siempre por nombre canónico
+        "IdCaso": "int32",
+        "FechaIngreso": {"type": "timestamp", "format": "%Y-%m-%d %H:%M:%S.%f"},
+        "estadocaso": "category"
+      }
+    }
+Tipos admitidos: int8/int16/int32/int64, float32/float64, string, category, timestamp.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from etl_kernels import parse_dates
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+
+INT_TYPES = {'int8', 'int16', 'int32', 'int64'}
+FLOAT_TYPES = {'float32', 'float64'}
+TIMESTAMP_UNIT = 'us' # El de las fechas que arma pandas: los dos modos del Paso 1 escriben el mismo esquema
+
+class IntRangeError(ValueError):
+    """Un lote Arrow tiene valores fuera del ancho entero declarado para 'column'."""
+
+    def __init__(self, column, kind):
+        super().__init__(f"{column}: valores fuera del rango de {kind}")
+        self.column = column
+
+def load_schema(name):
+    """Devuelve el esquema declarado para un insumo (nombre sin extensión) o None."""
+    path = os.path.join(SCHEMAS_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def schema_fingerprint(schema):
+    """Huella corta del esquema; va al manifiesto del Paso 1 para reconvertir si cambia."""
+    if schema is None:
+        return None
+    payload = json.dumps(schema, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return f"{schema.get('name')}@v{schema.get('version', 1)}:{hashlib.sha256(payload).hexdigest()[:12]}"
+
+def _spec(spec):
+    """Normaliza 'int32' o {"type": "int32"} a un dict."""
+    return {"type": spec} if isinstance(spec, str) else dict(spec)
+
+def int_range_warning(col, kind, low, high):
+    """Aviso de un entero que no entra en el ancho declarado (mismo texto en pandas y Arrow)."""
+    return f"{col}: valores fuera del rango de {kind} ({low}..{high}), no se convierte"
+
+# --- Aplicación sobre pandas ---
+
+def apply_schema_pandas(df, schema):
+    """
+    Renombra y tipa un DataFrame según el esquema. Las conversiones que no aplican
+    (p.ej. un entero con nulos) dejan la columna como estaba y se informan en stats.
+    Devuelve (df, stats) con stats = {"date_parse_failures": {...}, "warnings": [...]}.
+    """
+    stats = {"date_parse_failures": {}, "warnings": []}
+    if schema is None:
+        return df, stats
+
+    rename = {k: v for k, v in schema.get('rename', {}).items() if k in df.columns}
+    if rename:
+        df = df.rename(columns=rename)
+
+    for col, raw_spec in schema.get('columns', {}).items():
+        if col not in df.columns:
+            continue
+        spec = _spec(raw_spec)
+        kind = spec['type']
+        try:
+            if kind == 'timestamp':
+                s = df[col]
+                if not pd.api.types.is_datetime64_any_dtype(s):
+                    if not pd.api.types.is_numeric_dtype(s):
+                        s = s.where(s.astype(str).str.strip() != '') # Vacío = nulo, no es un error
+                    parsed, _ = parse_dates(s, format=spec.get('format')) # Una vez por valor distinto
+                    # Valores que no respetan el formato explícito: segundo intento ISO8601
+                    retry = parsed.isna() & s.notna()
+                    if retry.any():
+                        parsed.loc[retry], _ = parse_dates(s[retry], format='ISO8601')
+                    failed = int((parsed.isna() & s.notna()).sum())
+                    if failed:
+                        stats["date_parse_failures"][col] = failed
+                    df[col] = parsed
+            elif kind in INT_TYPES:
+                if df[col].isna().any():
+                    stats["warnings"].append(f"{col}: tiene nulos, no se convierte a {kind}")
+                else:
+                    values = pd.to_numeric(df[col])
+                    bounds = np.iinfo(kind)
+                    # astype no controla el rango: un valor fuera de él daría la vuelta en silencio
+                    if len(values) and (values.min() < bounds.min or values.max() > bounds.max):
+                        stats["warnings"].append(int_range_warning(col, kind, values.min(), values.max()))
+                    else:
+                        df[col] = values.astype(kind)
+            elif kind in FLOAT_TYPES:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype(kind)
+            elif kind == 'category':
+                df[col] = df[col].astype('category')
+            elif kind == 'string':
+                df[col] = df[col].astype(str).where(df[col].notna())
+        except (ValueError, TypeError, OverflowError) as e:
+            stats["warnings"].append(f"{col}: no se pudo convertir a {kind} ({e})")
+    return df, stats
+
+# --- Aplicación sobre Arrow (modo streaming) ---
+
+def declared_raw_columns(schema, raw_names):
+    """{nombre crudo: (nombre canónico, tipo)} de las columnas del archivo que el esquema declara."""
+    if schema is None:
+        return {}
+    canonical_to_raw = {v: k for k, v in schema.get('rename', {}).items()}
+    declared = {}
+    for col, raw_spec in schema.get('columns', {}).items():
+        raw = canonical_to_raw.get(col, col)
+        if raw not in raw_names:
+            raw = col # El archivo ya trae el nombre canónico
+        if raw in raw_names:
+            declared[raw] = (col, _spec(raw_spec)['type'])
+    return declared
+
+def arrow_column_types(schema, inferred_types):
+    """
+    Tipos de lectura para pyarrow.csv, por nombre crudo. Parte de los tipos inferidos
+    y los sobreescribe con los declarados (la categoría se lee como texto y se codifica después).
+    Los enteros se leen como int64: el ancho declarado lo aplica apply_schema_arrow tras
+    controlar el rango, como apply_schema_pandas.
+    """
+    column_types = dict(inferred_types)
+    for raw, (_, kind) in declared_raw_columns(schema, column_types).items():
+        if kind == 'timestamp':
+            column_types[raw] = pa.timestamp(TIMESTAMP_UNIT)
+        elif kind in INT_TYPES:
+            column_types[raw] = pa.int64()
+        elif kind in FLOAT_TYPES:
+            column_types[raw] = getattr(pa, kind)()
+        elif kind in ('string', 'category'):
+            column_types[raw] = pa.string()
+    return column_types
+
+def arrow_timestamp_parsers(schema):
+    """
+    Formatos de fecha declarados, para ConvertOptions(timestamp_parsers=...), seguidos de
+    ISO8601 como segundo intento (igual que en pandas). El strptime de Arrow no admite %f:
+    esas fechas con fracción de segundo las resuelve el intento ISO8601.
+    """
+    if schema is None:
+        return None
+    formats = []
+    for raw_spec in schema.get('columns', {}).values():
+        spec = _spec(raw_spec)
+        if spec['type'] == 'timestamp' and spec.get('format') and spec['format'] not in formats:
+            formats.append(spec['format'])
+    return formats + [pacsv.ISO8601] if formats else None
+
+def apply_schema_arrow(batch, schema, wide=(), ranges=None):
+    """
+    Renombra columnas, aplica la codificación diccionario y reduce los enteros (leídos como
+    int64) al ancho declarado en un RecordBatch ya tipado. El esquema de salida tiene que ser
+    el mismo en todos los lotes: si un lote no entra en el ancho se lanza IntRangeError y el
+    llamador relee con esa columna en 'wide', que queda int64 y acumula su rango en 'ranges'.
+    """
+    if schema is None:
+        return batch
+    rename = schema.get('rename', {})
+    names = [rename.get(n, n) for n in batch.schema.names]
+    columns = schema.get('columns', {})
+    arrays = []
+    for name, arr in zip(names, batch.columns):
+        kind = _spec(columns[name])['type'] if name in columns else None
+        if kind == 'category':
+            arr = arr.dictionary_encode()
+        elif kind in INT_TYPES and kind != 'int64' and pa.types.is_int64(arr.type):
+            low, high = pc.min_max(arr).values()
+            low, high = low.as_py(), high.as_py()
+            if name in wide:
+                if ranges is not None and low is not None:
+                    prev = ranges.get(name, (low, high))
+                    ranges[name] = (min(prev[0], low), max(prev[1], high))
+            else:
+                bounds = np.iinfo(kind)
+                if low is not None and (low < bounds.min or high > bounds.max):
+                    raise IntRangeError(name, kind)
+                arr = arr.cast(getattr(pa, kind)())
+        arrays.append(arr)
+    return pa.RecordBatch.from_arrays(arrays, names=names)
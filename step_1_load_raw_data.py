@@ -1,9 +1,22 @@
 # step_1_load_raw_data.py
 import pandas as pd
 import os
+import io
+import re
 import json
 import time
 import sys
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+from etl_refcache import file_sha256
+from etl_personas import derive_personas_tables
+from etl_schema import (load_schema, schema_fingerprint, apply_schema_pandas, declared_raw_columns, arrow_column_types,
+                        arrow_timestamp_parsers, apply_schema_arrow, int_range_warning, IntRangeError)
 
 # --- Configuración y Constantes ---
 CONFIG_FILE = 'config.json'
@@ -12,6 +25,17 @@ LOG_FILE = os.path.join(LOG_DIR, "step_1.log")
 RUNNING_FLAG = os.path.join(LOG_DIR, "step_1.running")
 METRICS_FILE = os.path.join(LOG_DIR, "step_1_metrics.json")
 PID_FILE = os.path.join(LOG_DIR, "step_1.pid")
+MANIFEST_NAME = "_manifest_paso1.json" # Se guarda dentro de 'intermediate_loaded'
+DEFAULT_ROW_GROUP_SIZE = 250000
+DEFAULT_BLOCK_SIZE_MB = 64
+# Extractos que pueden escribirse como dataset Hive particionado por año de ingreso
+YEAR_PARTITIONED_INPUTS = {
+    "CasosActuacionesInquisitivo": "FechaIngreso",
+    "CasosActuacionesAcusatorio": "FechaIngreso",
+}
+PARTITION_COL = "anio_ingreso"
+DEFAULT_EXCEL_SHEET_WORKERS = 4
+INVALID_FILENAME_CHARS = '\\/:*?"<>|'
 
 # --- Funciones de Logging y Control ---
 
@@ -45,7 +69,7 @@ def load_config():
     with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def save_metrics(last_df, output_dir, file_count):
+def save_metrics(last_df, output_dir, file_count, counts=None):
     """Guarda métricas para el Inspector de la App."""
     # Usamos el último DF cargado para mostrar una previsualización de ejemplo
     preview = []
@@ -64,14 +88,490 @@ def save_metrics(last_df, output_dir, file_count):
         "preview": preview,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
+    if counts is not None:
+        metrics.update(counts) # skipped / converted / failed
     
     with open(METRICS_FILE, 'w', encoding='utf-8') as f:
         json.dump(metrics, f, indent=2)
 
+# --- Manifiesto de Huellas (Carga Incremental) ---
+
+def load_manifest(loaded_dir):
+    path = os.path.join(loaded_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('files', {})
+    except Exception as e:
+        log_message(f"⚠️ Manifiesto ilegible, se reconstruirá: {e}")
+        return {}
+
+def save_manifest(loaded_dir, entries):
+    """Escritura atómica: un corte a mitad de escritura no deja un manifiesto corrupto."""
+    path = os.path.join(loaded_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"files": entries, "updated": time.strftime("%Y-%m-%d %H:%M:%S")}, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def conversion_params(filename, ingestion_config=None):
+    """Parámetros que afectan el Parquet generado. Si cambian, el archivo se vuelve a convertir."""
+    ingestion_config = ingestion_config or {}
+    schema_id = schema_fingerprint(load_schema(os.path.splitext(filename)[0]))
+    if filename.lower().endswith('.csv'):
+        params = {"reader": "csv", "sep": ";", "encoding": "latin-1", "on_bad_lines": "skip", "schema": schema_id}
+        if ingestion_config.get('csv_mode', 'pandas') == 'streaming':
+            params.update({
+                "csv_mode": "streaming",
+                "row_group_size": int(ingestion_config.get('row_group_size', DEFAULT_ROW_GROUP_SIZE)),
+                "block_size_mb": int(ingestion_config.get('block_size_mb', DEFAULT_BLOCK_SIZE_MB)),
+            })
+        stem = os.path.splitext(filename)[0]
+        if ingestion_config.get('partition_by_year', False) and stem in YEAR_PARTITIONED_INPUTS:
+            params["partition_by"] = f"{PARTITION_COL}({YEAR_PARTITIONED_INPUTS[stem]})"
+        return params
+    return {
+        "reader": "excel", "schema": schema_id,
+        "engine": resolve_excel_engine(ingestion_config.get('excel_engine')) or "default",
+        "all_sheets": bool(ingestion_config.get('excel_all_sheets', False)),
+    }
+
+def resolve_excel_engine(requested):
+    """'calamine' (lector en Rust) solo si python-calamine está instalado; si no, el lector por defecto."""
+    if requested == 'calamine':
+        try:
+            import python_calamine # noqa: F401
+            return 'calamine'
+        except ImportError:
+            return None
+    return requested or None
+
+def output_fingerprint(output_path):
+    if not os.path.exists(output_path):
+        return None
+    if os.path.isdir(output_path):
+        # Dataset particionado: tamaño total y mtime más reciente de sus archivos
+        size, mtime = 0, 0.0
+        for root, _, files in os.walk(output_path):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+        return {"output_size": size, "output_mtime": mtime}
+    st = os.stat(output_path)
+    return {"output_size": st.st_size, "output_mtime": st.st_mtime}
+
+def is_up_to_date(task, entry):
+    """
+    True si la fuente, los parámetros y el Parquet de salida coinciden con el manifiesto.
+    Si solo cambió la fecha y el hash coincide, actualiza el mtime de la entrada (hay que
+    guardar el manifiesto después) para no volver a hashear el archivo en cada corrida.
+    """
+    if not entry or entry.get('params') != task['params']:
+        return False
+    out_fp = output_fingerprint(task['output_path'])
+    if out_fp is None or out_fp['output_size'] != entry.get('output_size') or out_fp['output_mtime'] != entry.get('output_mtime'):
+        return False
+    # Salidas adicionales (una por hoja en libros Excel)
+    for extra_path, extra_fp in entry.get('extra_outputs', {}).items():
+        if output_fingerprint(extra_path) != extra_fp:
+            return False
+    if task['size'] != entry.get('size'):
+        return False
+    if task['mtime'] == entry.get('mtime'):
+        return True
+    # Mismo tamaño pero otra fecha (copia/touch): decide el contenido
+    task['sha256'] = file_sha256(task['file_path'])
+    if task['sha256'] != entry.get('sha256'):
+        return False
+    entry['mtime'] = task['mtime']
+    return True
+
+# --- Conversión CSV en Streaming (memoria acotada) ---
+
+# Valores nulos por defecto de pd.read_csv: el modo streaming lee lo mismo que el de pandas
+PANDAS_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+PAD_READ_SIZE = 1024 * 1024
+
+def _csv_options(params, on_invalid_row):
+    read_opts = pacsv.ReadOptions(
+        encoding=params['encoding'], use_threads=True,
+        block_size=params['block_size_mb'] * 1024 * 1024
+    )
+    parse_opts = pacsv.ParseOptions(delimiter=params['sep'], invalid_row_handler=on_invalid_row)
+    return read_opts, parse_opts
+
+def _convert_options(column_types=None, timestamp_parsers=None):
+    """Vacíos (con o sin comillas) y los marcadores de pandas son nulos, también en columnas de texto."""
+    return pacsv.ConvertOptions(column_types=column_types, null_values=PANDAS_NA_VALUES,
+                                strings_can_be_null=True, quoted_strings_can_be_null=True,
+                                timestamp_parsers=timestamp_parsers)
+
+class PaddedCSV(io.RawIOBase):
+    """
+    Vista del CSV en la que los registros con menos campos que el encabezado se completan
+    con separadores (campos vacíos = nulos), como hace pd.read_csv. Se lee por bloques: la
+    memoria no depende del archivo. Los separadores entre comillas no cuentan como campos.
+    """
+
+    def __init__(self, file_path, sep):
+        self.f = open(file_path, 'rb')
+        self.sep = sep.encode('ascii')
+        self.in_quotes = False
+        self.fields = 1
+        self.expected = None
+        self.pending = b''
+        self.padded = 0
+
+    def readable(self):
+        return True
+
+    def _count(self, line):
+        """Campos (separadores fuera de comillas + 1) acumulados en el registro en curso."""
+        if not self.in_quotes and b'"' not in line:
+            self.fields += line.count(self.sep)
+            return
+        quote, sep = ord('"'), self.sep[0]
+        for byte in line:
+            if byte == quote:
+                self.in_quotes = not self.in_quotes # "" (comilla escapada) cambia dos veces
+            elif byte == sep and not self.in_quotes:
+                self.fields += 1
+
+    def _process(self, line):
+        body = line.rstrip(b'\r\n')
+        if not body and not self.in_quotes and self.fields == 1:
+            return line # Línea vacía: el lector la ignora, igual que pandas
+        self._count(body)
+        if self.in_quotes:
+            return line # El registro sigue en la línea siguiente (salto dentro de comillas)
+        if self.expected is None:
+            self.expected = self.fields
+        elif self.fields < self.expected:
+            self.padded += 1
+            line = body + self.sep * (self.expected - self.fields) + line[len(body):]
+        self.fields = 1
+        return line
+
+    def readinto(self, buffer):
+        while len(self.pending) < len(buffer):
+            lines = self.f.readlines(PAD_READ_SIZE)
+            if not lines:
+                break
+            self.pending += b''.join(self._process(line) for line in lines)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def infer_streaming_types(file_path, params):
+    """
+    Infiere tipos sobre el primer bloque y los fija para todo el archivo.
+    Fechas y columnas vacías en la muestra quedan como texto, igual que con pd.read_csv.
+    """
+    read_opts, parse_opts = _csv_options(params, lambda row: 'skip')
+    reader = pacsv.open_csv(file_path, read_options=read_opts, parse_options=parse_opts,
+                            convert_options=_convert_options())
+    try:
+        schema = reader.schema
+    finally:
+        reader.close()
+    column_types = {}
+    for field in schema:
+        t = field.type
+        if pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_boolean(t):
+            column_types[field.name] = t
+        else:
+            column_types[field.name] = pa.string()
+    return column_types
+
+def _stream_csv(source, tmp_path, params, schema, column_types, wide, ranges):
+    """
+    Una pasada de lectura Arrow -> Parquet temporal. Devuelve (filas, líneas con campos de
+    más omitidas, registros cortos, preview_df). Con registros cortos el temporal no sirve:
+    pandas los conserva completando con nulos, y el lector Arrow solo puede omitirlos.
+    wide/ranges: enteros que se dejan en int64 y su rango (ver apply_schema_arrow).
+    """
+    bad_lines, short_rows = [0], [0]
+    def on_invalid_row(row):
+        if row.actual_columns < row.expected_columns:
+            short_rows[0] += 1
+        else:
+            bad_lines[0] += 1 # Mismo criterio que on_bad_lines='skip', pero contado
+        return 'skip'
+
+    read_opts, parse_opts = _csv_options(params, on_invalid_row)
+    convert_opts = _convert_options(column_types, arrow_timestamp_parsers(schema))
+    row_group_size = params['row_group_size']
+    total_rows = 0
+    preview = None
+    buffer, buffered_rows = [], 0
+    ranges.clear()
+    reader = pacsv.open_csv(source, read_options=read_opts, parse_options=parse_opts, convert_options=convert_opts)
+    try:
+        out_schema = apply_schema_arrow(pa.RecordBatch.from_pylist([], schema=reader.schema), schema, wide).schema
+        with pq.ParquetWriter(tmp_path, out_schema) as writer:
+            for batch in reader:
+                batch = apply_schema_arrow(batch, schema, wide, ranges)
+                if preview is None and batch.num_rows:
+                    preview = batch.slice(0, 5).to_pandas()
+                buffer.append(batch)
+                buffered_rows += batch.num_rows
+                total_rows += batch.num_rows
+                if buffered_rows >= row_group_size:
+                    writer.write_table(pa.Table.from_batches(buffer), row_group_size=row_group_size)
+                    buffer, buffered_rows = [], 0
+            if buffer:
+                writer.write_table(pa.Table.from_batches(buffer), row_group_size=row_group_size)
+    finally:
+        reader.close()
+    return total_rows, bad_lines[0], short_rows[0], preview
+
+def _failed_column(error, raw_names):
+    """Columna (nombre crudo) que hizo fallar la conversión del lector Arrow, o None."""
+    match = re.search(r"In CSV column #(\d+)", str(error))
+    return raw_names[int(match.group(1))] if match and int(match.group(1)) < len(raw_names) else None
+
+def convert_csv_streaming(file_path, output_path, params, schema=None):
+    """
+    Convierte el CSV por lotes de registros (lector Arrow multihilo) y escribe los row groups
+    de forma incremental. La memoria pico queda acotada por 'row_group_size', no por el archivo.
+    Los casos que pandas resuelve sobre la columna completa se resuelven releyendo:
+    - Registros con menos campos que el encabezado: se completan con nulos (como pandas),
+      releyendo el archivo a través de PaddedCSV.
+    - Tipos inferidos que no se sostienen más allá del primer bloque: las columnas no
+      declaradas se leen como texto (lo mismo que haría pandas con tipos mezclados).
+    - Entero declarado con valores fuera de su ancho: queda int64, con el aviso de pandas.
+    - Columna declarada que no convierte (p.ej. texto en un entero): queda como texto y se avisa.
+    Devuelve (filas, líneas_malformadas_omitidas, preview_df, nota o None, schema_stats).
+    """
+    # Los tipos declarados en el registro de esquemas tienen prioridad sobre los inferidos
+    inferred = infer_streaming_types(file_path, params)
+    raw_names = list(inferred)
+    declared = declared_raw_columns(schema, raw_names)
+    column_types = arrow_column_types(schema, inferred)
+    wide, ranges = set(), {}
+    notes, stats = [], {"date_parse_failures": {}, "warnings": []}
+    padded = False
+    # Se escribe a un temporal: un fallo a mitad de camino no deja un Parquet truncado
+    tmp_path = output_path + ".tmp"
+    try:
+        while True:
+            try:
+                if padded:
+                    with io.BufferedReader(PaddedCSV(file_path, params['sep']), PAD_READ_SIZE) as source:
+                        rows, bad_lines, _, preview = _stream_csv(source, tmp_path, params, schema, column_types, wide, ranges)
+                else:
+                    rows, bad_lines, short_rows, preview = _stream_csv(file_path, tmp_path, params, schema, column_types, wide, ranges)
+            except IntRangeError as e:
+                wide.add(e.column)
+                continue
+            except pa.ArrowInvalid as e:
+                raw = _failed_column(e, raw_names)
+                if raw is None or column_types.get(raw) == pa.string():
+                    raise
+                if raw in declared:
+                    col, kind = declared[raw]
+                    column_types[raw] = pa.string()
+                    stats["warnings"].append(f"{col}: no se pudo convertir a {kind} ({e})")
+                else:
+                    column_types.update({name: pa.string() for name in raw_names if name not in declared})
+                    notes.append(f"Tipos inestables más allá del primer bloque ({e}); columnas no declaradas leídas como texto")
+                continue
+            if short_rows and not padded:
+                padded = True
+                notes.append(f"{short_rows:,} registros con campos de menos completados con nulos")
+                continue
+            break
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    for raw, (col, kind) in declared.items():
+        if col in wide:
+            low, high = ranges.get(col, (None, None))
+            stats["warnings"].append(int_range_warning(col, kind, low, high))
+    clear_output(output_path)
+    os.replace(tmp_path, output_path)
+    return rows, bad_lines, preview, "; ".join(notes) or None, stats
+
+def clear_output(path):
+    """Elimina una salida previa, sea Parquet plano o dataset particionado (directorio)."""
+    if os.path.isdir(path): shutil.rmtree(path)
+    elif os.path.exists(path): os.remove(path)
+
+# --- Excel: todas las hojas, en paralelo ---
+
+def sheet_output_path(output_path, sheet_name):
+    """<libro>__<hoja>.parquet junto al Parquet del libro."""
+    safe = ''.join('_' if c in INVALID_FILENAME_CHARS else c for c in str(sheet_name)).strip()
+    stem = os.path.splitext(os.path.basename(output_path))[0]
+    return os.path.join(os.path.dirname(output_path), f"{stem}__{safe}.parquet")
+
+def convert_sheets(file_path, output_path, sheets, engine, schema):
+    """
+    Convierte un grupo de hojas [(índice, nombre)] abriendo el libro una sola vez.
+    La hoja 0 se escribe además como <libro>.parquet con el esquema del libro.
+    """
+    results = []
+    with pd.ExcelFile(file_path, engine=engine) as xls:
+        for idx, sheet_name in sheets:
+            df = xls.parse(sheet_name)
+            sheet_path = sheet_output_path(output_path, sheet_name)
+            compat_stats = None
+            if idx == 0:
+                df_compat, compat_stats = apply_schema_pandas(df.copy(), schema)
+                df_compat.to_parquet(output_path, index=False)
+                del df_compat
+            sheet_schema = load_schema(os.path.splitext(os.path.basename(sheet_path))[0])
+            df, _ = apply_schema_pandas(df, sheet_schema)
+            df.to_parquet(sheet_path, index=False)
+            results.append({"idx": idx, "sheet": sheet_name, "path": sheet_path, "rows": len(df),
+                            "preview": df.head(5) if idx == 0 else None, "schema_stats": compat_stats})
+    return results
+
+def convert_workbook(file_path, output_path, params, schema, sheet_workers):
+    """
+    Convierte cada hoja del libro a su propio Parquet. La primera hoja se escribe además
+    como <libro>.parquet, igual que antes, por compatibilidad. Con sheet_workers > 1 las
+    hojas se reparten entre procesos (el parseo de Excel no libera el GIL); cada proceso
+    abre el libro una vez para todas sus hojas.
+    Devuelve (filas_totales, salidas_por_hoja, preview_df, schema_stats).
+    """
+    engine = params.get('engine') if params.get('engine') != 'default' else None
+    with pd.ExcelFile(file_path, engine=engine) as xls:
+        sheet_names = xls.sheet_names
+
+    n_workers = max(1, min(sheet_workers, len(sheet_names)))
+    groups = [list(enumerate(sheet_names))[i::n_workers] for i in range(n_workers)]
+    if n_workers == 1:
+        sheets = convert_sheets(file_path, output_path, groups[0], engine, schema)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(convert_sheets, file_path, output_path, group, engine, schema) for group in groups]
+            sheets = [sheet for future in futures for sheet in future.result()]
+    sheets.sort(key=lambda sheet: sheet['idx'])
+    first = sheets[0]
+    return sum(s['rows'] for s in sheets), [s['path'] for s in sheets], first['preview'], first['schema_stats']
+
+# --- Particionado por Año ---
+
+def write_year_partitions(flat_path, output_path, date_col):
+    """
+    Reescribe un Parquet plano como dataset Hive (<salida>/anio_ingreso=AAAA/...), en streaming.
+    Cada partición lleva estadísticas por columna. Las fechas nulas van a la partición por defecto.
+    """
+    source = ds.dataset(flat_path, format='parquet')
+    if date_col not in source.schema.names or not pa.types.is_timestamp(source.schema.field(date_col).type):
+        raise ValueError(f"'{date_col}' no es una fecha nativa; revise el esquema declarado.")
+    columns = {name: ds.field(name) for name in source.schema.names}
+    columns[PARTITION_COL] = pc.year(ds.field(date_col))
+    tmp_dir = output_path + ".tmp_ds"
+    if os.path.exists(tmp_dir): shutil.rmtree(tmp_dir)
+    ds.write_dataset(
+        source.scanner(columns=columns), tmp_dir, format='parquet',
+        partitioning=ds.partitioning(pa.schema([(PARTITION_COL, pa.int64())]), flavor='hive'),
+        file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True),
+    )
+    # Reemplazo de la salida anterior (archivo plano o dataset previo)
+    clear_output(output_path)
+    os.replace(tmp_dir, output_path)
+    os.remove(flat_path)
+
+# --- Conversión de un archivo (ejecutable en un proceso hijo) ---
+
+def convert_file(task):
+    """Convierte un CSV/Excel a Parquet. Devuelve un dict con el resultado (no lanza excepciones)."""
+    filename, file_path, final_output_path = task['filename'], task['file_path'], task['output_path']
+    params = task['params']
+    partition_date_col = YEAR_PARTITIONED_INPUTS.get(os.path.splitext(filename)[0]) if params.get('partition_by') else None
+    # Con particionado se escribe primero un Parquet plano temporal y luego se reparte por año
+    output_path = final_output_path + ".flat.tmp" if partition_date_col else final_output_path
+    schema = load_schema(os.path.splitext(filename)[0])
+    result = {"filename": filename, "ok": False, "rows": 0, "elapsed": 0.0, "error": None, "preview": None,
+              "bad_lines": None, "note": None, "schema_stats": None, "extra_outputs": []}
+    start_t = time.time()
+    try:
+        df = None
+        if params.get('csv_mode') == 'streaming':
+            rows, bad_lines, preview, note, schema_stats = convert_csv_streaming(file_path, output_path, params, schema)
+            if partition_date_col:
+                write_year_partitions(output_path, final_output_path, partition_date_col)
+            result.update({"ok": True, "rows": rows, "bad_lines": bad_lines, "preview": preview, "note": note,
+                           "schema_stats": schema_stats, "sha256": task.get('sha256') or file_sha256(file_path)})
+            result["elapsed"] = time.time() - start_t
+            return result
+
+        # Carga CSV (Configuración compatible con R: Latin-1 y punto y coma)
+        if filename.lower().endswith('.csv'):
+            df = pd.read_csv(
+                file_path, 
+                sep=';', 
+                encoding='latin-1', 
+                low_memory=False,
+                on_bad_lines='skip' # Evita crash por líneas malformadas
+            )
+        
+        # Carga Excel: todas las hojas (una salida por hoja) o solo la primera, como siempre
+        elif filename.lower().endswith(('.xlsx', '.xls')):
+            if params.get('all_sheets'):
+                rows, sheet_paths, preview, schema_stats = convert_workbook(
+                    file_path, output_path, params, schema,
+                    task.get('excel_sheet_workers', DEFAULT_EXCEL_SHEET_WORKERS)
+                )
+                result.update({"ok": True, "rows": rows, "preview": preview, "schema_stats": schema_stats,
+                               "extra_outputs": sheet_paths, "sha256": task.get('sha256') or file_sha256(file_path)})
+                result["elapsed"] = time.time() - start_t
+                return result
+            engine = params.get('engine') if params.get('engine') != 'default' else None
+            df = pd.read_excel(file_path, engine=engine)
+        
+        # Guardado a Parquet
+        if df is not None:
+            # Nombres canónicos y tipos declarados (registro de esquemas); sin esquema queda lo inferido
+            df, result["schema_stats"] = apply_schema_pandas(df, schema)
+            
+            clear_output(output_path)
+            df.to_parquet(output_path, index=False)
+            if partition_date_col:
+                write_year_partitions(output_path, final_output_path, partition_date_col)
+            result["sha256"] = task.get('sha256') or file_sha256(file_path)
+            result["ok"] = True
+            result["rows"] = len(df)
+            result["preview"] = df.head(5) # Solo una muestra viaja de vuelta al proceso principal
+    except Exception as e:
+        result["error"] = str(e)
+        if partition_date_col and os.path.exists(output_path): os.remove(output_path)
+    result["elapsed"] = time.time() - start_t
+    return result
+
+def iter_conversions(tasks, workers):
+    """Ejecuta las conversiones en serie (workers <= 1) o en un pool de procesos, en orden de finalización."""
+    if workers <= 1:
+        for task in tasks:
+            yield convert_file(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_file, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # Un proceso hijo caído (p.ej. sin memoria) no debe abortar el lote
+                yield {"filename": futures[future]['filename'], "ok": False, "rows": 0,
+                       "elapsed": 0.0, "error": f"Proceso de conversión interrumpido: {e}", "preview": None}
+
 # --- Lógica Principal del ETL ---
 
-def run_step_1(paths_config, log_key_dummy=None):
-    """Función principal de carga."""
+def run_step_1(paths_config, log_key_dummy=None, ingestion_config=None, force=False):
+    """Función principal de carga. Con force=True se reconvierten todos los archivos."""
+    ingestion_config = ingestion_config or {}
+    force = force or bool(ingestion_config.get('force', False))
     
     # 1. Obtener rutas
     raw_dir = paths_config.get('raw_data')
@@ -100,62 +600,122 @@ def run_step_1(paths_config, log_key_dummy=None):
     total_files = len(files_to_process)
     log_message(f"🚀 Se encontraron {total_files} archivos para procesar.")
     
+    # Los archivos más grandes primero: evita que un CSV enorme quede como cola al final del lote
+    tasks = []
+    for filename in files_to_process:
+        file_path = os.path.join(raw_dir, filename)
+        # Cambio de extensión a .parquet
+        output_filename = os.path.splitext(filename)[0] + '.parquet'
+        st = os.stat(file_path)
+        tasks.append({
+            "filename": filename,
+            "file_path": file_path,
+            "output_path": os.path.join(loaded_dir, output_filename),
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "params": conversion_params(filename, ingestion_config),
+            "excel_sheet_workers": int(ingestion_config.get('excel_sheet_workers', DEFAULT_EXCEL_SHEET_WORKERS)),
+        })
+    tasks.sort(key=lambda t: t['size'], reverse=True)
+    
+    # Carga incremental: se omiten los archivos cuya huella y Parquet de salida no cambiaron
+    manifest = load_manifest(loaded_dir)
+    if force:
+        log_message("🔁 Modo 'force': se reconvertirán todos los archivos.")
+        pending = tasks
+    else:
+        pending = [t for t in tasks if not is_up_to_date(t, manifest.get(t['filename']))]
+        if any('sha256' in t for t in tasks if t not in pending):
+            save_manifest(loaded_dir, manifest) # Fechas actualizadas de archivos tocados pero sin cambios
+    skipped_count = total_files - len(pending)
+    if skipped_count:
+        log_message(f"⏭️ {skipped_count} archivos sin cambios (se omiten). Pendientes: {len(pending)}")
+    
+    workers = max(1, min(int(ingestion_config.get('workers', 1) or 1), max(len(pending), 1)))
+    if workers > 1:
+        log_message(f"⚙️ Modo paralelo: {workers} procesos (archivos grandes primero).")
+    if ingestion_config.get('csv_mode', 'pandas') == 'streaming':
+        log_message("⚙️ CSV en modo streaming (lotes Arrow + escritura Parquet por row groups).")
+    requested_engine = ingestion_config.get('excel_engine')
+    if requested_engine and resolve_excel_engine(requested_engine) is None:
+        log_message(f"⚠️ Motor Excel '{requested_engine}' no instalado (pip install python-calamine). Se usa el lector por defecto.")
+    
     success_count = 0
+    failed_count = 0
+    bad_lines_total = 0
+    excel_throughput = []
     last_processed_df = None
     start_time_total = time.time()
+    tasks_by_name = {t['filename']: t for t in pending}
 
     # 3. Bucle de Procesamiento
-    for i, filename in enumerate(files_to_process):
-        file_path = os.path.join(raw_dir, filename)
-        # Cambio de extensión a .parquet
-        output_filename = os.path.splitext(filename)[0] + '.parquet'
-        output_path = os.path.join(loaded_dir, output_filename)
-        
-        log_message(f"  ({i+1}/{total_files}) Leyendo: {filename}...")
-        start_t = time.time()
-        
-        try:
-            df = None
-            # Carga CSV (Configuración compatible con R: Latin-1 y punto y coma)
-            if filename.lower().endswith('.csv'):
-                df = pd.read_csv(
-                    file_path, 
-                    sep=';', 
-                    encoding='latin-1', 
-                    low_memory=False,
-                    on_bad_lines='skip' # Evita crash por líneas malformadas
-                )
-            
-            # Carga Excel
-            elif filename.lower().endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(file_path)
-            
-            # Guardado a Parquet
-            if df is not None:
-                # Normalizar nombres de columnas (opcional pero recomendado: minúsculas y sin espacios)
-                # df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_')
-                
-                df.to_parquet(output_path, index=False)
-                elapsed = time.time() - start_t
-                log_message(f"    -> OK. Guardado como Parquet ({len(df)} filas) [{elapsed:.2f}s]")
-                
-                success_count += 1
-                last_processed_df = df # Guardamos referencia para la preview
-                
-        except Exception as e:
-            log_message(f"    ❌ ERROR procesando archivo: {e}")
-            # No detenemos el loop, intentamos con el siguiente
-            continue
+    for i, result in enumerate(iter_conversions(pending, workers)):
+        log_message(f"  ({i+1}/{len(pending)}) {result['filename']}")
+        task = tasks_by_name[result['filename']]
+        if result["ok"]:
+            if result['note']:
+                log_message(f"    ⚠️ {result['note']}")
+            log_message(f"    -> OK. Guardado como Parquet ({result['rows']} filas) [{result['elapsed']:.2f}s]")
+            if task['params'].get('partition_by'):
+                log_message(f"    -> Dataset particionado por {task['params']['partition_by']}")
+            if task['params'].get('schema'):
+                log_message(f"    -> Esquema aplicado: {task['params']['schema']}")
+            schema_stats = result['schema_stats'] or {}
+            for col, n in schema_stats.get('date_parse_failures', {}).items():
+                log_message(f"    ⚠️ {col}: {n} fechas no parseables quedaron como nulo.")
+            for warning in schema_stats.get('warnings', []):
+                log_message(f"    ⚠️ Esquema: {warning}")
+            if result['bad_lines']:
+                log_message(f"    ⚠️ {result['bad_lines']} líneas malformadas omitidas.")
+                bad_lines_total += result['bad_lines']
+            if task['params']['reader'] == 'excel':
+                elapsed = max(result['elapsed'], 1e-6)
+                throughput = {
+                    "workbook": task['filename'], "engine": task['params']['engine'],
+                    "sheets": max(len(result['extra_outputs']), 1), "rows": result['rows'],
+                    "seconds": round(result['elapsed'], 2),
+                    "rows_per_s": round(result['rows'] / elapsed, 1),
+                    "mb_per_s": round(task['size'] / 1024**2 / elapsed, 2),
+                }
+                excel_throughput.append(throughput)
+                if result['extra_outputs']:
+                    log_message(f"    -> {throughput['sheets']} hojas convertidas ({throughput['rows_per_s']:,.0f} filas/s, motor: {throughput['engine']})")
+            success_count += 1
+            last_processed_df = result["preview"] # Guardamos referencia para la preview
+            manifest[task['filename']] = {
+                "source_path": task['file_path'], "size": task['size'], "mtime": task['mtime'],
+                "sha256": result['sha256'], "params": task['params'],
+                "output_path": task['output_path'], **output_fingerprint(task['output_path']),
+                "rows": result['rows'], "bad_lines": result['bad_lines'],
+                "schema_stats": result['schema_stats'], "converted_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "extra_outputs": {p: output_fingerprint(p) for p in result['extra_outputs']},
+            }
+        else:
+            # No detenemos el lote, el archivo fallido simplemente se omite
+            log_message(f"    ❌ ERROR procesando archivo: {result['error']}")
+            failed_count += 1
+            manifest.pop(task['filename'], None) # Se reintenta en la próxima corrida
+        save_manifest(loaded_dir, manifest)
+
+    # Tablas derivadas de personas para los Pasos 3 y 4 (solo si el archivo de personas cambió)
+    try:
+        derive_personas_tables(loaded_dir, force=force, log=log_message)
+    except Exception as e:
+        log_message(f"    ⚠️ No se pudieron derivar las tablas de personas: {e}")
 
     # 4. Finalización
     total_time = time.time() - start_time_total
     log_message("-" * 30)
     log_message(f"✅ PROCESO COMPLETADO")
-    log_message(f"   Archivos exitosos: {success_count} / {total_files}")
+    log_message(f"   Archivos convertidos: {success_count} / {len(pending)} (omitidos sin cambios: {skipped_count}, fallidos: {failed_count})")
     log_message(f"   Tiempo total: {total_time:.2f}s")
     
     # Generar métricas para la UI
-    save_metrics(last_processed_df, loaded_dir, success_count)
+    if bad_lines_total:
+        log_message(f"   Líneas malformadas omitidas: {bad_lines_total}")
+    counts = {"skipped": skipped_count, "converted": success_count, "failed": failed_count,
+              "bad_lines_skipped": bad_lines_total, "excel_throughput": excel_throughput}
+    save_metrics(last_processed_df, loaded_dir, success_count + skipped_count, counts)
     
     return True
 
@@ -173,7 +733,8 @@ if __name__ == "__main__":
         # 3. Cargar config y ejecutar
         config = load_config()
         if config:
-            run_step_1(config.get('paths', {}))
+            run_step_1(config.get('paths', {}), ingestion_config=config.get('ingestion', {}),
+                       force='--force' in sys.argv)
         else:
             log_message("ERROR CRITICO: No se pudo cargar config.json")
             
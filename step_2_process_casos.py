@@ -15,6 +15,13 @@ import gc
 import json 
 import traceback 
 from datetime import datetime
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from etl_loader import load_parquet
+from etl_kernels import fill_text, map_values, parse_dates, remap_where
+from etl_join import JoinGuard, combine_join_records
+from etl_buckets import (bucket_settings, key_column, split_parquet, read_bucket, bucket_path,
+                         run_buckets, concat_buckets, preview_frame, clear_work_dir)
 
 # --- Constantes ---
 LOG_DIR = "logs"
@@ -24,6 +31,9 @@ PAUSE_FILE = os.path.join(LOG_DIR, "step_2.pause")
 RUNNING_FLAG = os.path.join(LOG_DIR, "step_2.running")
 METRICS_FILE = os.path.join(LOG_DIR, "step_2_metrics.json") 
 CONFIG_FILE = 'config.json'
+SUBSEDES_UNIDAD_FISCAL = {'Subsede ORAN': 'Subsede ORAN', 'Subsede TARTAGAL': 'Subsede TARTAGAL'}
+TERRITORIO_SUBSEDES = {'Subsede ORAN': 'Orán Tartagal', 'Subsede TARTAGAL': 'Orán Tartagal'}
+PARTITION_COL = "anio_ingreso" # Columna de partición de los extractos de casos (Paso 1)
 
 # --- Funciones de Control ---
 
@@ -35,17 +45,22 @@ def check_pause(log_key="[Paso 2]"):
             time.sleep(1)
         log_message(f"{log_key} ▶️ REANUDANDO ejecución...")
 
-def save_metrics(df, output_path, input_files_list):
-    """Guarda un resumen procesado + lista de inputs para el Inspector."""
+def save_metrics(df, output_path, input_files_list, rows=None, memory_mb=None, joins=None):
+    """
+    Guarda un resumen procesado + lista de inputs para el Inspector. En el modo fuera de
+    memoria df es una vista previa: se pasan las filas totales y el pico de RAM por balde.
+    joins: predicción y filas reales de cada cruce (JoinGuard.records).
+    """
     preview = df.head(10).astype(str).to_dict(orient='records')
     
     metrics = {
-        "rows": len(df),
+        "rows": len(df) if rows is None else rows,
         "columns": len(df.columns),
-        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2, 2),
+        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2 if memory_mb is None else memory_mb, 2),
         "columns_list": list(df.columns),
         "output_file": output_path,
         "input_files": input_files_list, 
+        "joins": joins or [],
         "preview": preview,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
@@ -73,12 +88,13 @@ def log_memory_usage():
     mem_usage = psutil.virtual_memory().percent
     log_message(f"  [MEM] Uso de RAM del Sistema: {mem_usage}%")
     
-def safe_load(path, log_error=True):
+def safe_load(path, log_error=True, filters=None, columns=None):
+    """Carga con proyección de columnas y filtros empujados al escáner de Arrow (etl_loader)."""
     if not os.path.exists(path):
         if log_error: log_message(f"  -> ERROR: Archivo no encontrado: {path}")
         return None
     try:
-        return pd.read_parquet(path)
+        return load_parquet(path, columns=columns, filters=filters, log=log_message)
     except Exception as e:
         if log_error: log_message(f"  -> ERROR Leyendo {path}: {e}")
         return None
@@ -116,51 +132,47 @@ def optimize_memory(df):
     log_message(f"  -> Reducción de RAM: {initial_mem:.2f} MB -> {final_mem:.2f} MB")
     return df
 
-# --- LÓGICA PRINCIPAL ---
+def attach_caso_original(df_casos, src_originales):
+    """
+    Agrega IdCasoOriginal y FechaIngresoCasoIncidente (fecha de ingreso del caso original)
+    sin recorrer cada fila con regex ni hacer un merge de la tabla consigo misma:
+      1. Se factoriza 'numero' una vez; la extracción y la marca '/INC' corren por número distinto.
+      2. La búsqueda caso original -> fecha es un arreglo indexado por el código entero del número.
+      3. Las filas reciben el valor con takes posicionales (código de fila -> número -> fecha).
+    Equivale al merge left anterior: primera fila no-incidente por número, y nulo si no hay original.
+    Devuelve la cantidad de números distintos (para el log).
+    """
+    codes, numeros = pd.factorize(df_casos['numero'], use_na_sentinel=False)
+    id_original_u = pd.Series(numeros, dtype=df_casos['numero'].dtype).str.extract(r"(\d+/\d{4})", expand=False)
 
-def run_step_2_main():
-    start_time_total = time.time()
-    setup_logging()
-    
-    log_message("[Paso 2] Motor de Procesamiento Iniciado.")
-    log_memory_usage()
-    
-    config = load_config()
-    if not config:
-        log_message("ERROR FATAL: Configuración inválida.")
-        return
+    # Tabla de originales: por cada número distinto, la primera fila que no es incidente
+    if src_originales is df_casos:
+        src_codes, src_numeros = codes, numeros
+    else:
+        src_codes, src_numeros = pd.factorize(src_originales['numero'], use_na_sentinel=False)
+    es_incidente_u = pd.Series(src_numeros, dtype=src_originales['numero'].dtype).str.contains('/INC', na=False, case=False).to_numpy()
+    filas_originales = np.flatnonzero(~es_incidente_u[src_codes])
+    primera_fila = np.full(len(src_numeros), -1, dtype=np.int64)
+    codigos_vistos, primera_pos = np.unique(src_codes[filas_originales], return_index=True)
+    primera_fila[codigos_vistos] = filas_originales[primera_pos]
+    fecha_por_numero = src_originales['FechaIngreso'].array.take(primera_fila, allow_fill=True)
 
-    paths_config = config.get('paths', {})
-    filters_config = config.get('filters', {})
+    # Clave entera: IdCasoOriginal distinto -> código del número en la tabla de originales
+    pos_original_u = pd.Index(src_numeros).get_indexer(id_original_u)
+    fecha_u = fecha_por_numero.take(pos_original_u, allow_fill=True)
 
-    loaded_dir = paths_config.get('intermediate_loaded')
-    processed_dir = paths_config.get('intermediate_processed')
-    os.makedirs(processed_dir, exist_ok=True)
-    
-    input_files_used = []
+    df_casos['IdCasoOriginal'] = id_original_u.array.take(codes)
+    df_casos['FechaIngresoCasoIncidente'] = fecha_u.take(codes)
+    return len(numeros)
 
-    # 1. CARGA DE DATOS
-    check_pause()
-    log_message("  1/5 Cargando archivos Parquet...")
-    
-    f1 = os.path.join(loaded_dir, 'CasosActuacionesInquisitivo.parquet')
-    f2 = os.path.join(loaded_dir, 'CasosActuacionesAcusatorio.parquet')
-    f3 = os.path.join(loaded_dir, 'fechadelhecho.parquet')
-    
-    df_inquisitivo = safe_load(f1)
-    df_acusatorio = safe_load(f2)
-    df_fechadelhecho = safe_load(f3, log_error=False) 
-    
-    if df_inquisitivo is None or df_acusatorio is None:
-        log_message("ERROR CRITICO: Faltan archivos de casos (Inquisitivo o Acusatorio).")
-        return
-    
-    input_files_used.extend(["CasosActuacionesInquisitivo.parquet", "CasosActuacionesAcusatorio.parquet"])
-    if df_fechadelhecho is not None:
-        input_files_used.append("fechadelhecho.parquet")
-    else:
-        log_message("[Paso 2] ADVERTENCIA: No se encontró 'fechadelhecho.parquet'. Se continuará sin él.")
-        
+def process_casos(df_inquisitivo, df_acusatorio, df_originales_src, df_fechadelhecho, filters_config, guard=None):
+    """
+    Unificación y lógica de negocio del Paso 2 (puntos 2 a 5) sobre un conjunto de casos.
+    Con df_originales_src=None la búsqueda del caso original usa los propios casos. En el
+    modo fuera de memoria se llama una vez por balde de IdCaso con la búsqueda global.
+    guard (JoinGuard) controla la cardinalidad del cruce con la fecha del hecho.
+    """
+    if guard is None: guard = JoinGuard(log=log_message)
     # 2. UNIFICACIÓN
     check_pause()
     log_message("  2/5 Unificando datasets...")
@@ -172,15 +184,14 @@ def run_step_2_main():
         'idactuacion': 'IdActuacion', 'idestadoactuacion': 'IdEstadoActuacion', 'idcasodivision': 'IdCasoDivision',
         'activa': 'Activa', 'idprocedimiento_1': 'IdProcedimiento_1', 'personadelito': 'PersonaDelito'
     }
+    # Con el esquema declarado del Paso 1 las columnas ya vienen con nombre canónico (no-op)
     df_acusatorio = df_acusatorio.rename(columns=rename_map)
     
     df_casos = pd.concat([df_inquisitivo, df_acusatorio], ignore_index=True)
     del df_inquisitivo, df_acusatorio
     gc.collect()
     
-    log_message(f"  -> Total filas brutas: {len(df_casos):,}")
-    df_casos = df_casos[df_casos['estadocaso'] != 'Anulado']
-    log_message("  -> Filtro de anulados aplicado.")
+    log_message(f"  -> Total filas (sin anulados, filtrados en la lectura): {len(df_casos):,}")
     log_memory_usage()
 
     # 3. PROCESAMIENTO
@@ -188,26 +199,25 @@ def run_step_2_main():
     log_message("  3/5 Procesando lógica de negocio (IDs, Fechas)...")
 
     df_casos['numero'] = df_casos['numero'].astype(str)
-    # Lógica de caso original
-    casos_originales = df_casos[~df_casos['numero'].str.contains('/INC', na=False, case=False)][['numero', 'FechaIngreso']]
-    casos_originales = casos_originales.drop_duplicates(subset=['numero'])
-    casos_originales = casos_originales.rename(columns={'FechaIngreso': 'FechaIngresoCasoIncidente'})
-    
-    df_casos['IdCasoOriginal'] = df_casos['numero'].str.extract(r"(\d+/\d{4})")
-    
-    df_casos = pd.merge(
-        df_casos, casos_originales, 
-        left_on='IdCasoOriginal', right_on='numero', 
-        how='left', suffixes=('', '_orig')
-    )
-    if 'numero_orig' in df_casos.columns:
-        df_casos = df_casos.drop(columns=['numero_orig'])
-    df_casos['FechaIngresoOriginal'] = pd.to_datetime(df_casos['FechaIngreso'], errors='coerce')
-    del casos_originales
+    # Lógica de caso original (factorizada: una extracción por número distinto y takes posicionales)
+    src_originales = df_casos
+    if df_originales_src is not None:
+        src_originales = df_originales_src
+        src_originales['numero'] = src_originales['numero'].astype(str)
+    t_original = time.time()
+    n_numeros = attach_caso_original(df_casos, src_originales)
+    log_message(f"  -> Caso original: {n_numeros:,} números distintos para {len(df_casos):,} filas "
+                f"(regex y búsqueda {len(df_casos) / max(n_numeros, 1):.1f}x menos evaluaciones) en {time.time() - t_original:.2f}s")
+    df_casos['FechaIngresoOriginal'], _ = parse_dates(df_casos['FechaIngreso'])
+    del src_originales, df_originales_src
     gc.collect()
 
     for col in ['FechaIngreso', 'fechaactuacion', 'fechaaltaactuacion']:
-        df_casos[col] = pd.to_datetime(df_casos[col], errors='coerce')
+        # Si el Paso 1 aplicó el esquema declarado ya son fechas nativas y parse_dates no hace nada;
+        # si no, se parsea una vez por fecha distinta. Se guardan nativas: los pasos siguientes no reparsean.
+        df_casos[col], fallidas = parse_dates(df_casos[col])
+        if fallidas:
+            log_message(f"  -> ADVERTENCIA: {fallidas:,} valores de '{col}' no son fechas válidas (quedan nulos)")
 
     # --- CORRECCIÓN: FILTROS DE FECHA DESDE CONFIG ---
     fecha_start_str = filters_config.get("date_start", "2018-01-01")
@@ -235,11 +245,13 @@ def run_step_2_main():
     if df_fechadelhecho is not None:
         log_message("  4/5 Uniendo con 'fechadelhecho'...")
         df_fechadelhecho = df_fechadelhecho.rename(columns={'idcaso': 'idcaso_hecho'})
+        df_fechadelhecho = guard.check('step2.fechadelhecho', df_casos, df_fechadelhecho, 'IdCaso', 'idcaso_hecho')
         df_casos = pd.merge(
             df_casos, df_fechadelhecho, 
             left_on='IdCaso', right_on='idcaso_hecho', 
             how='left'
         )
+        guard.record('step2.fechadelhecho', len(df_casos))
         if 'idcaso_hecho' in df_casos.columns:
             df_casos = df_casos.drop(columns=['idcaso_hecho'])
         del df_fechadelhecho
@@ -250,48 +262,115 @@ def run_step_2_main():
 
     # 5. LÓGICA DE UNIDADES FISCALES
     log_message("  5/5 Aplicando lógica de Unidades Fiscales...")
+    # Kernels sobre categorías: cada operación corre sobre los valores distintos, no sobre las filas
     for col in ['fiscalia_ingreso', 'fiscalia_actual', 'fiscalia_actuacion']:
-        df_casos[col] = df_casos[col].astype(str).fillna('Sin datos')
+        df_casos[col] = fill_text(df_casos[col], 'Sin datos')
 
-    df_casos['unidadfiscal_ingreso'] = df_casos['fiscalia_ingreso']
-    df_casos['unidadfiscal_actual'] = df_casos['fiscalia_actual']
-    df_casos['unidadfiscal_actuacion'] = df_casos['fiscalia_actuacion']
+    sufijos = ['ingreso', 'actual', 'actuacion']
+    for sufijo in sufijos:
+        # Las subsedes de Orán y Tartagal son unidad fiscal propia aunque dependan de otra fiscalía
+        df_casos[f'unidadfiscal_{sufijo}'] = remap_where(df_casos[f'fiscalia_{sufijo}'], df_casos[f'oficina_{sufijo}'], SUBSEDES_UNIDAD_FISCAL)
+    for sufijo in sufijos:
+        df_casos[f'territorio_acusatorio_{sufijo}'] = map_values(df_casos[f'unidadfiscal_{sufijo}'], TERRITORIO_SUBSEDES)
+
+    # --- OPTIMIZACIÓN ---
+    check_pause()
+    df_casos = optimize_memory(df_casos)
+    gc.collect()
+    return df_casos
 
-    # Optimización usando np.select en lugar de case_when anidado
-    conds_ing = [df_casos['oficina_ingreso'] == 'Subsede ORAN', df_casos['oficina_ingreso'] == 'Subsede TARTAGAL']
-    choices_ing = ['Subsede ORAN', 'Subsede TARTAGAL']
-    df_casos['unidadfiscal_ingreso'] = np.select(conds_ing, choices_ing, default=df_casos['unidadfiscal_ingreso'])
+# --- LÓGICA PRINCIPAL ---
 
-    conds_act = [df_casos['oficina_actual'] == 'Subsede ORAN', df_casos['oficina_actual'] == 'Subsede TARTAGAL']
-    choices_act = ['Subsede ORAN', 'Subsede TARTAGAL']
-    df_casos['unidadfiscal_actual'] = np.select(conds_act, choices_act, default=df_casos['unidadfiscal_actual'])
-    
-    conds_actu = [df_casos['oficina_actuacion'] == 'Subsede ORAN', df_casos['oficina_actuacion'] == 'Subsede TARTAGAL']
-    choices_actu = ['Subsede ORAN', 'Subsede TARTAGAL']
-    df_casos['unidadfiscal_actuacion'] = np.select(conds_actu, choices_actu, default=df_casos['unidadfiscal_actuacion'])
+def run_step_2_main():
+    start_time_total = time.time()
+    setup_logging()
     
-    conds_terr_ing = [(df_casos['unidadfiscal_ingreso'] == 'Subsede ORAN') | (df_casos['unidadfiscal_ingreso'] == 'Subsede TARTAGAL')]
-    df_casos['territorio_acusatorio_ingreso'] = np.select(conds_terr_ing, ['Orán Tartagal'], default=df_casos['unidadfiscal_ingreso'])
+    log_message("[Paso 2] Motor de Procesamiento Iniciado.")
+    log_memory_usage()
     
-    conds_terr_act = [(df_casos['unidadfiscal_actual'] == 'Subsede ORAN') | (df_casos['unidadfiscal_actual'] == 'Subsede TARTAGAL')]
-    df_casos['territorio_acusatorio_actual'] = np.select(conds_terr_act, ['Orán Tartagal'], default=df_casos['unidadfiscal_actual'])
+    config = load_config()
+    if not config:
+        log_message("ERROR FATAL: Configuración inválida.")
+        return
+
+    paths_config = config.get('paths', {})
+    filters_config = config.get('filters', {})
+
+    loaded_dir = paths_config.get('intermediate_loaded')
+    processed_dir = paths_config.get('intermediate_processed')
+    os.makedirs(processed_dir, exist_ok=True)
     
-    conds_terr_actu = [(df_casos['unidadfiscal_actuacion'] == 'Subsede ORAN') | (df_casos['unidadfiscal_actuacion'] == 'Subsede TARTAGAL')]
-    df_casos['territorio_acusatorio_actuacion'] = np.select(conds_terr_actu, ['Orán Tartagal'], default=df_casos['unidadfiscal_actuacion'])
+    input_files_used = []
 
-    # --- OPTIMIZACIÓN ---
+    # 1. CARGA DE DATOS
     check_pause()
-    df_casos = optimize_memory(df_casos)
+    log_message("  1/5 Cargando archivos Parquet...")
+    
+    f1 = os.path.join(loaded_dir, 'CasosActuacionesInquisitivo.parquet')
+    f2 = os.path.join(loaded_dir, 'CasosActuacionesAcusatorio.parquet')
+    f3 = os.path.join(loaded_dir, 'fechadelhecho.parquet')
+    
+    # Si los extractos están particionados por año, se leen solo los años de la ventana configurada
+    year_start = pd.to_datetime(filters_config.get("date_start", "2018-01-01")).year
+    year_end = pd.to_datetime(filters_config.get("date_end", "2025-12-31")).year
+    year_filters = [(PARTITION_COL, '>=', year_start), (PARTITION_COL, '<=', year_end)]
+    if os.path.isdir(f1) or os.path.isdir(f2):
+        log_message(f"  -> Extractos particionados: leyendo años {year_start}-{year_end}")
+    
+    # Los anulados se descartan en la lectura (los nulos se conservan, igual que con '!=' en pandas)
+    no_anulados = (pc.field('estadocaso') != 'Anulado') | pc.field('estadocaso').is_null()
+    def casos_filter(path):
+        if os.path.isdir(path):
+            return pq.filters_to_expression(year_filters) & no_anulados
+        return no_anulados
+    
+    # El caso original de un incidente puede ser de un año anterior a la ventana (o, en el modo
+    # fuera de memoria, de otro balde): para esa búsqueda se leen solo 'numero' y la fecha
+    out_of_core = bucket_settings(config, processed_dir)
+    df_originales_src = None
+    if out_of_core is not None or os.path.isdir(f1) or os.path.isdir(f2):
+        narrow_cols = ['numero', 'FechaIngreso', 'fechaingreso']
+        hasta_fin = pq.filters_to_expression([(PARTITION_COL, '<=', year_end)]) & no_anulados
+        partes = [safe_load(f, columns=narrow_cols, filters=hasta_fin if os.path.isdir(f) else no_anulados)
+                  for f in (f1, f2)]
+        partes = [p.rename(columns={'fechaingreso': 'FechaIngreso'}) if p is not None else None for p in partes]
+        if all(p is not None for p in partes):
+            df_originales_src = pd.concat(partes, ignore_index=True)
+
+    output_path = os.path.join(processed_dir, 'data_casos_processed.parquet')
+    if out_of_core is not None:
+        ok = run_step_2_buckets(out_of_core, f1, f2, f3, casos_filter, df_originales_src, filters_config,
+                                output_path, input_files_used, config.get('joins'))
+        if ok:
+            log_message(f"--- [Paso 2] FINALIZADO CORRECTAMENTE ({time.time() - start_time_total:.2f}s) ---")
+        return ok
+
+    df_inquisitivo = safe_load(f1, filters=casos_filter(f1))
+    df_acusatorio = safe_load(f2, filters=casos_filter(f2))
+    df_fechadelhecho = safe_load(f3, log_error=False) 
+    
+    if df_inquisitivo is None or df_acusatorio is None:
+        log_message("ERROR CRITICO: Faltan archivos de casos (Inquisitivo o Acusatorio).")
+        return
+    
+    input_files_used.extend(["CasosActuacionesInquisitivo.parquet", "CasosActuacionesAcusatorio.parquet"])
+    if df_fechadelhecho is not None:
+        input_files_used.append("fechadelhecho.parquet")
+    else:
+        log_message("[Paso 2] ADVERTENCIA: No se encontró 'fechadelhecho.parquet'. Se continuará sin él.")
+
+    guard = JoinGuard(config.get('joins'), log=log_message)
+    df_casos = process_casos(df_inquisitivo, df_acusatorio, df_originales_src, df_fechadelhecho, filters_config, guard)
+    del df_inquisitivo, df_acusatorio, df_originales_src, df_fechadelhecho
     gc.collect()
 
     # 6. GUARDADO FINAL
     log_message("  -> Guardando resultado final...")
-    output_path = os.path.join(processed_dir, 'data_casos_processed.parquet')
     
     try:
         df_casos.to_parquet(output_path, index=False, engine='pyarrow')
         log_message(f"  ¡Éxito! Archivo guardado: {output_path}")
-        save_metrics(df_casos, output_path, input_files_used)
+        save_metrics(df_casos, output_path, input_files_used, joins=guard.records)
     except Exception as e:
         log_message(f"  ERROR FATAL al guardar: {e}")
         return False
@@ -301,6 +380,62 @@ def run_step_2_main():
     log_memory_usage()
     return True
 
+# --- MODO FUERA DE MEMORIA (baldes por IdCaso) ---
+
+def process_bucket(work_dir, bucket, filters_config, joins_config):
+    """Procesa un balde de IdCaso y deja su salida en disco. Corre en un proceso hijo si workers > 1."""
+    guard = JoinGuard(joins_config, log=log_message)
+    df_casos = process_casos(
+        read_bucket(work_dir, 'inquisitivo', bucket),
+        read_bucket(work_dir, 'acusatorio', bucket),
+        pd.read_parquet(os.path.join(work_dir, 'originales.parquet')),
+        read_bucket(work_dir, 'fechadelhecho', bucket),
+        filters_config, guard)
+    out_path = bucket_path(work_dir, 'salida', bucket)
+    df_casos.to_parquet(out_path, index=False, engine='pyarrow')
+    return {"rows": len(df_casos), "memory_mb": df_casos.memory_usage(deep=True).sum() / 1024**2, "joins": guard.records}
+
+def run_step_2_buckets(out_of_core, f1, f2, f3, casos_filter, df_originales_src, filters_config, output_path, input_files_used,
+                       joins_config=None):
+    """
+    Reparte los extractos por hash de IdCaso en N baldes de disco, procesa cada balde con la
+    misma lógica (process_casos) y concatena las salidas. Las operaciones de grupo del paso son
+    por caso; la única búsqueda entre casos (caso original) usa la tabla angosta global.
+    """
+    n, work_dir = out_of_core['buckets'], out_of_core['dir']
+    if not os.path.exists(f1) or not os.path.exists(f2) or df_originales_src is None:
+        log_message("ERROR CRITICO: Faltan archivos de casos (Inquisitivo o Acusatorio).")
+        return False
+    log_message(f"  -> Modo fuera de memoria: {n} baldes por IdCaso, {out_of_core['workers']} procesos ({work_dir})")
+    clear_work_dir(work_dir)
+    try:
+        t_split = time.time()
+        for name, path in (('inquisitivo', f1), ('acusatorio', f2)):
+            key = key_column(path, ['IdCaso', 'idcaso'])
+            rows = split_parquet(path, key, n, work_dir, name, filters=casos_filter(path))
+            log_message(f"    [BALDES] {os.path.basename(path)}: {rows:,} filas repartidas")
+        input_files_used.extend(["CasosActuacionesInquisitivo.parquet", "CasosActuacionesAcusatorio.parquet"])
+        if os.path.exists(f3):
+            split_parquet(f3, key_column(f3, ['idcaso', 'IdCaso']), n, work_dir, 'fechadelhecho')
+            input_files_used.append("fechadelhecho.parquet")
+        else:
+            log_message("[Paso 2] ADVERTENCIA: No se encontró 'fechadelhecho.parquet'. Se continuará sin él.")
+        df_originales_src['numero'] = df_originales_src['numero'].astype(str)
+        df_originales_src.to_parquet(os.path.join(work_dir, 'originales.parquet'), index=False, engine='pyarrow')
+        log_message(f"    [BALDES] Reparto en {time.time() - t_split:.2f}s")
+
+        stats = run_buckets(process_bucket, [(work_dir, b, filters_config, joins_config) for b in range(n)], out_of_core['workers'])
+        check_pause()
+        log_message("  -> Guardando resultado final (concatenando baldes)...")
+        rows = concat_buckets([bucket_path(work_dir, 'salida', b) for b in range(n)], output_path)
+        peak_mb = max((st['memory_mb'] for st in stats), default=0)
+        log_message(f"  ¡Éxito! Archivo guardado: {output_path} ({rows:,} filas, pico por balde {peak_mb:.1f} MB)")
+        save_metrics(preview_frame(output_path), output_path, input_files_used, rows=rows, memory_mb=peak_mb,
+                     joins=combine_join_records(st['joins'] for st in stats))
+        return True
+    finally:
+        clear_work_dir(work_dir)
+
 if __name__ == "__main__":
     with open(RUNNING_FLAG, 'w') as f: f.write("running")
     try:
@@ -7,8 +7,21 @@ import sys
 import psutil
 import gc
 import json 
+import shutil
 import traceback 
 from datetime import datetime 
+import pyarrow as pa
+import pyarrow.dataset as ds
+from etl_loader import load_parquet, ConcurrentLoads, ready
+from etl_kernels import apply_on_categories, strip_text, top1_per_group
+from etl_audiencias import AudienciaDetector
+from etl_rules import load_rules, rule_versions, rules_metadata, write_parquet, log_rule_changes
+from etl_refcache import load_reference_sheets
+from etl_personas import derive_personas_tables, imputados_por_caso, PERSONAS_FILE
+from etl_atlas import case_columns, write_star, write_star_buckets, remove_star
+from etl_join import KeyIndex, JoinGuard, join_left, attach, combine_join_records, phase_monitor
+from etl_buckets import (bucket_settings, key_column, split_parquet, split_frame, read_bucket, bucket_path, run_buckets,
+                         concat_buckets, iter_unified_tables, preview_frame, clear_work_dir)
 
 # --- Constantes ---
 LOG_DIR = "logs"
@@ -18,24 +31,14 @@ PAUSE_FILE = os.path.join(LOG_DIR, "step_3.pause")
 RUNNING_FLAG = os.path.join(LOG_DIR, "step_3.running")
 METRICS_FILE = os.path.join(LOG_DIR, "step_3_metrics.json")
 CONFIG_FILE = 'config.json'
-
-# --- Listas de Lógica de Negocio ---
-PALABRAS_EXCLUIR_AUDIENCIA = [
-    "a favor de suspensión", "comunicación", "comunicación de fecha",
-    "comunicación de fecha de audiencia", "dejar sin efecto audiencia",
-    "deje sin efecto", "designación de audiencia", "entrevista",
-    "fija fecha", "fija nueva audiencia", "gessel", "memorial",
-    "mpf solicita se convoque", "notificación", "notificación de audiencia",
-    "notifica audiencia", "notifica reprogramación",
-    "pjn notifica link de audiencia", "pjn suspende","notifica fecha de audiencia",
-    "breves notas sustitutivas",
-    "postergación de audiencia", "resolución", "solicitud",
-    "solicita audiencia", "suspende audiencia", "suspende/posterga audiencia",
-    "suspensión de audiencia", "vista","notifica fecha de audiencia","informe por audiencia","pjn fija audiencia",
-    "mpf deja sin efecto medida de prueba/audiencia","pjn celebra audiencia para obtención de adn",
-    "dictamen en contra de audiencia","dictamen a favor",	
-    "mpf ordena transcripción de audiencia"
-]
+ATLAS_PARTITION_COLS = ['descripcion_sistemaprocesal', 'jurisdiccion_para_implementacion']
+ATLAS_SORT_COLS = ['IdCaso', 'FechaIngreso']
+DEFAULT_ATLAS_ROW_GROUP_SIZE = 100000
+PERSONAS_COLS = ['IdCaso', 'IdPersona']
+VICTIMAS_COLS = ['idcaso', 'rol_persona_descripcion', 'cantidad']
+DEFAULT_CACHE_DIRNAME = '_cache'
+AUDIENCIA_RULES = 'exclusiones_audiencia' # rules/exclusiones_audiencia.json: palabra clave y frases de exclusión
+CASO_COMPLEJO_PREFIX = 'Delitos complejos' # Libros de referencia de Caso Complejo en la carpeta raw
 
 # --- Funciones de Soporte ---
 def setup_logging():
@@ -56,29 +59,105 @@ def check_pause():
         while os.path.exists(PAUSE_FILE): time.sleep(1)
         log_message("[Reanudar] Continuando...")
 
-def load_paths():
-    if not os.path.exists(CONFIG_FILE): return None
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f).get('paths')
+def load_config():
+    if not os.path.exists(CONFIG_FILE): return {}
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f)
 
-def safe_load(path, log_error=True):
+def safe_load(path, log_error=True, columns=None, filters=None):
     if not os.path.exists(path):
         if log_error: log_message(f"WARN: No encontrado {path}")
         return None
-    try: return pd.read_parquet(path)
+    try: return load_parquet(path, columns=columns, filters=filters, log=log_message)
     except Exception as e:
         log_message(f"ERROR leyendo {path}: {e}"); return None
 
-def save_metrics(df, output_path, inputs):
+def save_metrics(df, output_path, inputs, rows=None, memory_mb=None, joins=None, load_timings=None, star=None):
+    # En el modo fuera de memoria df es una vista previa: se informan filas totales y pico por balde.
+    # joins: predicción y filas reales de cada cruce (JoinGuard.records)
+    # load_timings: duración, espera y filas de cada carga (ConcurrentLoads.timings)
+    # star: layout del Atlas estrella (etl_atlas), si se escribió
     preview = df.head(5).astype(str).to_dict(orient='records')
     metrics = {
-        "rows": len(df), "columns": len(df.columns),
-        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2, 2),
+        "rows": len(df) if rows is None else rows, "columns": len(df.columns),
+        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2 if memory_mb is None else memory_mb, 2),
         "columns_list": list(df.columns),
         "output_file": output_path, "input_files": inputs,
+        "joins": joins or [],
+        "load_timings": load_timings or {},
+        "star": star,
         "preview": preview, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
     with open(METRICS_FILE, 'w', encoding='utf-8') as f: json.dump(metrics, f, indent=2)
 
+def load_imputados(loaded_dir):
+    """
+    Imputados distintos por caso (IdCaso, imputados) desde la tabla derivada de personas,
+    que se deriva acá si falta o quedó vieja. Si no se puede derivar se cuenta sobre las
+    columnas IdCaso/IdPersona del archivo completo.
+    """
+    try:
+        tables = derive_personas_tables(loaded_dir, log=log_message)
+    except Exception as e:
+        log_message(f"WARN: No se pudieron derivar las tablas de personas ({e}); se lee {PERSONAS_FILE}")
+        df_personas = safe_load(os.path.join(loaded_dir, PERSONAS_FILE), log_error=False, columns=PERSONAS_COLS)
+        return None if df_personas is None else imputados_por_caso(df_personas)
+    if tables is None:
+        return None
+    return safe_load(tables['imputados'])
+
+def resolve_cache_dir(config, loaded_dir):
+    """Carpeta de cachés persistentes (sección 'cache' del config); None si están desactivados."""
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', True):
+        return None
+    return cache_config.get('dir') or os.path.join(loaded_dir, DEFAULT_CACHE_DIRNAME)
+
+def find_caso_complejo_workbooks(raw_dir):
+    """
+    Libros de referencia de Caso Complejo ('Delitos complejos ...xlsx' en la carpeta raw).
+    Solo se listan: la regla por tipo de delito y actuación que los usaría necesita columnas
+    (idtipodelito) que el Atlas todavía no trae, así que no se leen ni viajan a los baldes.
+    """
+    if not os.path.isdir(raw_dir):
+        return []
+    return sorted(f for f in os.listdir(raw_dir)
+                  if f.lower().startswith(CASO_COMPLEJO_PREFIX.lower()) and f.lower().endswith(('.xlsx', '.xls')))
+
+def atlas_outputs(atlas_config):
+    """(archivo ancho, par estrella) según la sección 'atlas' del config; al menos uno de los dos."""
+    star = atlas_config.get('star', False)
+    wide = atlas_config.get('wide', True)
+    if not wide and not star:
+        log_message("WARN: atlas.wide y atlas.star apagados: se escribe el Atlas ancho")
+        wide = True
+    return wide, star
+
+def write_atlas_dataset(table, dataset_path, row_group_size, basename_template='part-{i}.parquet', clear=True):
+    """
+    Escribe el Atlas (tabla Arrow) como dataset Hive particionado por sistema procesal y
+    jurisdicción de implementación, ordenado por IdCaso/FechaIngreso dentro de cada partición.
+    Así el Paso 4 abre solo la partición Acusatorio y cada row group cubre un rango acotado
+    de casos. En el modo fuera de memoria se llama una vez por balde (clear=False y un
+    basename distinto por balde).
+    """
+    if clear and os.path.isdir(dataset_path): shutil.rmtree(dataset_path)
+    sort_cols = [c for c in ATLAS_SORT_COLS if c in table.column_names]
+    if sort_cols:
+        table = table.sort_by([(c, 'ascending') for c in sort_cols]) # Estable, nulos al final
+    partitioning = ds.partitioning(
+        pa.schema([(c, pa.string()) for c in ATLAS_PARTITION_COLS]), flavor='hive')
+    # Las columnas de partición viajan como texto en la ruta; la categoría se recupera al leer
+    for c in ATLAS_PARTITION_COLS:
+        idx = table.schema.get_field_index(c)
+        table = table.set_column(idx, c, table[c].cast(pa.string()))
+    ds.write_dataset(table, dataset_path, format='parquet', partitioning=partitioning,
+                     max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, 10000),
+                     existing_data_behavior='overwrite_or_ignore', preserve_order=True,
+                     basename_template=basename_template)
+    if clear:
+        n_parts = sum(1 for _, _, files in os.walk(dataset_path) for f in files if f.endswith('.parquet'))
+        log_message(f"  -> Atlas particionado: {dataset_path} ({n_parts} archivos, orden {'/'.join(sort_cols)})")
+
 def optimize_memory(df):
     log_message("  ⚡ Optimizando memoria...")
     for col in df.select_dtypes(include=['object']).columns:
@@ -89,105 +168,91 @@ def optimize_memory(df):
                 df[col] = df[col].astype('category')
     return df
 
-# --- Main ---
-def run_step_3_main():
-    start_time_total = time.time()
-    setup_logging()
-    log_message("[Paso 3] Construcción Base Atlas (Mixto+Acusatorio)...")
-    
-    paths = load_paths()
-    processed_dir = paths.get('intermediate_processed')
-    loaded_dir = paths.get('intermediate_loaded')
-    raw_dir = paths.get('raw_data')
-    analytical_dir = paths.get('intermediate_analytical')
-    os.makedirs(analytical_dir, exist_ok=True)
-    
-    input_files_used = []
-
-    # 1. CARGA BASE (Paso 2)
-    check_pause()
-    log_message("  1/7 Cargando Casos Base (Paso 2)...")
-    df = safe_load(os.path.join(processed_dir, 'data_casos_processed.parquet'))
-    if df is None: return
-    input_files_used.append("data_casos_processed.parquet")
-    
-    # --- LIMPIEZA WHITESPACE ---
-    cols_to_strip = ['jurisdiccion_ingreso', 'jurisdiccion_actual', 'oficina_ingreso', 'oficina_actual', 'fiscalia_ingreso', 'fiscalia_actual']
-    for col in cols_to_strip:
-        if col in df.columns:
-            df[col] = df[col].astype(str).str.strip()
-    log_message("  -> Limpieza agresiva de whitespace en columnas de Jurisdicción aplicada.")
-
-    # 2. CARGA REFERENCIAS BÁSICAS
-    log_message("  2/7 Cargando Tablas de Referencia...")
-    df_delitos = safe_load(os.path.join(loaded_dir, 'df_delitos.parquet'), log_error=False)
-    df_ult_act = safe_load(os.path.join(loaded_dir, 'CasosUltimaActuacionEstado.parquet'), log_error=False)
-    df_personas_full = safe_load(os.path.join(loaded_dir, 'df_persona_actuacion_delito.parquet'), log_error=False)
-    df_victimas = safe_load(os.path.join(loaded_dir, 'victimas_imputados.parquet'), log_error=False)
-    
-    excel_path = os.path.join(raw_dir, "TipoActuacionAcusatorioUNISA_Relacionales.xlsx")
-    try:
-        df_estados_unisa = pd.read_excel(excel_path, sheet_name="Relacional")
-        df_orden_unisa = pd.read_excel(excel_path, sheet_name="OrdenUnisa")
-        input_files_used.append("TipoActuacionAcusatorioUNISA_Relacionales.xlsx")
-    except Exception as e:
-        log_message(f"ERROR CRITICO: No se pudo leer Excel Relacional. {e}")
-        return
+def enrich_by_case(df, df_delitos, df_ult_act, df_imputados, df_victimas, guard):
+    """
+    Puntos 3 a 5a: agrega a la base las columnas de delitos, última actuación y los conteos
+    de imputados (df_imputados: tabla derivada IdCaso -> imputados) y víctimas. Mismo
+    resultado que la cadena de pd.merge(how='left') por IdCaso, pero sin copiar la tabla
+    ancha en cada cruce. Cada cruce pasa antes por el
+    control de cardinalidad (guard). Las tablas pueden llegar como cargas pendientes
+    (ConcurrentLoads): se esperan recién al cruzarlas.
+    """
+    index = KeyIndex(df['IdCaso'])
 
     # 3. MERGE DELITOS
     check_pause()
     log_message("  3/7 Cruzando Delitos...")
+    df_delitos = ready(df_delitos)
     if df_delitos is not None:
-        df = pd.merge(df, df_delitos, on='IdCaso', how='left')
-        input_files_used.append("df_delitos.parquet")
-        del df_delitos; gc.collect()
+        df_delitos = guard.check('step3.delitos', df, df_delitos, 'IdCaso')
+        df, index = join_left(df, index, df_delitos, 'IdCaso', log=log_message, label='delitos')
+        guard.record('step3.delitos', len(df))
     
     # 4. MERGE ULTIMA ACTUACION
     check_pause()
     log_message("  4/7 Cruzando Última Actuación...")
+    df_ult_act = ready(df_ult_act)
     if df_ult_act is not None:
-        df = pd.merge(df, df_ult_act, on='IdCaso', how='left')
-        input_files_used.append("CasosUltimaActuacionEstado.parquet")
-        del df_ult_act; gc.collect()
+        df_ult_act = guard.check('step3.ultima_actuacion', df, df_ult_act, 'IdCaso')
+        df, index = join_left(df, index, df_ult_act, 'IdCaso', log=log_message, label='última actuación')
+        guard.record('step3.ultima_actuacion', len(df))
 
     # 5. MERGE IMPUTADOS y VICTIMAS + CASO COMPLEJO
     check_pause()
     log_message("  5/7 Lógica Compleja (Imputados, Víctimas y Clasificación)...")
     
     # 5a. Conteos
-    if df_personas_full is not None:
-        tImputadosporCaso = df_personas_full.groupby('IdCaso')['IdPersona'].nunique().reset_index().rename(columns={'IdPersona':'imputados'})
-        df = pd.merge(df, tImputadosporCaso, on='IdCaso', how='left')
+    df_imputados, df_victimas = ready(df_imputados), ready(df_victimas)
+    if df_imputados is not None:
+        tImputadosporCaso = df_imputados.set_index('IdCaso')['imputados']
+        df = attach(df, index, tImputadosporCaso, 'imputados')
         df['imputados'] = df['imputados'].fillna(0)
         df['imputados_complejo'] = np.where(df['imputados'] >= 3, '3 o más imputados', 'Menos de 3 imputados')
-        del tImputadosporCaso, df_personas_full
-        gc.collect()
+        del tImputadosporCaso
     
     if df_victimas is not None:
         if 'rol_persona_descripcion' in df_victimas.columns:
             tVictimasporCaso = df_victimas[df_victimas['rol_persona_descripcion'] == "Víctima"][['idcaso', 'cantidad']].drop_duplicates()
             tVictimasporCaso = tVictimasporCaso.rename(columns={'idcaso':'IdCaso', 'cantidad':'Victimas'})
-            df = pd.merge(df, tVictimasporCaso, on='IdCaso', how='left')
+            tVictimasporCaso = guard.check('step3.victimas', df, tVictimasporCaso, 'IdCaso')
+            df, index = join_left(df, index, tVictimasporCaso, 'IdCaso', log=log_message, label='víctimas')
+            guard.record('step3.victimas', len(df))
             df['Victimas'] = df['Victimas'].fillna(0)
             df['victimas_complejo'] = np.where(df['Victimas'] >= 3, '3 o más victimas', 'Menos de 3 victimas')
-        del df_victimas
-        gc.collect()
+    return df
+
+def build_atlas(df, df_delitos, df_ult_act, df_imputados, df_victimas, df_estados_unisa, df_orden_unisa, casos_complejos=None,
+                guard=None, cache_dir=None):
+    """
+    Lógica del Atlas (puntos 3 a 7) sobre un conjunto de casos ya cargado. Todos los cruces
+    y agrupamientos son por IdCaso, por eso en el modo fuera de memoria se aplica balde por balde.
+    guard (JoinGuard) controla la cardinalidad de los cruces; por defecto, políticas de fábrica.
+    casos_complejos: nombres de los libros de Caso Complejo (find_caso_complejo_workbooks).
+    cache_dir: carpeta del caché de veredictos de audiencias (None = sin caché).
+    """
+    if guard is None: guard = JoinGuard(log=log_message)
+    # --- LIMPIEZA WHITESPACE ---
+    cols_to_strip = ['jurisdiccion_ingreso', 'jurisdiccion_actual', 'oficina_ingreso', 'oficina_actual', 'fiscalia_ingreso', 'fiscalia_actual']
+    for col in cols_to_strip:
+        if col in df.columns:
+            df[col] = strip_text(df[col]) # Sobre categorías: costo proporcional a la cardinalidad
+    log_message("  -> Limpieza agresiva de whitespace en columnas de Jurisdicción aplicada.")
 
-    # 5b. Lógica Caso Complejo (Requires loading extra Excels)
+    # 3-5. Enriquecimiento por índice de IdCaso (se construye una vez; ver etl_join)
+    with phase_monitor("Cruces por IdCaso (puntos 3 a 5)", log_message):
+        df = enrich_by_case(df, df_delitos, df_ult_act, df_imputados, df_victimas, guard)
+    del df_delitos, df_ult_act, df_imputados, df_victimas; gc.collect()
+
+    # 5b. Lógica Caso Complejo
     try:
-        f_complex = os.path.join(loaded_dir, 'Delitos complejos seleccion de actuaciones - Mixto - Acusatorio - Delitos.parquet')
-        # Si no está en parquet, intentar cargar raw
-        if not os.path.exists(f_complex):
+        if not casos_complejos:
              # Dummy logic si no existen los archivos para no romper el pipeline
              log_message("WARN: No se encontraron archivos de configuración de Caso Complejo. Se saltará esta lógica.")
              df['CasoComplejo'] = 'No Complejo'
         else:
-            # Aquí iría la carga si los archivos estuvieran en Parquet. 
-            # Como fallback simple por ahora (dado que no tenemos los 4 excels convertidos a parquet individualmente en el log del paso 1, sino uno solo):
-            # Asumiremos que si no están las tablas, es No Complejo.
-            # *Implementación real requeriría leer las hojas específicas del Excel raw si no se procesaron en Step 1*
-            pass
-            
+            log_message(f"  -> Libros de Caso Complejo presentes: {casos_complejos}")
+            # *La regla por tipo de delito y actuación requiere columnas (idtipodelito) que el Atlas todavía no trae*
+
         # Lógica simplificada basada en lo disponible:
         # En R: (idtipodelito in Complex) OR (Actuacion in Complex) OR (Imputados>=3) OR (Victimas>=3)
         # Y que NO esté en DelitosDescartan.
@@ -203,28 +268,39 @@ def run_step_3_main():
     # 6. ESTADO UNISA (Jerarquía)
     check_pause()
     log_message("  6/7 Calculando Estado UNISA...")
+    df_orden_unisa = guard.check('step3.orden_unisa', df_estados_unisa, df_orden_unisa, 'EstadoUNISA', 'EstadoUnisaOrden')
     df_finaliza = pd.merge(df_estados_unisa, df_orden_unisa, left_on="EstadoUNISA", right_on="EstadoUnisaOrden", how="left")
+    guard.record('step3.orden_unisa', len(df_finaliza))
     df_finaliza['OrdenUnisa'] = pd.to_numeric(df_finaliza['OrdenUnisa'], errors='coerce').fillna(0)
     
     col_estado = 'actuacion_estadodelcaso' if 'actuacion_estadodelcaso' in df.columns else 'IdEstadoActuacion'
     # Asegurar tipos compatibles para merge
-    df[col_estado] = df[col_estado].astype(str)
+    df[col_estado] = apply_on_categories(df[col_estado], lambda v: v.astype(str))
     df_finaliza['EstadoCoiron'] = df_finaliza['EstadoCoiron'].astype(str)
 
-    df_unisa = pd.merge(df, df_finaliza, left_on=col_estado, right_on="EstadoCoiron", how='left')
-    df_unisa['ordenultimoestado'] = df_unisa.groupby('IdCaso')['OrdenUnisa'].transform('max')
-    
-    df_max = df_unisa[df_unisa['OrdenUnisa'] == df_unisa['ordenultimoestado']].copy()
-    df_max['IdActuacionUltimoEstadoUNISA'] = df_max.groupby('IdCaso')['IdActuacion'].transform('min')
-    
-    df_final_info = df_max[df_max['IdActuacion'] == df_max['IdActuacionUltimoEstadoUNISA']][
-        ['IdCaso', 'IdActuacionUltimoEstadoUNISA', 'ordenultimoestado', 'EstadoUNISA', 'fechaactuacion']
-    ].rename(columns={'fechaactuacion': 'EstadoUnisaFecha'}).drop_duplicates(subset=['IdCaso'])
+    # Solo las columnas de la decisión: el estado UNISA y su orden se buscan por estado de la actuación
+    df_unisa = df[['IdCaso', 'IdActuacion', 'fechaactuacion', col_estado]]
+    df_finaliza = guard.check('step3.estado_unisa', df_unisa, df_finaliza[['EstadoCoiron', 'OrdenUnisa', 'EstadoUNISA']],
+                              col_estado, 'EstadoCoiron')
+    df_unisa, _ = join_left(df_unisa, KeyIndex(df_unisa[col_estado]), df_finaliza, col_estado, 'EstadoCoiron',
+                            log=log_message, label='estado UNISA')
+    guard.record('step3.estado_unisa', len(df_unisa))
+
+    # Por caso: la actuación de mayor OrdenUnisa y, entre empatadas, la de menor IdActuacion
+    _, ganadoras = top1_per_group(df_unisa['IdCaso'], [df_unisa['OrdenUnisa'], df_unisa['IdActuacion']], ascending=[False, True])
+    ganadoras = ganadoras[ganadoras >= 0]
+    df_final_info = pd.DataFrame({
+        'IdCaso': df_unisa['IdCaso'].array.take(ganadoras),
+        'IdActuacionUltimoEstadoUNISA': df_unisa['IdActuacion'].array.take(ganadoras),
+        'ordenultimoestado': df_unisa['OrdenUnisa'].array.take(ganadoras),
+        'EstadoUNISA': df_unisa['EstadoUNISA'].array.take(ganadoras),
+        'EstadoUnisaFecha': df_unisa['fechaactuacion'].array.take(ganadoras),
+    })
     
-    df = pd.merge(df, df_final_info, on='IdCaso', how='left')
+    df, _ = join_left(df, KeyIndex(df['IdCaso']), df_final_info, 'IdCaso')
     df['EstadoUNISA'] = df['EstadoUNISA'].fillna("Sin Salidas")
     
-    del df_unisa, df_max, df_finaliza, df_final_info, df_estados_unisa, df_orden_unisa; gc.collect()
+    del df_unisa, df_finaliza, df_final_info, df_estados_unisa, df_orden_unisa; gc.collect()
 
     # 7. VARIABLES FINALES (Implementación, Tiempos y AUDIENCIAS)
     check_pause()
@@ -241,32 +317,203 @@ def run_step_3_main():
     
     df['descripcion_sistemaprocesal'] = np.where(df['IdSistemaProcesal'] == 2, "Acusatorio", "Mixto")
     
-    # 7b. Detector de Audiencias (REGEX)
-    log_message("    -> Detectando Audiencias (Regex)...")
+    # 7b. Detector de Audiencias (frases de exclusión, con caché por descripción)
+    log_message("    -> Detectando Audiencias...")
     if 'descripcionactuacion' in df.columns:
-        # Normalizar a minúsculas
-        desc_lower = df['descripcionactuacion'].fillna("").str.lower()
-        
-        # 1. Debe contener 'audiencia'
-        has_audiencia = desc_lower.str.contains('audiencia', regex=False)
-        
-        # 2. NO debe contener ninguna frase de exclusión
-        # Construimos patrón regex: "frase1|frase2|frase3"
-        patron_exclusion = '|'.join([p.lower() for p in PALABRAS_EXCLUIR_AUDIENCIA])
-        has_exclusion = desc_lower.str.contains(patron_exclusion, regex=True)
-        
-        df['ActuacionAudiencia'] = np.where(has_audiencia & ~has_exclusion, 'Audiencia', 'No Audiencia')
+        rules = load_rules(AUDIENCIA_RULES)
+        detector = AudienciaDetector(rules['phrases'], cache_dir, keyword=rules['keyword'], log=log_message)
+        # Se evalúa una vez por descripción distinta (o se toma del caché) y se reparte por código
+        has_audiencia = apply_on_categories(df['descripcionactuacion'], detector.classify).to_numpy(dtype=bool)
+        detector.save()
+        df['ActuacionAudiencia'] = np.where(has_audiencia, 'Audiencia', 'No Audiencia')
     else:
         df['ActuacionAudiencia'] = 'No Audiencia'
 
     df = optimize_memory(df)
+    return df
+
+# --- Main ---
+def run_step_3_main():
+    start_time_total = time.time()
+    setup_logging()
+    log_message("[Paso 3] Construcción Base Atlas (Mixto+Acusatorio)...")
+    
+    config = load_config()
+    paths = config.get('paths')
+    atlas_config = config.get('atlas', {})
+    processed_dir = paths.get('intermediate_processed')
+    loaded_dir = paths.get('intermediate_loaded')
+    raw_dir = paths.get('raw_data')
+    analytical_dir = paths.get('intermediate_analytical')
+    os.makedirs(analytical_dir, exist_ok=True)
+    
+    input_files_used = []
     output_path = os.path.join(analytical_dir, 'data_final_comparativo.parquet')
-    df.to_parquet(output_path, index=False, engine='pyarrow')
-    save_metrics(df, output_path, input_files_used)
+    dataset_path = os.path.join(analytical_dir, 'data_final_comparativo')
+
+    cache_dir = resolve_cache_dir(config, loaded_dir)
+    excel_path = os.path.join(raw_dir, "TipoActuacionAcusatorioUNISA_Relacionales.xlsx")
+    out_of_core = bucket_settings(config, analytical_dir)
+
+    # Todas las cargas independientes arrancan juntas; cada una se espera recién al usarla
+    with ConcurrentLoads(log=log_message) as loads:
+        loads.submit("TipoActuacionAcusatorioUNISA_Relacionales.xlsx", load_reference_sheets,
+                     excel_path, ["Relacional", "OrdenUnisa"], cache_dir, log=log_message)
+        if out_of_core is None:
+            loads.submit("data_casos_processed.parquet", safe_load, os.path.join(processed_dir, 'data_casos_processed.parquet'))
+            df_delitos = loads.submit("df_delitos.parquet", safe_load, os.path.join(loaded_dir, 'df_delitos.parquet'), log_error=False)
+            df_ult_act = loads.submit("CasosUltimaActuacionEstado.parquet", safe_load,
+                                      os.path.join(loaded_dir, 'CasosUltimaActuacionEstado.parquet'), log_error=False)
+            # Personas y víctimas solo alimentan conteos por caso: imputados sale de la tabla derivada
+            # (etl_personas) y de víctimas se leen únicamente las columnas necesarias
+            df_imputados = loads.submit("imputados_por_caso.parquet", load_imputados, loaded_dir)
+            df_victimas = loads.submit("victimas_imputados.parquet", safe_load,
+                                       os.path.join(loaded_dir, 'victimas_imputados.parquet'), log_error=False,
+                                       columns=VICTIMAS_COLS)
+
+        try:
+            hojas = loads.get("TipoActuacionAcusatorioUNISA_Relacionales.xlsx")
+            df_estados_unisa, df_orden_unisa = hojas["Relacional"], hojas["OrdenUnisa"]
+        except Exception as e:
+            log_message(f"ERROR CRITICO: No se pudo leer Excel Relacional. {e}")
+            return
+        casos_complejos = find_caso_complejo_workbooks(raw_dir)
+
+        if out_of_core is not None:
+            run_step_3_buckets(out_of_core, processed_dir, loaded_dir, df_estados_unisa, df_orden_unisa, casos_complejos,
+                               output_path, dataset_path, atlas_config, input_files_used + ["TipoActuacionAcusatorioUNISA_Relacionales.xlsx"],
+                               config.get('joins'), cache_dir, loads.timings())
+            log_message(f"--- [Paso 3] FINALIZADO ({time.time() - start_time_total:.2f}s) ---")
+            return
+
+        # 1. CARGA BASE (Paso 2)
+        check_pause()
+        log_message("  1/7 Cargando Casos Base (Paso 2)...")
+        df = loads.get("data_casos_processed.parquet")
+        if df is None: return
+        input_files_used.append("data_casos_processed.parquet")
+        
+        # 2. CARGA REFERENCIAS BÁSICAS (ya en curso: build_atlas espera cada tabla al cruzarla)
+        log_message("  2/7 Cargando Tablas de Referencia...")
+        input_files_used.append("TipoActuacionAcusatorioUNISA_Relacionales.xlsx")
+
+        guard = JoinGuard(config.get('joins'), log=log_message)
+        df = build_atlas(df, df_delitos, df_ult_act, df_imputados, df_victimas, df_estados_unisa, df_orden_unisa, casos_complejos,
+                         guard, cache_dir)
+        if loads.get("df_delitos.parquet") is not None: input_files_used.append("df_delitos.parquet")
+        if loads.get("CasosUltimaActuacionEstado.parquet") is not None: input_files_used.append("CasosUltimaActuacionEstado.parquet")
+        load_timings = loads.timings()
+    del df_delitos, df_ult_act, df_imputados, df_victimas, loads
+    gc.collect()
+    log_message("    [CARGAS] " + ", ".join(f"{n}: {t.get('seconds', 0):.2f}s (espera {t.get('waited', 0):.2f}s)"
+                                          for n, t in load_timings.items()))
+
+    write_wide, write_star_pair = atlas_outputs(atlas_config)
+    rules = load_rules(AUDIENCIA_RULES)
+    log_rule_changes(output_path, rules, log=log_message)
+    if write_wide:
+        write_parquet(df, output_path, rules) # Archivo único: se mantiene para consumidores externos
+    elif os.path.exists(output_path):
+        os.remove(output_path) # El par estrella lo reemplaza: que nadie lea uno viejo
+    star = write_star(df, analytical_dir, log=log_message, rules=rule_versions(rules)) if write_star_pair else None
+    if not write_star_pair:
+        remove_star(analytical_dir)
+
+    if atlas_config.get('partitioned', False):
+        write_atlas_dataset(pa.Table.from_pandas(df, preserve_index=False), dataset_path,
+                            atlas_config.get('row_group_size', DEFAULT_ATLAS_ROW_GROUP_SIZE))
+    elif os.path.isdir(dataset_path):
+        shutil.rmtree(dataset_path) # Evita que el Paso 4 lea un dataset de una corrida anterior
+    save_metrics(df, output_path, input_files_used, joins=guard.records, load_timings=load_timings, star=star)
     
-    log_message(f"  ¡Éxito! Atlas generado: {output_path} ({len(df.columns)} columnas)")
+    log_message(f"  ¡Éxito! Atlas generado: {output_path if write_wide else analytical_dir} ({len(df.columns)} columnas)")
     log_message(f"--- [Paso 3] FINALIZADO ({time.time() - start_time_total:.2f}s) ---")
 
+# --- Modo fuera de memoria (baldes por IdCaso) ---
+def process_bucket(work_dir, bucket, df_estados_unisa, df_orden_unisa, casos_complejos, joins_config, cache_dir):
+    """Construye el Atlas de un balde de IdCaso y deja la salida en disco (proceso hijo si workers > 1)."""
+    guard = JoinGuard(joins_config, log=log_message)
+    df = build_atlas(read_bucket(work_dir, 'casos', bucket), read_bucket(work_dir, 'delitos', bucket),
+                     read_bucket(work_dir, 'ult_act', bucket), read_bucket(work_dir, 'imputados', bucket),
+                     read_bucket(work_dir, 'victimas', bucket), df_estados_unisa, df_orden_unisa, casos_complejos,
+                     guard, cache_dir)
+    df.to_parquet(bucket_path(work_dir, 'salida', bucket), index=False, engine='pyarrow')
+    return {"rows": len(df), "memory_mb": df.memory_usage(deep=True).sum() / 1024**2, "joins": guard.records,
+            "case_columns": case_columns(df, log=log_message)}
+
+def run_step_3_buckets(out_of_core, processed_dir, loaded_dir, df_estados_unisa, df_orden_unisa, casos_complejos,
+                       output_path, dataset_path, atlas_config, input_files_used, joins_config=None, cache_dir=None,
+                       load_timings=None):
+    """
+    Reparte la base del Paso 2 y las tablas de referencia por hash de IdCaso, construye el
+    Atlas balde por balde y concatena. El dataset particionado, si está activo, se escribe
+    desde los baldes ya unificados (ordenado por IdCaso/FechaIngreso dentro de cada archivo).
+    El par estrella usa las columnas de caso que resultaron constantes en todos los baldes.
+    """
+    n, work_dir = out_of_core['buckets'], out_of_core['dir']
+    f_casos = os.path.join(processed_dir, 'data_casos_processed.parquet')
+    if not os.path.exists(f_casos):
+        log_message(f"WARN: No encontrado {f_casos}")
+        return
+    log_message(f"  -> Modo fuera de memoria: {n} baldes por IdCaso, {out_of_core['workers']} procesos ({work_dir})")
+    clear_work_dir(work_dir)
+    try:
+        check_pause()
+        log_message("  1/7 Repartiendo Casos Base y Referencias en baldes...")
+        inputs = [('casos', f_casos, ['IdCaso'], None),
+                  ('delitos', os.path.join(loaded_dir, 'df_delitos.parquet'), ['IdCaso'], None),
+                  ('ult_act', os.path.join(loaded_dir, 'CasosUltimaActuacionEstado.parquet'), ['IdCaso'], None),
+                  ('victimas', os.path.join(loaded_dir, 'victimas_imputados.parquet'), ['idcaso', 'IdCaso'], VICTIMAS_COLS)]
+        for name, path, keys, columns in inputs:
+            if not os.path.exists(path):
+                continue
+            rows = split_parquet(path, key_column(path, keys), n, work_dir, name, columns=columns)
+            log_message(f"    [BALDES] {os.path.basename(path)}: {rows:,} filas repartidas")
+            if name in ('casos', 'delitos', 'ult_act'):
+                input_files_used.append(os.path.basename(path))
+        df_imputados = load_imputados(loaded_dir) # Tabla chica (un registro por caso): se reparte desde memoria
+        if df_imputados is not None:
+            split_frame(df_imputados, 'IdCaso', n, work_dir, 'imputados')
+            log_message(f"    [BALDES] imputados_por_caso: {len(df_imputados):,} filas repartidas")
+            del df_imputados
+
+        stats = run_buckets(process_bucket, [(work_dir, b, df_estados_unisa, df_orden_unisa, casos_complejos, joins_config, cache_dir)
+                                             for b in range(n)],
+                            out_of_core['workers'])
+        salidas = [bucket_path(work_dir, 'salida', b) for b in range(n)]
+        write_wide, write_star_pair = atlas_outputs(atlas_config)
+        rules = load_rules(AUDIENCIA_RULES)
+        log_rule_changes(output_path, rules, log=log_message)
+        if write_wide:
+            rows = concat_buckets(salidas, output_path, metadata=rules_metadata(rules)) # Archivo único: se mantiene para consumidores externos
+        else:
+            rows = sum(st['rows'] for st in stats)
+            if os.path.exists(output_path): os.remove(output_path)
+        star = None
+        if write_star_pair:
+            case_cols = [c for c in stats[0]['case_columns'] if all(c in st['case_columns'] for st in stats)]
+            star = write_star_buckets(salidas, os.path.dirname(output_path), case_cols, work_dir, log=log_message,
+                                      rules=rule_versions(rules))
+        else:
+            remove_star(os.path.dirname(output_path))
+
+        if atlas_config.get('partitioned', False):
+            row_group_size = atlas_config.get('row_group_size', DEFAULT_ATLAS_ROW_GROUP_SIZE)
+            if os.path.isdir(dataset_path): shutil.rmtree(dataset_path)
+            for b, table in enumerate(iter_unified_tables(salidas)):
+                write_atlas_dataset(table, dataset_path, row_group_size, basename_template=f'part-b{b:03d}-{{i}}.parquet', clear=False)
+            log_message(f"  -> Atlas particionado: {dataset_path} ({n} baldes)")
+        elif os.path.isdir(dataset_path):
+            shutil.rmtree(dataset_path)
+
+        peak_mb = max((st['memory_mb'] for st in stats), default=0)
+        df_preview = preview_frame(output_path if write_wide else salidas[0])
+        save_metrics(df_preview, output_path, input_files_used, rows=rows, memory_mb=peak_mb,
+                     joins=combine_join_records(st['joins'] for st in stats), load_timings=load_timings, star=star)
+        log_message(f"  ¡Éxito! Atlas generado: {output_path if write_wide else os.path.dirname(output_path)} ({len(df_preview.columns)} columnas, {rows:,} filas, pico por balde {peak_mb:.1f} MB)")
+    finally:
+        clear_work_dir(work_dir)
+
 if __name__ == "__main__":
     os.makedirs(LOG_DIR, exist_ok=True)
     with open(RUNNING_FLAG, 'w') as f: f.write("running")
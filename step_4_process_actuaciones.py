@@ -7,7 +7,7 @@ cruza con personas preservando actuaciones sin persona (Lógica R: Union All),
 y calcula el 'EstadoInforme'.
 """
 import pandas as pd
-import numpy as np
+import pyarrow.parquet as pq
 import os
 import time
 import sys
@@ -16,6 +16,15 @@ import gc
 import json 
 from datetime import datetime
 import traceback
+from etl_loader import load_parquet, ConcurrentLoads
+from etl_kernels import apply_on_categories, parse_dates
+from etl_rules import compile_rules, rules_metadata, write_parquet, log_rule_changes
+from etl_nested import nest_frame, nested_enabled, nested_layout, nested_metadata
+from etl_join import JoinGuard, join_tagged, combine_join_records
+from etl_atlas import load_atlas, split_atlas, atlas_source
+from etl_personas import derive_personas_tables, load_personas_for, PERSONAS_FILE
+from etl_buckets import (bucket_settings, split_parquet, read_bucket, bucket_path, run_buckets,
+                         concat_buckets, preview_frame, clear_work_dir)
 
 # --- Constantes ---
 LOG_DIR = "logs"
@@ -25,37 +34,8 @@ PAUSE_FILE = os.path.join(LOG_DIR, "step_4.pause")
 RUNNING_FLAG = os.path.join(LOG_DIR, "step_4.running")
 METRICS_FILE = os.path.join(LOG_DIR, "step_4_metrics.json")
 CONFIG_FILE = 'config.json'
-
-# --- Mapeo de Estados ---
-ESTADOS_MAP = {
-    "SentenciaCondenatoriaJuicio": ["Sentencia Condenatoria -juicio oral- (art. 305, CPPF)", "Sentencia Condenatoria Firme -juicio oral- (art. 305, CPPF)", "Sentencia Condenatoria (art. 305, CPPF)", "Sentencia Condenatoria Firme (art. 305, CPPF)"],
-    "SentenciaCondenatoriaAcuerdoPleno": ["Sentencia Condenatoria -acuerdo pleno- (art. 325, CPPF)", "Sentencia Condenatoria Firme -acuerdo pleno- (art. 325, CPPF)", "Sentencia Condenatoria (art. 325, CPPF)", "Sentencia Condenatoria Firme (art. 325, CPPF)", "Acuerdo Pleno (Art. 323, CPPF)"],
-    "SentenciaAbsolutoriaJuicio": ["Sentencia Absolutoria -juicio oral- (art. 305, CPPF)", "Sentencia Absolutoria Firme -juicio oral- (art. 305, CPPF)", "Sentencia Absolutoria (art. 305, CPPF)", "Sentencia Absolutoria Firme (art. 305, CPPF)"],
-    "SentenciaAbsolutoriaAcuerdoPleno": ["Sentencia Absolutoria -acuerdo pleno- (art. 325, CPPF)", "Sentencia Absolutoria Firme -acuerdo pleno- (art. 325, CPPF)", "Sentencia Absolutoria (art. 325, CPPF)", "Sentencia Absolutoria Firme (art. 325, CPPF)"],
-    "Formalización": ["Audiencia de Formalización de la investigación preparatoria (Art. 258, CPPF)"],
-    "Acusación Fiscal": ["Acusación Fiscal (Art. 274, CPPF)", "Cierre de la investigación preparatoria por Acusación Fiscal (Arts. 268 y 274, CPPF)", "Audiencia de control de la Acusación (Art. 279, CPPF)", "Cierre de la IPP por Acusación Fiscal junto a Querella (Art. 268, CPPF)", "Remisión de Acusación Fiscal a Oficina Judicial (art. 276, últ., párr., CPPF) "],
-    "Archivo - Aplicación": ["Archivo (Art. 250, CPPF)", "Archivo en caso con autores ignorados (Art. 250, CPPF)"],
-    "Archivo - Firme": ["Fiscal revisor confirma decisión de archivo (art. 251, 3ero. Párr., CPPF)", "Confirmación de archivo (art. 251, 3ero. Párr., CPPF)", "Vencimiento de plazo de la víctima para revisión de archivo (Art 252, 2do párr., CPPF)"],
-    "Desestimación - Aplicación": ["Desestimación por inexistencia de delito (Art. 249, CPPF)"],
-    "Desestimación - Firme": ["Fiscal revisor confirma decisión de desestimación (art. 251, 3ero. Párr., CPPF)", "Confirmación de desestimación  (art. 251, 3ero. Párr., CPPF)", "Vencimiento de plazo de la víctima para revisión de desestimación (Art 252, 2do párr., CPPF)"],
-    "Criterio Oportunidad - Aplicación": ["Aplicación de Criterio de Oportunidad por insignificancia (art. 31, inc. a, CPPF)", "Aplicación de Criterio de Oportunidad por insignificancia (art. 31, inc a, CPPF)", "Aplicación de Criterio de Oportunidad por insignificancia con autores ignorados (art. 31, inc. a)", "Aplicación de Criterio de Oportunidad por menor relevancia (art. 31, inc. b, CPPF)", "Aplicación de Criterio de Oportunidad por pena natural (art. 31, inc. c, CPPF)", "Aplicación de Criterio de Oportunidad por pena que carece de importancia (art. 31, inc. d, CPPF)"],
-    "Criterio Oportunidad - Firme": ["Confirmación de aplicación de criterio de oportunidad (art. 251, 3ero. Párr., CPPF)", "Fiscal revisor confirma criterio de oportunidad por insignificancia (art. 251, 3er párr, CPPF)", "Fiscal revisor confirma criterio de oportunidad por menor relevancia (art. 251, 3er párr., CPPF)", "Fiscal revisor confirma criterio de oportunidad por pena natural (art. 251, 3er párr., CPPF)", "Fiscal revisor confirma Criterio de Oportunidad por pena que carece importancia (art. 251, 3er párr., CPPF)", "Vencimiento de plazo de la víctima para revisión criterio de oportunidad (Art 252, 2do párr., CPPF)"],
-    "Criterio Oportunidad- Rechazado por el Fiscal Revisor": ["Decisión que rechaza revisión de víctima por aplicación de crit. de oport. (252, 4to. párr., CPPF)"],
-    "Sobreseimiento": ["Resolución de Sobreseimiento por extinción de la acción penal (Arts. 269, inc. F, y 273, CPPF)", "Resolución de Sobreseimiento por falta de pruebas para juicio (Arts. 269, inc. E, y 273, CPPF)", "Resolución de Sobreseimiento por no ser el autor o partícipe (Arts. 269, inc. C y 273, CPPF)", "Resolución que hace lugar a sobreseimiento (Arts. 272 y 279 inc. c., CPPF)", "Resolución de Sobreseimiento por Hecho Atípico (art. 336, inc. 3, CPPN)", "Sobreseimiento por agotamiento de la investigación (Arts. 269, inc. E, y 273, CPPF)", "Sobreseimiento por extinción de la acción penal (Arts. 269, inc. F, y 273, CPPF)", "Sobreseimiento por hecho no cometido (Arts. 269, inc. A, y 273, CPPF)", "Sobreseimiento por justificación, inculpabilidad o ausencia punibilidad (Arts. 269, inc. D, y 273, CPPF)", "Sobreseimiento por no adecuarse a figura legal (Arts. 269, inc. B, y 273, CPPF)", "Sobreseimiento por no tomar parte en el hecho (Arts. 269, inc. C y 273, CPPF)"],
-    "Sobreseimiento por Criterio de oportunidad": ["Sobreseimiento por aplicación de criterio de oportunidad (Arts. 269, inc. G, y 273, CPPF)"],
-    "Conciliación": ["Resolución que homologa conciliación (Arts. 34 y 279 inc. d, CPPF)", "Resolución que homologa conciliación (art. 34, CPPF)"],
-    "Sobreseimiento por Conciliación": ["Resolución de sobreseimiento por acuerdo conciliatorio", "Sobreseimiento por acuerdo conciliatorio (Arts. 269, inc. G, y 273, CPPF)"],
-    "Suspensión de proceso a prueba": ["Acuerdo de suspensión del proceso a prueba (art. 35, 4to. párr, CPPF)", "Suspensión del proceso a prueba en plazo de cumplimiento"],
-    "Sobreseimiento por suspensión proceso a prueba": ["Sobreseimiento por suspensión del proceso a prueba (Arts. 269, inc. G, y 273, CPPF)"],
-    "Reparación Integral": ["Resolución que hace lugar a reparación integral", "Resolución de Homologación de Reparación"],
-    "Sobreseimiento por Reparación": ["Sobreseimiento por acuerdo reparatorio (Arts. 269, inc. G, y 273, CPPF)"],
-    "Incompetencia": ["Resolución de incompetencia (Art. 48)", "Resolución de incompetencia con autores ignorados (Art. 48)", "Derivado a justicia provincial/local"],
-    "Derivado_a_organismo_externo": ["Derivado a organismo externo"],
-    "Cese de intervención del MPF": ["Cese de intervención del MPF"],
-    "Expulsión": ["Resolución que hace lugar a expulsión (art. 35, CPPF)"],
-    "Rebeldía": ["Resolución que declara rebeldía (Art. 69, 2do párr., CPPF)"],
-    "Con detención": ["Acta de detención (art. 215, CPPF)"]
-}
+ESTADOS_RULES = 'estados_informe' # rules/estados_informe.json: descripcionactuacion -> EstadoInforme
+STEP4_COLUMNS = ['fuente_datos_actuacion', 'EstadoInforme'] # Columnas de actuación que agrega este paso
 
 # --- Funciones de Soporte ---
 def setup_logging():
@@ -84,22 +64,44 @@ def load_config():
     if not os.path.exists(CONFIG_FILE): return None
     with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f)
 
-def safe_load(path, log_error=True):
+def safe_load(path, log_error=True, columns=None, filters=None, partition_columns=False):
     if not os.path.exists(path):
         if log_error: log_message(f"ERROR: No encontrado {path}")
         return None
-    try: return pd.read_parquet(path)
+    try: return load_parquet(path, columns=columns, filters=filters, log=log_message, partition_columns=partition_columns)
     except Exception as e:
         log_message(f"ERROR leyendo {path}: {e}")
         return None
 
-def save_metrics(df, output_path, inputs):
+def safe_load_atlas(analytical_dir, filters=None):
+    """Atlas del Paso 3 (par estrella, dataset particionado o archivo único) con el filtro en la lectura."""
+    try: return load_atlas(analytical_dir, filters=filters, log=log_message, partition_columns=True, use_dataset=True)
+    except FileNotFoundError as e:
+        log_message(f"ERROR: {e}")
+        return None
+    except Exception as e:
+        log_message(f"ERROR leyendo Atlas: {e}")
+        return None
+
+def load_personas_tables(loaded_dir):
+    """Tablas derivadas de personas (etl_personas), derivadas acá si faltan; None si no se puede."""
+    try: return derive_personas_tables(loaded_dir, log=log_message)
+    except Exception as e:
+        log_message(f"WARN: No se pudieron derivar las tablas de personas ({e}); se lee {PERSONAS_FILE}")
+        return None
+
+def save_metrics(df, output_path, inputs, rows=None, memory_mb=None, joins=None, load_timings=None):
+    # En el modo fuera de memoria df es una vista previa: se informan filas totales y pico por balde.
+    # joins: predicción y filas reales de cada cruce (JoinGuard.records)
+    # load_timings: duración, espera y filas de cada carga (ConcurrentLoads.timings)
     preview = df.head(5).astype(str).to_dict(orient='records')
     metrics = {
-        "rows": len(df), "columns": len(df.columns),
-        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2, 2),
+        "rows": len(df) if rows is None else rows, "columns": len(df.columns),
+        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2 if memory_mb is None else memory_mb, 2),
         "columns_list": list(df.columns),
         "output_file": output_path, "input_files": inputs,
+        "joins": joins or [],
+        "load_timings": load_timings or {},
         "preview": preview, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
     with open(METRICS_FILE, 'w', encoding='utf-8') as f: json.dump(metrics, f, indent=2)
@@ -114,46 +116,43 @@ def optimize_memory(df):
                 df[col] = df[col].astype('category')
     return df
 
-# --- LOGICA PRINCIPAL ---
-def run_step_4_main():
-    start_time_total = time.time()
-    setup_logging()
-    log_message("[Paso 4] Procesando Actuaciones (SOLO ACUSATORIO)...")
-    log_memory_usage()
-    
-    config = load_config()
-    paths = config.get('paths', {})
-    filters = config.get('filters', {})
-    processed_dir = paths.get('intermediate_processed')
-    analytical_dir = paths.get('intermediate_analytical')
-    loaded_dir = paths.get('intermediate_loaded')
-    
-    input_files_used = []
+def persona_columns(df_final, atlas_columns):
+    """Columnas que aportó el cruce con personas (las que se anidan con 'nested')."""
+    return [c for c in df_final.columns if c not in set(atlas_columns) and c not in STEP4_COLUMNS]
 
-    # 1. Cargar Atlas (Paso 3)
-    check_pause()
-    log_message("  1/5 Cargando Atlas (Paso 3) y Aplicando Filtros...")
-    
-    df_atlas = safe_load(os.path.join(analytical_dir, 'data_final_comparativo.parquet'))
-    if df_atlas is None:
-        log_message("ERROR CRITICO: Falta data_final_comparativo.parquet")
+def write_output(df_final, path, atlas_columns, nested, rules=None):
+    """
+    Guarda la salida plana o, con nested, una fila por actuación con las personas en una
+    columna lista (etl_nested). Sin columnas de personas se guarda plana.
+    """
+    items = persona_columns(df_final, atlas_columns) if nested else []
+    if not items:
+        write_parquet(df_final, path, *([rules] if rules else []))
         return
-    input_files_used.append("data_final_comparativo.parquet")
+    table = nest_frame(df_final, items)
+    if rules is not None:
+        table = table.replace_schema_metadata({**table.schema.metadata, **rules_metadata(rules)})
+    pq.write_table(table, path)
 
-    # Filtro Acusatorio
-    initial_rows = len(df_atlas)
-    df_casos = df_atlas[df_atlas['descripcion_sistemaprocesal'] == 'Acusatorio'].copy()
-    log_message(f"  -> Filtro Acusatorio: {initial_rows:,} -> {len(df_casos):,} filas")
-    
+# --- LOGICA PRINCIPAL ---
+def process_actuaciones(df_casos, load_personas, filters, guard=None):
+    """
+    Filtro de fechas, cruce con personas (con_persona + sin_persona) y clasificación
+    (puntos 1 a 4) sobre un conjunto de actuaciones del Atlas. load_personas(actuaciones) se
+    llama solo si quedan casos, con los IdActuacion que sobrevivieron al filtro: alcanza con
+    devolver las personas de esas actuaciones. Todo es por IdActuacion, así que en el modo fuera de memoria se aplica
+    balde por balde. guard (JoinGuard) controla la cardinalidad del cruce con personas.
+    """
+    if guard is None: guard = JoinGuard(log=log_message)
     # Filtro Fechas
     if 'date_start' in filters and 'date_end' in filters:
         d_start = pd.to_datetime(filters['date_start'])
         d_end = pd.to_datetime(filters['date_end'])
-        df_casos['FechaIngreso'] = pd.to_datetime(df_casos['FechaIngreso'], errors='coerce')
+        df_casos['FechaIngreso'], _ = parse_dates(df_casos['FechaIngreso']) # Ya es fecha nativa desde el Paso 2: no-op
         df_casos = df_casos[(df_casos['FechaIngreso'] >= d_start) & (df_casos['FechaIngreso'] <= d_end)]
         log_message(f"  -> Filtro Fechas ({d_start.date()} - {d_end.date()}): {len(df_casos):,} filas restantes")
 
-    del df_atlas; gc.collect()
+    gc.collect()
 
     if df_casos.empty:
         log_message("⚠️ ADVERTENCIA: Dataset vacío. Generando archivo dummy.")
@@ -162,46 +161,22 @@ def run_step_4_main():
         # 2. Cargar Personas
         check_pause()
         log_message("  2/5 Cargando Personas...")
-        df_personas = safe_load(os.path.join(loaded_dir, 'df_persona_actuacion_delito.parquet'), log_error=False)
-        input_files_used.append("df_persona_actuacion_delito.parquet")
+        # Todas las columnas de personas pasan a la salida: sin proyección
+        df_personas = load_personas(df_casos['IdActuacion'])
         
         # 3. Join Híbrido (Con Persona + Sin Persona)
         check_pause()
         log_message("  3/5 Cruzando Casos con Personas (Recuperando 'Sin Persona')...")
         
         if df_personas is not None:
-            # RAMA A: Con Persona (INNER JOIN)
-            log_message("    -> Generando rama 'con_persona'...")
-            df_con_persona = pd.merge(
-                df_casos, 
-                df_personas, 
-                on='IdActuacion', 
-                how='inner',
-                suffixes=('', '_per')
-            )
-            df_con_persona['fuente_datos_actuacion'] = 'con_persona'
-            
-            # Limpieza de duplicadas por merge
-            cols_to_drop = [c for c in df_con_persona.columns if c.endswith('_per')]
-            df_con_persona.drop(columns=cols_to_drop, inplace=True, errors='ignore')
-            if 'IdPersona_x' in df_con_persona.columns:
-                df_con_persona['IdPersona'] = df_con_persona['IdPersona_y'].fillna(df_con_persona['IdPersona_x'])
-                df_con_persona.drop(columns=['IdPersona_x', 'IdPersona_y'], inplace=True, errors='ignore')
-            if 'IdDelito_x' in df_con_persona.columns:
-                df_con_persona['IdDelito'] = df_con_persona['IdDelito_y'].fillna(df_con_persona['IdDelito_x'])
-                df_con_persona.drop(columns=['IdDelito_x', 'IdDelito_y'], inplace=True, errors='ignore')
-
-            # RAMA B: Sin Persona (ANTI JOIN implícito)
-            log_message("    -> Generando rama 'sin_persona'...")
-            actuaciones_con_persona = df_personas['IdActuacion'].unique()
-            df_sin_persona = df_casos[~df_casos['IdActuacion'].isin(actuaciones_con_persona)].copy()
-            df_sin_persona['fuente_datos_actuacion'] = 'sin_persona'
-            
-            # Unir (Union All)
-            log_message("    -> Uniendo ramas...")
-            df_final = pd.concat([df_con_persona, df_sin_persona], ignore_index=True)
-            
-            del df_con_persona, df_sin_persona, df_personas
+            # Con Persona (cruce interno) + Sin Persona (anti-cruce) en una sola pasada: un cruce
+            # izquierdo que etiqueta cada fila; primero las 'con_persona', después las 'sin_persona'
+            df_personas = guard.check('step4.personas', df_casos, df_personas, 'IdActuacion', how='inner')
+            df_final, n_con_persona = join_tagged(df_casos, df_personas, 'IdActuacion', 'fuente_datos_actuacion',
+                                                  ('con_persona', 'sin_persona'))
+            guard.record('step4.personas', n_con_persona)
+            log_message(f"    -> con_persona: {n_con_persona:,} filas, sin_persona: {len(df_final) - n_con_persona:,} filas")
+            del df_personas
         else:
             log_message("    -> Sin tabla de personas, todo es 'sin_persona'.")
             df_final = df_casos.copy()
@@ -215,30 +190,161 @@ def run_step_4_main():
         check_pause()
         log_message("  4/5 Aplicando Clasificación de Estados...")
         
-        desc_to_estado_map = {}
-        for estado, descripciones in ESTADOS_MAP.items():
-            for desc in descripciones:
-                desc_to_estado_map[desc] = estado
-        
-        df_final['descripcionactuacion'] = df_final['descripcionactuacion'].astype(str)
-        df_final['EstadoInforme'] = df_final['descripcionactuacion'].map(desc_to_estado_map).fillna("Otros Estados")
+        # Conversión y búsqueda sobre las descripciones distintas (reglas compiladas de rules/estados_informe.json)
+        df_final['descripcionactuacion'] = apply_on_categories(df_final['descripcionactuacion'], lambda v: v.astype(str))
+        df_final['EstadoInforme'] = compile_rules(ESTADOS_RULES).classify(df_final['descripcionactuacion'])
         
         mask_rechazo = df_final['descripcionactuacion'] == "Decisión que rechaza revisión de víctima por aplicación de crit. de oport. (252, 4to. párr., CPPF)"
         if mask_rechazo.any():
             df_final.loc[mask_rechazo, 'EstadoInforme'] = "Criterio Oportunidad- Rechazado por el Fiscal Revisor"
+    return df_final
+
+def run_step_4_main():
+    start_time_total = time.time()
+    setup_logging()
+    log_message("[Paso 4] Procesando Actuaciones (SOLO ACUSATORIO)...")
+    log_memory_usage()
+    
+    config = load_config()
+    paths = config.get('paths', {})
+    filters = config.get('filters', {})
+    processed_dir = paths.get('intermediate_processed')
+    analytical_dir = paths.get('intermediate_analytical')
+    loaded_dir = paths.get('intermediate_loaded')
+    
+    input_files_used = []
+    output_path = os.path.join(processed_dir, 'df_casos_personas_final.parquet')
+
+    out_of_core = bucket_settings(config, processed_dir)
+    if out_of_core is not None:
+        run_step_4_buckets(out_of_core, analytical_dir, loaded_dir, filters, output_path, input_files_used, config.get('joins'),
+                           nested_enabled(config))
+        log_message(f"--- [Paso 4] FINALIZADO ({time.time() - start_time_total:.2f}s) ---")
+        return
+
+    # 1. Cargar Atlas (Paso 3)
+    check_pause()
+    log_message("  1/5 Cargando Atlas (Paso 3) y Aplicando Filtros...")
+    
+    # Filtro Acusatorio empujado a la lectura: los row groups sin 'Acusatorio' no se decodifican.
+    # Si el Paso 3 dejó el Atlas particionado, solo se abre la partición Acusatorio; con el par
+    # estrella el filtro se resuelve en la dimensión de casos.
+    personas_path = os.path.join(loaded_dir, PERSONAS_FILE)
+    # Las tablas derivadas de personas se verifican (o derivan) en paralelo con el Atlas; del
+    # índice por actuación se leen después solo las filas de las actuaciones del Atlas
+    with ConcurrentLoads(log=log_message) as loads:
+        loads.submit("data_final_comparativo.parquet", safe_load_atlas, analytical_dir,
+                     filters=[('descripcion_sistemaprocesal', '==', 'Acusatorio')])
+        loads.submit("personas_derivadas", load_personas_tables, loaded_dir)
+        df_casos = loads.get("data_final_comparativo.parquet")
+        if df_casos is None:
+            log_message("ERROR CRITICO: Falta data_final_comparativo.parquet")
+            return
+        input_files_used.append("data_final_comparativo.parquet")
+        log_message(f"  -> Filtro Acusatorio (en lectura): {len(df_casos):,} filas")
+        
+        def load_personas(actuaciones):
+            tables = loads.get("personas_derivadas")
+            if tables is not None:
+                input_files_used.append(os.path.basename(tables['indice']))
+                return load_personas_for(tables, actuaciones, log=log_message)
+            input_files_used.append(PERSONAS_FILE)
+            return safe_load(personas_path, log_error=False)
+
+        guard = JoinGuard(config.get('joins'), log=log_message)
+        atlas_columns = list(df_casos.columns)
+        df_final = process_actuaciones(df_casos, load_personas, filters, guard)
+        load_timings = loads.timings()
+    del df_casos, loads
+    gc.collect()
 
     # 5. Guardar
     check_pause()
     log_message("  5/5 Guardando...")
     df_final = optimize_memory(df_final)
     
-    output_path = os.path.join(processed_dir, 'df_casos_personas_final.parquet')
-    df_final.to_parquet(output_path, index=False, engine='pyarrow')
-    save_metrics(df_final, output_path, input_files_used)
+    rules = compile_rules(ESTADOS_RULES)
+    log_rule_changes(output_path, rules, log=log_message)
+    # La huella de las reglas queda en los metadatos del Parquet
+    write_output(df_final, output_path, atlas_columns, nested_enabled(config), rules)
+    save_metrics(df_final, output_path, input_files_used, joins=guard.records, load_timings=load_timings)
     
-    log_message(f"  ¡Éxito! Guardado en {output_path}")
+    log_message(f"  ¡Éxito! Guardado en {output_path}" + (" (personas anidadas)" if nested_enabled(config) else ""))
     log_message(f"--- [Paso 4] FINALIZADO ({time.time() - start_time_total:.2f}s) ---")
 
+# --- MODO FUERA DE MEMORIA (baldes por IdActuacion) ---
+def process_bucket(work_dir, bucket, filters, joins_config, nested=False):
+    """Procesa un balde de actuaciones y deja la salida en disco (proceso hijo si workers > 1)."""
+    df_casos = read_bucket(work_dir, 'atlas', bucket)
+    if df_casos.empty:
+        return {"rows": 0, "memory_mb": 0.0, "joins": []}
+    guard = JoinGuard(joins_config, log=log_message)
+    atlas_columns = list(df_casos.columns)
+    df_final = process_actuaciones(df_casos, lambda actuaciones: read_bucket(work_dir, 'personas', bucket), filters, guard)
+    if df_final.empty:
+        # El filtro de fechas vació el balde: su archivo dummy de 4 columnas no se concatena
+        # con los demás (si todos quedan vacíos, el dummy lo escribe run_step_4_buckets)
+        return {"rows": 0, "memory_mb": 0.0, "joins": guard.records}
+    df_final = optimize_memory(df_final)
+    write_output(df_final, bucket_path(work_dir, 'salida', bucket), atlas_columns, nested)
+    return {"rows": len(df_final), "memory_mb": df_final.memory_usage(deep=True).sum() / 1024**2, "joins": guard.records}
+
+def run_step_4_buckets(out_of_core, analytical_dir, loaded_dir, filters, output_path, input_files_used, joins_config=None,
+                       nested=False):
+    """
+    Reparte la porción Acusatorio del Atlas y la tabla de personas por hash de IdActuacion
+    (la clave del cruce: cada actuación y sus personas caen en el mismo balde), procesa balde
+    por balde y concatena. Se lee el Atlas de archivo único (o el par estrella), con el filtro
+    Acusatorio en la lectura.
+    """
+    n, work_dir = out_of_core['buckets'], out_of_core['dir']
+    personas_path = os.path.join(loaded_dir, PERSONAS_FILE)
+    if atlas_source(analytical_dir)[0] is None:
+        log_message("ERROR CRITICO: Falta data_final_comparativo.parquet")
+        return
+    log_message(f"  -> Modo fuera de memoria: {n} baldes por IdActuacion, {out_of_core['workers']} procesos ({work_dir})")
+    clear_work_dir(work_dir)
+    try:
+        check_pause()
+        log_message("  1/5 Repartiendo Atlas (Acusatorio) y Personas en baldes...")
+        rows = split_atlas(analytical_dir, 'IdActuacion', n, work_dir, 'atlas',
+                           filters=[('descripcion_sistemaprocesal', '==', 'Acusatorio')], log=log_message)
+        input_files_used.append("data_final_comparativo.parquet")
+        log_message(f"    [BALDES] Atlas Acusatorio: {rows:,} filas repartidas")
+        tables = load_personas_tables(loaded_dir)
+        if tables is not None:
+            personas_path = tables['indice'] # Mismas filas, ordenadas por IdActuacion
+        if os.path.exists(personas_path):
+            rows = split_parquet(personas_path, 'IdActuacion', n, work_dir, 'personas')
+            input_files_used.append(os.path.basename(personas_path))
+            log_message(f"    [BALDES] Personas: {rows:,} filas repartidas")
+
+        stats = run_buckets(process_bucket, [(work_dir, b, filters, joins_config, nested) for b in range(n)], out_of_core['workers'])
+        salidas = [bucket_path(work_dir, 'salida', b) for b in range(n) if os.path.exists(bucket_path(work_dir, 'salida', b))]
+        check_pause()
+        log_message("  5/5 Guardando (concatenando baldes)...")
+        if not salidas:
+            # Sin actuaciones: mismo archivo dummy que el modo en memoria
+            df_vacio = process_actuaciones(read_bucket(work_dir, 'atlas', 0), lambda actuaciones: None, filters)
+            write_parquet(df_vacio, output_path, compile_rules(ESTADOS_RULES))
+            save_metrics(df_vacio, output_path, input_files_used)
+            return
+        rules = compile_rules(ESTADOS_RULES)
+        log_rule_changes(output_path, rules, log=log_message)
+        metadata = rules_metadata(rules)
+        anidados = [p for p in salidas if nested_layout(pq.read_schema(p))]
+        if anidados:
+            metadata.update(nested_metadata(pq.read_schema(anidados[0]))) # Layout anidado: el mismo en todos los baldes
+        rows = concat_buckets(salidas, output_path, metadata=metadata)
+        if anidados:
+            rows = sum(st['rows'] for st in stats) # Filas planas, como sin anidar
+        peak_mb = max((st['memory_mb'] for st in stats), default=0)
+        save_metrics(preview_frame(output_path), output_path, input_files_used, rows=rows, memory_mb=peak_mb,
+                     joins=combine_join_records(st['joins'] for st in stats))
+        log_message(f"  ¡Éxito! Guardado en {output_path} ({rows:,} filas, pico por balde {peak_mb:.1f} MB)")
+    finally:
+        clear_work_dir(work_dir)
+
 if __name__ == "__main__":
     with open(RUNNING_FLAG, 'w') as f: f.write("running")
     try:
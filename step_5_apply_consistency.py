@@ -9,7 +9,13 @@ import gc
 import json 
 from datetime import datetime
 import traceback
-import hashlib # Necesario para IdTrinomio (digest)
+import shutil
+import pyarrow.parquet as pq
+from etl_nested import read_flat, explode_table, nested_layout
+from etl_kernels import group_max, group_ids, group_nunique, concat_keys, sha256_prefix, take_values
+from etl_rules import compile_rules, rules_metadata, write_parquet, log_rule_changes
+from etl_buckets import (bucket_settings, split_parquet, read_bucket, bucket_path, run_buckets,
+                         concat_buckets, preview_frame, clear_work_dir)
 
 # --- Constantes ---
 LOG_DIR = "logs"
@@ -19,21 +25,8 @@ PAUSE_FILE = os.path.join(LOG_DIR, "step_5.pause")
 RUNNING_FLAG = os.path.join(LOG_DIR, "step_5.running")
 METRICS_FILE = os.path.join(LOG_DIR, "step_5_metrics.json")
 CONFIG_FILE = 'config.json'
-
-# --- Jerarquía ---
-ORDEN_RESOLUCIONES = {
-    "Archivo": 0, "Archivo - Aplicación": 0, "Archivo - Firme": 1,
-    "Desestimación": 0, "Desestimación - Aplicación": 0, "Desestimación - Firme": 1,
-    "Derivado a organismo externo": 0, "Incompetencia": 0, "Cese de intervención del MPF": 0,
-    "Criterio Oportunidad - Aplicación": 2, "Criterio Oportunidad - Firme": 3,
-    "Sobreseimiento por Criterio de oportunidad": 4, "Conciliación": 5,
-    "Sobreseimiento por Conciliación": 6, "Reparación Integral": 5, "Sobreseimiento por Reparación": 6,
-    "Suspensión de proceso a prueba": 5, "Sobreseimiento por suspensión proceso a prueba": 6,
-    "Suspensión acción penal por cuestión prejudicial": 5, "Sobreseimiento": 7, "Expulsión": 7,
-    "SentenciaAbsolutoriaJuicio": 8, "SentenciaAbsolutoriaAcuerdoPleno": 8,
-    "SentenciaCondenatoriaJuicio": 9, "SentenciaCondenatoriaAcuerdoPleno": 9,
-    "criteriodeoportunidadrevisión": 3
-}
+ORDEN_RULES = 'orden_resoluciones' # rules/orden_resoluciones.json: EstadoInforme -> orden_jerarquia
+HITO_COLUMNS = ['HitoMasAvanzado_Caso', 'HitoMasAvanzado_Persona']
 
 # --- Funciones Control ---
 def setup_logging():
@@ -54,22 +47,23 @@ def check_pause():
         while os.path.exists(PAUSE_FILE): time.sleep(1)
         log_message("[Reanudar] Continuando...")
 
-def load_paths():
-    if not os.path.exists(CONFIG_FILE): return None
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f).get('paths')
+def load_config():
+    if not os.path.exists(CONFIG_FILE): return {}
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f)
 
-def safe_load(path):
+def safe_load(path, columns=None, filters=None):
     if not os.path.exists(path):
         log_message(f"ERROR: No encontrado {path}"); return None
-    try: return pd.read_parquet(path)
+    try: return read_flat(path, columns=columns, filters=filters, log=log_message) # Plana aunque el Paso 4 la haya anidado
     except Exception as e:
         log_message(f"ERROR leyendo {path}: {e}"); return None
 
-def save_metrics(df, output_path, inputs):
+def save_metrics(df, output_path, inputs, rows=None, memory_mb=None):
+    # En el modo fuera de memoria df es una vista previa: se informan filas totales y pico por balde
     preview = df.head(5).astype(str).to_dict(orient='records')
     metrics = {
-        "rows": len(df), "columns": len(df.columns),
-        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2, 2),
+        "rows": len(df) if rows is None else rows, "columns": len(df.columns),
+        "memory_mb": round(df.memory_usage(deep=True).sum() / 1024**2 if memory_mb is None else memory_mb, 2),
         "columns_list": list(df.columns),
         "output_file": output_path, "input_files": inputs,
         "preview": preview, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
@@ -81,23 +75,50 @@ def optimize_memory(df):
         if df[col].nunique() / len(df) < 0.5: df[col] = df[col].astype('category')
     return df
 
-# --- Main ---
-def run_step_5_main():
-    start_time_total = time.time()
-    setup_logging()
-    log_message("[Paso 5] Consistencia y Jerarquías (Acusatorio)...")
-    
-    paths = load_paths()
-    processed_dir = paths.get('intermediate_processed')
-    output_dir = paths.get('output_reports')
-    os.makedirs(output_dir, exist_ok=True)
-    
-    check_pause()
-    log_message("  1/5 Cargando datos del Paso 4...")
-    input_file = os.path.join(processed_dir, 'df_casos_personas_final.parquet')
-    df = safe_load(input_file)
-    if df is None: return
+# --- Reglas de consistencia ---
+# Todas comparten los grupos (IdCasoOriginal, IdPersona, IdDelito), numerados una sola vez con
+# group_ids: cada regla marca grupos y el resultado se reparte a las filas por posición.
+CONFLICT_KEYS = ['IdCasoOriginal', 'IdPersona', 'IdDelito']
+SENTENCIAS_CONDENATORIAS = ["SentenciaCondenatoriaJuicio", "SentenciaCondenatoriaAcuerdoPleno"]
+
+def conflicto_juicio_acuerdo(df, groups, n_groups, con_persona):
+    """
+    Misma persona y delito con condena por juicio y por acuerdo pleno. Se marca todo el
+    grupo; el estado de consistencia cambia solo en las filas de sentencia.
+    """
+    es_sentencia = df['EstadoInforme'].isin(SENTENCIAS_CONDENATORIAS).to_numpy()
+    conflicto = group_nunique(groups, n_groups, df['EstadoInforme'], con_persona & es_sentencia) > 1
+    en_conflicto = (groups >= 0) & np.append(conflicto, False)[groups] # -1 (clave nula) toma el False final
+    return en_conflicto, en_conflicto & es_sentencia
 
+# (InconsistenciaTipo, regla, EstadoInformeConsistencia para las filas afectadas). Una regla
+# nueva es una función más con la misma firma; si dos marcan la misma fila, gana la última.
+CONSISTENCY_RULES = [
+    ("JuicioYAcuerdoPleno", conflicto_juicio_acuerdo, "SentenciaCondenatoriaConflicto"),
+]
+
+def detect_inconsistencies(df, rules=CONSISTENCY_RULES):
+    """Aplica las reglas sobre las actuaciones no copiadas (en el lugar, sin reindexar)."""
+    if df.empty:
+        return
+    if 'fuente_datos_actuacion' in df.columns:
+        con_persona = (df['fuente_datos_actuacion'] == "con_persona").to_numpy()
+    else:
+        con_persona = df['IdPersona'].notna().to_numpy()
+    groups, n_groups = group_ids(*(df[k] for k in CONFLICT_KEYS))
+    for tipo, rule, estado in rules:
+        marcadas, a_reemplazar = rule(df, groups, n_groups, con_persona)
+        if marcadas.any():
+            df.loc[marcadas, 'InconsistenciaTipo'] = tipo
+            df.loc[a_reemplazar, 'EstadoInformeConsistencia'] = estado
+            log_message(f"    -> {tipo}: {int(marcadas.sum()):,} filas")
+
+# --- Lógica ---
+def apply_consistency(df):
+    """
+    Conflictos de sentencias y jerarquía por caso (puntos 1 a 3). Los grupos son por
+    IdCasoOriginal, así que en el modo fuera de memoria se aplica balde por balde.
+    """
     # Inicializar columnas
     df['EstadoInformeConsistencia'] = df['EstadoInforme']
     df['InconsistenciaTipo'] = ""
@@ -113,25 +134,7 @@ def run_step_5_main():
     # 2. CONFLICTO SENTENCIAS
     check_pause()
     log_message("  2/5 Detectando conflictos de sentencias...")
-    sentencias = ["SentenciaCondenatoriaJuicio", "SentenciaCondenatoriaAcuerdoPleno"]
-    
-    if 'fuente_datos_actuacion' in df_nocop.columns:
-        mask_con_persona = df_nocop['fuente_datos_actuacion'] == "con_persona"
-    else:
-        mask_con_persona = df_nocop['IdPersona'].notna()
-        
-    mask_sent = mask_con_persona & (df_nocop['EstadoInforme'].isin(sentencias))
-    df_sent = df_nocop[mask_sent]
-    
-    if not df_sent.empty:
-        grupos = df_sent.groupby(['IdCasoOriginal', 'IdPersona', 'IdDelito'])['EstadoInforme'].nunique()
-        conflicto = grupos[grupos > 1].index
-        if not conflicto.empty:
-            df_nocop.set_index(['IdCasoOriginal', 'IdPersona', 'IdDelito'], inplace=True, drop=False)
-            df_nocop.loc[conflicto, 'InconsistenciaTipo'] = "JuicioYAcuerdoPleno"
-            mask = df_nocop.index.isin(conflicto) & df_nocop['EstadoInforme'].isin(sentencias)
-            df_nocop.loc[mask, 'EstadoInformeConsistencia'] = "SentenciaCondenatoriaConflicto"
-            df_nocop.reset_index(drop=True, inplace=True)
+    detect_inconsistencies(df_nocop)
 
     # 3. JERARQUÍA Y HITOS
     check_pause()
@@ -139,34 +142,83 @@ def run_step_5_main():
     df_final = pd.concat([df_nocop, df_copiadas], ignore_index=True)
     del df_nocop, df_copiadas; gc.collect()
 
-    df_final['orden_jerarquia'] = df_final['EstadoInforme'].map(ORDEN_RESOLUCIONES).fillna(-1).astype(int)
+    df_final['orden_jerarquia'] = compile_rules(ORDEN_RULES).classify(df_final['EstadoInforme']) # Sin regla: -1
     
-    df_final['HitoMasAvanzado_Caso'] = df_final.groupby('IdCasoOriginal')['orden_jerarquia'].transform('max')
-    df_final['HitoMasAvanzado_Persona'] = df_final.groupby('IdPersona')['orden_jerarquia'].transform('max')
+    df_final['HitoMasAvanzado_Caso'] = group_max(df_final['IdCasoOriginal'], df_final['orden_jerarquia'])
+    return df_final
+
+def finalize_hitos(df_final, hito_persona=None, hash_workers=1):
+    """
+    Hito más avanzado por persona e identificadores de hito. Una persona puede tener
+    actuaciones en varios casos: en el modo fuera de memoria el máximo llega ya agregado
+    entre baldes (hito_persona, indexado por IdPersona). hash_workers: procesos para el
+    hash de trinomios (en el modo fuera de memoria los baldes ya van en paralelo).
+    """
+    if hito_persona is None:
+        df_final['HitoMasAvanzado_Persona'] = group_max(df_final['IdPersona'], df_final['orden_jerarquia'])
+    else:
+        df_final['HitoMasAvanzado_Persona'] = df_final['IdPersona'].map(hito_persona)
 
     df_final['IdPersona'] = df_final['IdPersona'].fillna(-1)
+
+    # Crear ID único (Hash) para Hitos: 'IdPersona_IdCasoOriginal_IdDelito' y sus 16 primeros
+    # caracteres de SHA-256, calculados una vez por trinomio distinto (nulo si falta una parte)
+    codes, trinomios = concat_keys([df_final['IdPersona'], df_final['IdCasoOriginal'], df_final['IdDelito']], sep='_')
+    df_final['IdTrinomio'] = take_values(trinomios, codes, index=df_final.index)
+    df_final['idhitoprocesal'] = take_values(sha256_prefix(trinomios, 16, workers=hash_workers), codes, index=df_final.index)
+    return df_final
+
+def export_csv(df_final, path, header=True):
+    """Exporta en formato R (; y WINDOWS-1252). Con header=False agrega al final (baldes)."""
+    df_export = df_final.copy()
+    for col in df_export.select_dtypes(include=['category']).columns:
+        df_export[col] = df_export[col].astype(str)
+    # Tipo fijo: según haya claves nulas, el máximo sale int64 o float64 ("5" o "5.0"),
+    # y los baldes del modo fuera de memoria no coinciden entre sí
+    for col in HITO_COLUMNS:
+        if col in df_export.columns:
+            df_export[col] = df_export[col].astype('Int64')
+    df_export.to_csv(path, index=False, sep=';', encoding='windows-1252', errors='replace',
+                     header=header, mode='w' if header else 'a')
+
+# --- Main ---
+def run_step_5_main():
+    start_time_total = time.time()
+    setup_logging()
+    log_message("[Paso 5] Consistencia y Jerarquías (Acusatorio)...")
+    
+    config = load_config()
+    paths = config.get('paths')
+    processed_dir = paths.get('intermediate_processed')
+    output_dir = paths.get('output_reports')
+    os.makedirs(output_dir, exist_ok=True)
+    input_file = os.path.join(processed_dir, 'df_casos_personas_final.parquet')
+    output_path = os.path.join(processed_dir, 'df_procesal_unificado.parquet')
+    acusatorio_csv_path = os.path.join(output_dir, 'baseUnisaAcusatorio.csv')
+
+    out_of_core = bucket_settings(config, processed_dir)
+    if out_of_core is not None:
+        run_step_5_buckets(out_of_core, input_file, output_path, acusatorio_csv_path)
+        log_message(f"--- [Paso 5] FINALIZADO ({time.time() - start_time_total:.2f}s) ---")
+        return
+    
+    check_pause()
+    log_message("  1/5 Cargando datos del Paso 4...")
+    df = safe_load(input_file)
+    if df is None: return
+
+    df_final = apply_consistency(df)
+    del df; gc.collect()
     
     # 4. EXPORTAR BASE ACUSATORIO COMPLETA (DfCasosPersonasFinal_3)
     check_pause()
     log_message("  4/5 Exportando CSV Acusatorio (baseUnisaAcusatorio.csv)...")
     
-    acusatorio_csv_path = os.path.join(output_dir, 'baseUnisaAcusatorio.csv')
-    
     try:
-        # 1. Crear ID único (Hash) para Hitos
-        df_final['IdTrinomio'] = df_final['IdPersona'].astype(str) + '_' + df_final['IdCasoOriginal'].astype(str) + '_' + df_final['IdDelito'].astype(str)
-        df_final['idhitoprocesal'] = df_final['IdTrinomio'].apply(lambda x: hashlib.sha256(x.encode()).hexdigest()[:16] if pd.notna(x) else np.nan)
-        
-        # 2. Convertir a string para exportación (WINDOWS-1252)
-        df_export = df_final.copy()
-        for col in df_export.select_dtypes(include=['category']).columns:
-            df_export[col] = df_export[col].astype(str)
-
-        # 3. Guardar CSV (Formato R: ; y WINDOWS-1252)
-        df_export.to_csv(acusatorio_csv_path, index=False, sep=';', encoding='windows-1252', errors='replace')
+        df_final = finalize_hitos(df_final, hash_workers=int(config.get('hashing', {}).get('workers', 1)))
+        export_csv(df_final, acusatorio_csv_path)
         log_message(f"    ✅ Exportado CSV Acusatorio en: {acusatorio_csv_path}")
-
-        del df_export; gc.collect()
+        gc.collect()
     except Exception as e:
         log_message(f"    ❌ ERROR guardando CSV Acusatorio: {e}")
 
@@ -175,12 +227,96 @@ def run_step_5_main():
     log_message("  5/5 Guardando Parquet Procesal Unificado...")
     df_final = optimize_memory(df_final)
     
-    output_path = os.path.join(processed_dir, 'df_procesal_unificado.parquet')
-    df_final.to_parquet(output_path, index=False, engine='pyarrow')
+    rules = compile_rules(ORDEN_RULES)
+    log_rule_changes(output_path, rules, log=log_message)
+    write_parquet(df_final, output_path, rules)
     save_metrics(df_final, output_path, [input_file])
     
     log_message(f"--- [Paso 5] FINALIZADO ---")
 
+# --- Modo fuera de memoria (baldes por IdCasoOriginal) ---
+def consistency_bucket(work_dir, bucket, layout=None):
+    """
+    Primera pasada: consistencia y jerarquía del balde + máximo parcial por persona.
+    layout: el de etl_nested si la salida del Paso 4 está anidada (el balde se expande al leerlo).
+    """
+    if layout is not None:
+        df = explode_table(pq.read_table(bucket_path(work_dir, 'entrada', bucket)), layout)
+    else:
+        df = read_bucket(work_dir, 'entrada', bucket)
+    if df.empty:
+        return None
+    df_final = apply_consistency(df)
+    df_final.to_parquet(bucket_path(work_dir, 'consistencia', bucket), index=False, engine='pyarrow')
+    parcial = df_final.groupby('IdPersona')['orden_jerarquia'].max().reset_index()
+    parcial.to_parquet(bucket_path(work_dir, 'hito_persona', bucket), index=False, engine='pyarrow')
+    return len(df_final)
+
+def finalize_bucket(work_dir, bucket):
+    """Segunda pasada: hito por persona global, hash de hitos, CSV y Parquet del balde."""
+    path = bucket_path(work_dir, 'consistencia', bucket)
+    if not os.path.exists(path):
+        return {"rows": 0, "memory_mb": 0.0}
+    hito_persona = pd.read_parquet(os.path.join(work_dir, 'hito_persona.parquet'))
+    hito_persona = hito_persona.set_index('IdPersona')['orden_jerarquia']
+    df_final = finalize_hitos(read_bucket(work_dir, 'consistencia', bucket), hito_persona)
+    export_csv(df_final, os.path.join(work_dir, f"salida.b{bucket:03d}.csv"))
+    df_final = optimize_memory(df_final)
+    df_final.to_parquet(bucket_path(work_dir, 'salida', bucket), index=False, engine='pyarrow')
+    return {"rows": len(df_final), "memory_mb": df_final.memory_usage(deep=True).sum() / 1024**2}
+
+def run_step_5_buckets(out_of_core, input_file, output_path, acusatorio_csv_path):
+    """
+    Reparte la salida del Paso 4 por hash de IdCasoOriginal (clave de los conflictos y del
+    hito por caso) y procesa en dos pasadas: la primera deja el máximo parcial por persona,
+    que se agrega entre baldes (tabla chica) y la segunda lo aplica y exporta. El CSV y el
+    Parquet se arman concatenando los baldes.
+    """
+    n, work_dir = out_of_core['buckets'], out_of_core['dir']
+    if not os.path.exists(input_file):
+        log_message(f"ERROR: No encontrado {input_file}")
+        return
+    log_message(f"  -> Modo fuera de memoria: {n} baldes por IdCasoOriginal, {out_of_core['workers']} procesos ({work_dir})")
+    clear_work_dir(work_dir)
+    try:
+        check_pause()
+        log_message("  1/5 Repartiendo datos del Paso 4 en baldes...")
+        rows = split_parquet(input_file, 'IdCasoOriginal', n, work_dir, 'entrada')
+        log_message(f"    [BALDES] {os.path.basename(input_file)}: {rows:,} filas repartidas")
+
+        layout = nested_layout(pq.read_schema(input_file))
+        filas = run_buckets(consistency_bucket, [(work_dir, b, layout) for b in range(n)], out_of_core['workers'])
+        parciales = [pd.read_parquet(bucket_path(work_dir, 'hito_persona', b)) for b, r in enumerate(filas) if r is not None]
+        if not parciales:
+            log_message("ERROR: El Paso 4 no dejó filas para procesar.")
+            return
+        hito_persona = pd.concat(parciales, ignore_index=True).groupby('IdPersona')['orden_jerarquia'].max().reset_index()
+        hito_persona.to_parquet(os.path.join(work_dir, 'hito_persona.parquet'), index=False, engine='pyarrow')
+        log_message(f"    [BALDES] Hito por persona agregado: {len(hito_persona):,} personas")
+
+        check_pause()
+        log_message("  4/5 Exportando CSV Acusatorio (baseUnisaAcusatorio.csv)...")
+        stats = run_buckets(finalize_bucket, [(work_dir, b) for b in range(n)], out_of_core['workers'])
+        partes_csv = [os.path.join(work_dir, f"salida.b{b:03d}.csv") for b in range(n)]
+        partes_csv = [p for p in partes_csv if os.path.exists(p)]
+        with open(acusatorio_csv_path, 'wb') as out:
+            for i, parte in enumerate(partes_csv):
+                with open(parte, 'rb') as f:
+                    if i > 0: f.readline() # Encabezado solo una vez
+                    shutil.copyfileobj(f, out)
+        log_message(f"    ✅ Exportado CSV Acusatorio en: {acusatorio_csv_path}")
+
+        check_pause()
+        log_message("  5/5 Guardando Parquet Procesal Unificado (concatenando baldes)...")
+        rules = compile_rules(ORDEN_RULES)
+        log_rule_changes(output_path, rules, log=log_message)
+        rows = concat_buckets([bucket_path(work_dir, 'salida', b) for b in range(n)], output_path, metadata=rules_metadata(rules))
+        peak_mb = max((st['memory_mb'] for st in stats), default=0)
+        save_metrics(preview_frame(output_path), output_path, [input_file], rows=rows, memory_mb=peak_mb)
+        log_message(f"    {rows:,} filas, pico por balde {peak_mb:.1f} MB")
+    finally:
+        clear_work_dir(work_dir)
+
 if __name__ == "__main__":
     setup_logging()
     try:
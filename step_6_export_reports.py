@@ -10,6 +10,7 @@ import json
 import math 
 import traceback # AGREGADO
 from datetime import datetime # AGREGADO
+from etl_atlas import load_atlas
 
 # --- Constantes ---
 LOG_DIR = "logs"
@@ -58,13 +59,6 @@ def save_metrics(df, main_output, created_files):
     }
     with open(METRICS_FILE, 'w', encoding='utf-8') as f: json.dump(metrics, f, indent=2)
 
-def safe_load(path):
-    if not os.path.exists(path):
-        log_message(f"ERROR: No encontrado {path}"); return None
-    try: return pd.read_parquet(path)
-    except Exception as e:
-        log_message(f"ERROR leyendo {path}: {e}"); return None
-
 def log_memory():
     mem = psutil.virtual_memory().percent
     return f"(RAM: {mem}%)"
@@ -110,7 +104,9 @@ def run_step_6_main():
     # 1. CARGA
     check_pause()
     log_message(f"  1/4 Cargando Atlas... {log_memory()}")
-    df = safe_load(os.path.join(analytical_dir, 'data_final_comparativo.parquet'))
+    try: df = load_atlas(analytical_dir, log=log_message) # Archivo ancho o vista reconstruida del par estrella
+    except Exception as e:
+        log_message(f"ERROR leyendo Atlas: {e}"); df = None
     if df is None: 
         log_message("ERROR CRITICO: Falta data_final_comparativo.parquet")
         return